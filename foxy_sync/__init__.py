@@ -7,6 +7,7 @@ import logging.config
 
 from .snapshot import *
 from .transaction import *
+from .watch import *
 from . import utils
 
 version = "0.1"
@@ -22,12 +23,21 @@ class Run:
     parser.add_argument("-i", action="store_true",
                         help="start transaction immediately.")
     parser.add_argument("--prefix")
+    parser.add_argument("--compare", choices=("md5", "fast"),
+                        help="compare by md5, or by size and mtime first.")
+    parser.add_argument("--watch", action="store_true",
+                        help="keep pushing changes of the local directory.")
+    parser.add_argument("--progress", action="store_true",
+                        help="print progress of the jobs.")
+    parser.add_argument("--status",
+                        choices=("ready", "finished", "failed", "canceled"),
+                        help="print only jobs of the status in a dump.")
     parser.add_argument("--version", action="version", version=version)
 
     def start(self):
         try:
             self._start()
-        except utils.TransactionError as e:
+        except (utils.ConfigError, utils.TransactionError) as e:
             print(e)
             sys.exit(1)
         except Exception as e:
@@ -40,6 +50,10 @@ class Run:
 
         # load configuration
         config = utils.Config()
+        if args.compare is not None:
+            config.compare = args.compare
+        if args.progress:
+            config.progress = True
 
         # configure logging
         if config.log_config is not None:
@@ -50,23 +64,34 @@ class Run:
                 c["handlers"]["file"]["filename"] = config.log_file
             logging.config.dictConfig(c)
 
-        if args.dest is None:
+        if args.watch:
+            if args.dest is None:
+                raise utils.TransactionError("--watch needs a destination.")
+            dest = Snapshot.get_instance(args.dest, args)
+            if not isinstance(dest, AliOssSnapshot):
+                raise utils.TransactionError("--watch only pushes to AliOss.")
+            Watcher(args.src, dest).run()
+        elif args.dest is None:
             # load a transaction dump
-            ts = Transaction.load(args.src)
-            ts.get_jobs()
-
             if args.i:
+                ts = Transaction.load(args.src)
+                ts.get_jobs(pipeline=config.pipeline)
                 ts.start()
             else:
-                print(ts)
+                # jobs are read one by one, without the snapshots
+                Transaction.write_jobs(sys.stdout,
+                                       Transaction.iter_jobs(args.src),
+                                       status=args.status)
         else:
             src = Snapshot.get_instance(args.src, args)
             dest = Snapshot.get_instance(args.dest, args)
             ts = src.push_to(dest)
-            ts.get_jobs()
+            # a plan to be looked at first is not pushed meanwhile
+            ts.get_jobs(pipeline=args.i and config.pipeline)
 
             if args.i:
                 ts.start()
             else:
                 ts.dump()
+                ts.write_metrics()
                 print(ts.dump_path)
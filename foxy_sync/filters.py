@@ -0,0 +1,166 @@
+import re
+import threading
+
+from . import utils
+
+
+__all__ = ["PathFilter"]
+
+
+class PathFilter:
+    """Include and exclude rules of paths relative to the snapshot root, in
+    the syntax of gitignore:
+
+        *.tmp           files or directories named so, at any depth
+        node_modules/   directories only
+        /build, a/*.log anchored to the root, as the rule has a slash
+        docs/**/draft   ** matches any number of directories
+        !keep.tmp       included again, the last rule matched wins
+
+    A path under an excluded directory is excluded too, whatever the rules,
+    so that excluded directories are pruned before being walked or listed.
+
+    Rules are compiled once into a single regular expression, for files and
+    for directories each. Its alternatives are the rules in reverse order,
+    so the first one matched is the last rule that matches.
+
+    Patterns of skip_dir are kept for directories, matched against the
+    whole path by fnmatch, where * also matches slashes.
+    """
+
+    # directories whose result is cached
+    cache_size = 100000
+
+    _lock = threading.Lock()
+    _current = None
+
+    def __init__(self, rules=(), skip_dir=()):
+        # (regex, include, directory only)
+        self.rules = [(self._translate(p, slash=True), False, True)
+                      for p in skip_dir]
+        for rule in rules:
+            rule = self._parse(rule)
+            if rule is not None:
+                self.rules.append(rule)
+
+        self._files = self._compile([r for r in self.rules if not r[2]])
+        self._dirs = self._compile(self.rules)
+        self._parents = {}
+
+    @classmethod
+    def get(cls):
+        """:return: the filter of skip_dir and filters in Config, compiled
+        again only if they are changed."""
+        config = utils.Config()
+        key = (tuple(config.skip_dir), tuple(config.filters))
+        with cls._lock:
+            if cls._current is None or cls._current[0] != key:
+                cls._current = (key, cls(config.filters, config.skip_dir))
+            return cls._current[1]
+
+    def match(self, path, directory=False):
+        """:return: True if path itself is excluded, its parent directories
+                    are not checked."""
+        regex, includes = self._dirs if directory else self._files
+        if regex is None:
+            return False
+        m = regex.fullmatch(path)
+        return m is not None and not includes[m.lastindex-1]
+
+    def excluded(self, path, directory=False):
+        """:return: True if path or one of its parent directories is
+                    excluded."""
+        if not self.rules:
+            return False
+        return (self.excluded_parent(path) is not None or
+                self.match(path, directory))
+
+    def excluded_parent(self, path):
+        """:return: the top excluded directory containing path, or None"""
+        parent = path.rpartition("/")[0]
+        if not parent or not self.rules:
+            return None
+
+        result = self._parents.get(parent)
+        if result is None:
+            result = self.excluded_parent(parent)
+            if result is None:
+                result = parent if self.match(parent, directory=True) else ""
+            if len(self._parents) >= self.cache_size:
+                self._parents.clear()
+            self._parents[parent] = result
+        return result or None
+
+    @classmethod
+    def _parse(cls, rule):
+        """:return: (regex, include, directory only), or None for blank
+                    lines and comments."""
+        rule = rule.strip()
+        if not rule or rule.startswith("#"):
+            return None
+
+        include = rule.startswith("!")
+        if include:
+            rule = rule[1:]
+        directory = rule.endswith("/")
+        rule = rule.rstrip("/")
+        if "/" in rule:
+            regex = cls._translate(rule.lstrip("/"))
+        else:
+            # matches the name at any depth
+            regex = "(?:.*/)?" + cls._translate(rule)
+        return regex, include, directory
+
+    @staticmethod
+    def _translate(pattern, slash=False):
+        """glob pattern into a regex without capturing groups.
+
+        :param slash: wildcards match slashes too, as fnmatch
+        """
+        any_char = "." if slash else "[^/]"
+        result = []
+        i = 0
+        while i < len(pattern):
+            c = pattern[i]
+            if pattern.startswith("**/", i):
+                result.append("(?:.*/)?")
+                i += 2
+            elif pattern.startswith("**", i):
+                result.append(".*")
+                i += 1
+            elif c == "*":
+                result.append(any_char + "*")
+            elif c == "?":
+                result.append(any_char)
+            elif c == "[":
+                end = i + 1
+                if end < len(pattern) and pattern[end] in "!^":
+                    end += 1
+                if end < len(pattern) and pattern[end] == "]":
+                    end += 1
+                end = pattern.find("]", end)
+                if end < 0:
+                    result.append(re.escape(c))
+                else:
+                    chars = pattern[i+1:end].replace("\\", "\\\\")
+                    if chars[0] in "!^":
+                        chars = "^" + chars[1:]
+                    result.append("[%s]" % chars)
+                    i = end
+            elif c == "\\" and i + 1 < len(pattern):
+                i += 1
+                result.append(re.escape(pattern[i]))
+            else:
+                result.append(re.escape(c))
+            i += 1
+        return "".join(result)
+
+    @staticmethod
+    def _compile(rules):
+        """:return: (regex, includes by alternative), regex is None if no
+                    rule"""
+        if not rules:
+            return None, []
+        rules = rules[::-1]
+        regex = re.compile("|".join("(%s)" % r[0] for r in rules), re.S)
+        return regex, [r[1] for r in rules]
@@ -0,0 +1,237 @@
+import os
+import sys
+import json
+import time
+import bisect
+import logging
+import threading
+import contextlib
+from array import array
+from datetime import datetime
+
+from . import utils
+
+
+__all__ = ["Metrics", "Progress"]
+
+logger = logging.getLogger(__name__)
+
+
+class _Histogram:
+    """Values are all kept for percentiles, and counted in buckets for
+    Prometheus."""
+
+    buckets = (0.1, 0.5, 1, 5, 10, 30, 60, 300, 600, 1800)
+
+    def __init__(self):
+        self.values = array("d")
+        self.counts = [0] * (len(self.buckets) + 1)
+
+    def observe(self, value):
+        self.values.append(value)
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+
+    def percentile(self, p):
+        values = sorted(self.values)
+        if not values:
+            return None
+        return values[min(int(len(values) * p / 100), len(values) - 1)]
+
+
+class Metrics(metaclass=utils.SingletonMeta):
+    """Counters, gauges, histograms and phase times of the process.
+
+    Names may have labels, such as inc("job_failures", error="NoSuchKey").
+    Phases are named after the steps of a sync: scan, hash, list, head,
+    diff, plan and execute. They may overlap, plan includes the loading
+    of the snapshots it needs.
+
+    write() puts a Prometheus textfile, foxy_sync.prom, and a JSON summary
+    of the run into cache_dir.
+    """
+
+    prefix = "foxy_sync_"
+
+    def __init__(self):
+        self.reset()
+
+    def reset(self):
+        self._lock = threading.Lock()
+        self.started = time.time()
+        self.counters = {}
+        self.gauges = {}
+        self.histograms = {}
+        self.phases = {}
+
+    def inc(self, name, value=1, **labels):
+        key = self._key(name, labels)
+        with self._lock:
+            self.counters[key] = self.counters.get(key, 0) + value
+
+    def set(self, name, value, **labels):
+        self.gauges[self._key(name, labels)] = value
+
+    def observe(self, name, value):
+        with self._lock:
+            histogram = self.histograms.get(name)
+            if histogram is None:
+                histogram = self.histograms[name] = _Histogram()
+            histogram.observe(value)
+
+    @contextlib.contextmanager
+    def phase(self, name):
+        """time a phase, added up if it runs more than once."""
+        start = time.time()
+        try:
+            yield
+        finally:
+            with self._lock:
+                self.phases[name] = (self.phases.get(name, 0) +
+                                     time.time() - start)
+
+    def get(self, name, **labels):
+        return self.counters.get(self._key(name, labels), 0)
+
+    def total(self, name):
+        """:return: sum of a counter of all labels"""
+        head = name + "{"
+        return sum(v for k, v in list(self.counters.items())
+                   if k == name or k.startswith(head))
+
+    def summary(self, name=None):
+        def per_second(counter, phase, unit=1):
+            seconds = self.phases.get(phase)
+            if not seconds:
+                return None
+            return round(self.total(counter) / seconds / unit, 2)
+
+        result = {"name": name,
+                  "start": datetime.fromtimestamp(self.started).isoformat(),
+                  "seconds": round(time.time() - self.started, 3),
+                  "phases": {k: round(v, 3) for k, v in self.phases.items()},
+                  "counters": dict(self.counters),
+                  "gauges": dict(self.gauges),
+                  "rates": {
+                      "scan_files_per_second": per_second("scanned_files",
+                                                          "scan"),
+                      "list_keys_per_second": per_second("listed_keys",
+                                                         "list"),
+                      "hash_mb_per_second": per_second("hashed_bytes", "hash",
+                                                       2**20),
+                      "upload_mb_per_second": per_second("uploaded_bytes",
+                                                         "execute", 2**20),
+                      "jobs_per_second": per_second("jobs", "execute")}}
+
+        for key, histogram in self.histograms.items():
+            result[key] = {"count": len(histogram.values),
+                           "p50": histogram.percentile(50),
+                           "p90": histogram.percentile(90),
+                           "p99": histogram.percentile(99),
+                           "max": max(histogram.values)}
+        return result
+
+    def write(self, name=None):
+        """write the Prometheus textfile, and the JSON summary if the run
+        has a name."""
+        cache_dir = utils.Config().cache_dir
+        try:
+            self._write(os.path.join(cache_dir, "foxy_sync.prom"),
+                        self.prometheus())
+            if name is not None:
+                self._write(os.path.join(cache_dir, name + ".metrics.json"),
+                            json.dumps(self.summary(name), indent=2,
+                                       sort_keys=True) + "\n")
+        except OSError as e:
+            logger.warning("write metrics failed: %s", e)
+
+    def prometheus(self):
+        lines = []
+
+        def add(name, kind, samples):
+            name = self.prefix + name
+            lines.append("# TYPE %s %s" % (name, kind))
+            for labels, value in samples:
+                lines.append("%s%s %s" % (name, labels, value))
+
+        for kind, values in (("counter", self.counters),
+                             ("gauge", self.gauges)):
+            by_name = {}
+            for key, value in sorted(values.items()):
+                metric, _, labels = key.partition("{")
+                by_name.setdefault(metric, []).append(
+                    ("{" + labels if labels else "", value))
+            for metric, samples in sorted(by_name.items()):
+                add(metric, kind, samples)
+
+        add("phase_seconds", "gauge",
+            [('{phase="%s"}' % k, round(v, 3))
+             for k, v in sorted(self.phases.items())])
+
+        for key, histogram in sorted(self.histograms.items()):
+            samples = []
+            count = 0
+            for bound, number in zip(self._bounds(),
+                                     histogram.counts):
+                count += number
+                samples.append(('_bucket{le="%s"}' % bound, count))
+            samples.append(("_sum", round(sum(histogram.values), 3)))
+            samples.append(("_count", count))
+            add(key, "histogram", samples)
+
+        return "\n".join(lines) + "\n"
+
+    @staticmethod
+    def _bounds():
+        return [str(b) for b in _Histogram.buckets] + ["+Inf"]
+
+    @staticmethod
+    def _write(path, text):
+        tmp_path = path + ".tmp"
+        with open(tmp_path, "w") as f:
+            f.write(text)
+        os.replace(tmp_path, path)
+
+    @staticmethod
+    def _key(name, labels):
+        if not labels:
+            return name
+        return "%s{%s}" % (name, ",".join('%s="%s"' % (k, labels[k])
+                                          for k in sorted(labels)))
+
+
+class Progress:
+    """print a line of job progress to stderr every interval seconds."""
+
+    interval = 1
+
+    def __init__(self, executor):
+        self.executor = executor
+        self._stopped = threading.Event()
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._start = time.time()
+        self._uploaded = Metrics().total("uploaded_bytes")
+
+    def start(self):
+        self._thread.start()
+
+    def stop(self):
+        self._stopped.set()
+        self._thread.join()
+        self._show()
+        sys.stderr.write("\n")
+
+    def _run(self):
+        while not self._stopped.wait(self.interval):
+            self._show()
+
+    def _show(self):
+        executor = self.executor
+        uploaded = Metrics().total("uploaded_bytes") - self._uploaded
+        seconds = max(time.time() - self._start, 0.001)
+        sys.stderr.write(
+            "\r%s/%s jobs, %s failed, %.1f MB/s, %.1f MB in flight  " % (
+                executor.finished_number + executor.failed_number,
+                executor.total, executor.failed_number,
+                uploaded / seconds / 2**20,
+                executor.inflight_bytes / 2**20))
+        sys.stderr.flush()
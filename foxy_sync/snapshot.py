@@ -1,27 +1,99 @@
 
+import io
 import os
-import fnmatch
+import gzip
+import json
+import time
+import uuid
 import logging
+import threading
+from math import isnan
+from array import array
 from datetime import datetime
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
 
 import oss2
-from oss2.http import Session as OssSession
 
 from . import utils
+from .filters import PathFilter
+from .metrics import Metrics
 
 
-__all__ = ["FileIdentity", "Snapshot", "LocalSnapshot", "AliOssSnapshot"]
+__all__ = ["FileIdentity", "FileTable", "Snapshot", "LocalSnapshot",
+           "AliOssSnapshot", "merge_diff", "same_content", "same_md5",
+           "same_metadata", "ADDED", "REMOVED", "CHANGED", "UNCHANGED"]
 
 logger = logging.getLogger(__name__)
 
+NAN = float("nan")
+
 
 class FileIdentity:
+    """A file of a FileTable. It is only a view on a row of the table and
+    holds no data itself, so that views can be created on access.
 
-    def __init__(self, path, md5=None, mtime=None, prefix=''):
-        self.path = path
-        self.md5 = md5
-        self.mtime = mtime
-        self.prefix = prefix
+    Created directly, the identity is backed by a table of its own.
+    """
+
+    __slots__ = ("table", "index")
+
+    def __init__(self, path, md5=None, mtime=None, prefix='', size=None,
+                 stat=None):
+        """
+        :param size: file size in bytes, not compared.
+        :param stat: (size, mtime_ns, inode, device) of a local file, taken
+                     while scanning, not compared.
+        """
+        self.table = FileTable(prefix)
+        self.index = self.table.append(path, md5=md5, mtime=mtime, size=size,
+                                       stat=stat)
+
+    @classmethod
+    def view(cls, table, index):
+        f_id = cls.__new__(cls)
+        f_id.table = table
+        f_id.index = index
+        return f_id
+
+    @property
+    def path(self):
+        return self.table.path(self.index)
+
+    @property
+    def prefix(self):
+        return self.table.prefix
+
+    @property
+    def md5(self):
+        return self.table.md5(self.index)
+
+    @md5.setter
+    def md5(self, value):
+        self.table.set_md5(self.index, value)
+
+    @property
+    def mtime(self):
+        return self.table.mtime(self.index)
+
+    @mtime.setter
+    def mtime(self, value):
+        self.table.set_mtime(self.index, value)
+
+    @property
+    def size(self):
+        return self.table.size(self.index)
+
+    @size.setter
+    def size(self, value):
+        self.table.set_size(self.index, value)
+
+    @property
+    def stat(self):
+        return self.table.stat(self.index)
+
+    @stat.setter
+    def stat(self, value):
+        self.table.set_stat(self.index, value)
 
     def __str__(self):
         data = ""
@@ -47,12 +119,229 @@ class FileIdentity:
         """support set operation"""
         return hash((self.path, self.md5, self.mtime))
 
+    def __getstate__(self):
+        return self.table, self.index
+
+    def __setstate__(self, state):
+        if isinstance(state, dict):
+            # dumps before FileTable pickled the __dict__ of identities
+            self.__init__(state["path"], md5=state.get("md5"),
+                          mtime=state.get("mtime"),
+                          prefix=state.get("prefix", ''),
+                          size=state.get("size"), stat=state.get("stat"))
+        else:
+            self.table, self.index = state
+
+
+class FileTable:
+    """Files of a snapshot, stored by column instead of one object per file.
+
+    Directories of paths are interned, md5 is kept as 16 bytes and numbers
+    in arrays. Iterating the table gives FileIdentity views.
+    """
+
+    # flags
+    HAS_MD5 = 1
+    EMPTY_MD5 = 2
+    HAS_STAT = 4
+
+    def __init__(self, prefix=''):
+        self.prefix = prefix
+        self._dirs = []
+        self._dir_ids = {}
+        self._dir = array("I")
+        self._name = []
+        self._flags = bytearray()
+        self._md5 = bytearray()
+        self._mtime = array("d")
+        self._size = array("q")
+        self._mtime_ns = array("q")
+        self._inode = array("Q")
+        self._device = array("Q")
+        # md5 that is not a hex digest, such as md5 meta set by others
+        self._odd_md5 = {}
+        # whether files are appended in order of path
+        self.is_sorted = True
+        self._last_path = None
+
+    def append(self, path, md5=None, mtime=None, size=None, stat=None):
+        """:return: index of the new file"""
+        if self.is_sorted:
+            if self._last_path is not None and path < self._last_path:
+                self.is_sorted = False
+            self._last_path = path
+
+        directory, name = os.path.split(path)
+        dir_id = self._dir_ids.get(directory)
+        if dir_id is None:
+            dir_id = self._dir_ids[directory] = len(self._dirs)
+            self._dirs.append(directory)
+
+        index = len(self._name)
+        self._dir.append(dir_id)
+        self._name.append(name)
+        self._flags.append(0)
+        self._md5.extend(bytes(16))
+        self._mtime.append(NAN)
+        self._size.append(-1 if size is None else size)
+        self._mtime_ns.append(0)
+        self._inode.append(0)
+        self._device.append(0)
+
+        if md5 is not None:
+            self.set_md5(index, md5)
+        if mtime is not None:
+            self.set_mtime(index, mtime)
+        if stat is not None:
+            self.set_stat(index, stat)
+        return index
+
+    def path(self, index):
+        return os.path.join(self._dirs[self._dir[index]], self._name[index])
+
+    def md5(self, index):
+        flags = self._flags[index]
+        if flags & self.HAS_MD5:
+            return self._md5[index*16:index*16+16].hex().upper()
+        elif flags & self.EMPTY_MD5:
+            return ""
+        else:
+            return self._odd_md5.get(index)
+
+    def set_md5(self, index, value):
+        flags = self._flags[index] & ~(self.HAS_MD5 | self.EMPTY_MD5)
+        self._odd_md5.pop(index, None)
+
+        if value == "":
+            flags |= self.EMPTY_MD5
+        elif value is not None:
+            try:
+                digest = bytes.fromhex(value)
+            except ValueError:
+                digest = None
+            if digest is not None and len(digest) == 16:
+                self._md5[index*16:index*16+16] = digest
+                flags |= self.HAS_MD5
+            else:
+                self._odd_md5[index] = value
+
+        self._flags[index] = flags
+
+    def mtime(self, index):
+        value = self._mtime[index]
+        return None if isnan(value) else value
+
+    def set_mtime(self, index, value):
+        self._mtime[index] = NAN if value is None else value
+
+    def size(self, index):
+        value = self._size[index]
+        return None if value < 0 else value
+
+    def set_size(self, index, value):
+        self._size[index] = -1 if value is None else value
+
+    def stat(self, index):
+        """:return: (size, mtime_ns, inode, device) or None"""
+        if self._flags[index] & self.HAS_STAT:
+            return (self._size[index], self._mtime_ns[index],
+                    self._inode[index], self._device[index])
+        return None
+
+    def set_stat(self, index, value):
+        (self._size[index], self._mtime_ns[index], self._inode[index],
+         self._device[index]) = value
+        self._flags[index] |= self.HAS_STAT
+
+    def iter_sorted(self):
+        """:return: generator of FileIdentity sorted by path. Files appended
+        in order are not sorted again."""
+        if self.is_sorted:
+            order = range(len(self))
+        else:
+            order = array("I", sorted(range(len(self)), key=self.path))
+        for i in order:
+            yield FileIdentity.view(self, i)
+
+    def __getitem__(self, index):
+        if not 0 <= index < len(self):
+            raise IndexError(index)
+        return FileIdentity.view(self, index)
+
+    def __iter__(self):
+        for i in range(len(self)):
+            yield FileIdentity.view(self, i)
+
+    def __len__(self):
+        return len(self._name)
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        del state["_dir_ids"]
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._dir_ids = {d: i for i, d in enumerate(self._dirs)}
+
+
+ADDED = "added"
+REMOVED = "removed"
+CHANGED = "changed"
+UNCHANGED = "unchanged"
+
+
+def same_content(a, b):
+    return a.md5 == b.md5 and a.mtime == b.mtime
+
+
+def same_md5(a, b):
+    """compared by md5 only, such as objects with mtime from the manifest to
+    files loaded without mtime."""
+    return a.md5 == b.md5
+
+
+def same_metadata(a, b):
+    """file not changed since uploaded, judged by size and mtime only."""
+    return a.size == b.size and a.mtime is not None and a.mtime == b.mtime
+
+
+def merge_diff(mine, theirs, same=same_content, unchanged=False):
+    """Diff two iterables of file identities, both sorted by path, with
+    constant memory.
+
+    :param same: function telling whether two files of a path are the same.
+    :param unchanged: yield files that are the same too.
+    :return: generator of (kind, file in mine, file in theirs) in order of
+             path. kind is ADDED if the path is only in mine, REMOVED if only
+             in theirs, CHANGED if the files are not the same and UNCHANGED
+             otherwise, the file missing from the side is None.
+    """
+    mine = iter(mine)
+    theirs = iter(theirs)
+    a = next(mine, None)
+    b = next(theirs, None)
+
+    while a is not None or b is not None:
+        if b is None or (a is not None and a.path < b.path):
+            yield ADDED, a, None
+            a = next(mine, None)
+        elif a is None or b.path < a.path:
+            yield REMOVED, None, b
+            b = next(theirs, None)
+        else:
+            if not same(a, b):
+                yield CHANGED, a, b
+            elif unchanged:
+                yield UNCHANGED, a, b
+            a = next(mine, None)
+            b = next(theirs, None)
+
 
 class Snapshot:
-    def __init__(self, root):
+    def __init__(self, root, prefix=''):
         self.root = root
-        self.files = []
-        self._frozen_files = set()
+        self.files = FileTable(prefix)
         self.load_completed = False
         self._scan()
         logger.info("%s files in %s", len(self.files), self.root)
@@ -85,19 +374,22 @@ class Snapshot:
                 raise utils.SnapshotError("invalid local directory %s" % path)
 
     def diff_str(self, snapshot):
-        only_in_self, only_in_other = self.diff(snapshot)
-        data = ''
-        if only_in_self:
-            data += "only in %s ->\n" % self.root
-            for f_id in only_in_self:
-                data += "    %s\n" % f_id
-
-        if only_in_other:
-            data += "only in %s ->\n" % snapshot.root
-            for f_id in only_in_other:
-                data += "    %s\n" % f_id
-
-        return data
+        f = io.StringIO()
+        self.write_diff(snapshot, f)
+        return f.getvalue()
+
+    def write_diff(self, snapshot, f):
+        """write the diff into file object f, line by line."""
+        for root, kinds in ((self.root, (ADDED, CHANGED)),
+                            (snapshot.root, (REMOVED, CHANGED))):
+            head = "only in %s ->\n" % root
+            for kind, mine, theirs in self.iter_diff(snapshot):
+                if kind in kinds:
+                    if head:
+                        f.write(head)
+                        head = None
+                    f_id = mine if root == self.root else theirs
+                    f.write("    %s\n" % f_id)
 
     def diff(self, snapshot):
         """diff two snapshots, get two list of file identity, with of each is
@@ -105,17 +397,26 @@ class Snapshot:
 
         :return: (only_in_self, only_in_other)
         """
-        s = self.frozen_files.intersection(snapshot.frozen_files)
-        only_in_self = self._sort(self.frozen_files.difference(s))
-        only_in_other = self._sort(snapshot.frozen_files.difference(s))
+        only_in_self = []
+        only_in_other = []
+        for kind, mine, theirs in self.iter_diff(snapshot):
+            if mine is not None:
+                only_in_self.append(mine)
+            if theirs is not None:
+                only_in_other.append(theirs)
         return only_in_self, only_in_other
 
+    def iter_diff(self, snapshot, **kwargs):
+        """streaming version of diff, see merge_diff for kwargs."""
+        return merge_diff(self.frozen_files.iter_sorted(),
+                          snapshot.frozen_files.iter_sorted(), **kwargs)
+
     @property
     def frozen_files(self):
         if not self.load_completed:
             raise utils.SnapshotError("snapshot loading unfinished, call  "
                                       "load_detail() first.")
-        return self._frozen_files
+        return self.files
 
     def push_to(self, snapshot):
         raise NotImplementedError
@@ -133,32 +434,25 @@ class Snapshot:
 
     @staticmethod
     def should_skip(path, directory=False, key=False):
-        if directory:
-            target_dir = path
-        elif key:
-            target_dir = os.path.dirname(path)
-        else:
+        """:return: True if the directory, or the file of key, is excluded by
+                    skip_dir and filters, see filters.PathFilter"""
+        if not directory and not key:
             raise utils.SnapshotError("unknown path type")
-
-        config = utils.Config()
-        for p in config.skip_dir:
-            if fnmatch.fnmatch(target_dir, p):
-                return True
-
-        return False
+        return PathFilter.get().excluded(path, directory=directory)
 
     def _load_detail(self, md5=False, mtime=False):
         raise NotImplementedError
 
-    @staticmethod
-    def _sort(id_set):
-        return sorted(id_set, key=lambda x: x.path)
-
     def __str__(self):
-        data = "%s -> %s files\n" % (self.root, len(self.frozen_files))
-        for f_id in self._sort(self.frozen_files):
-            data += "    %s\n" % f_id
-        return data
+        f = io.StringIO()
+        self.write(f)
+        return f.getvalue()
+
+    def write(self, f):
+        """write files into file object f, line by line."""
+        f.write("%s -> %s files\n" % (self.root, len(self.frozen_files)))
+        for f_id in self.frozen_files.iter_sorted():
+            f.write("    %s\n" % f_id)
 
     def __len__(self):
         return len(self.files)
@@ -168,12 +462,26 @@ class Snapshot:
         """
         return {"root": self.root,
                 "files": self.files,
-                "_frozen_files": self._frozen_files,
                 "load_completed": self.load_completed}
 
+    def __setstate__(self, state):
+        files = state["files"]
+        if not isinstance(files, FileTable):
+            # dumps before FileTable hold a list of identities and a set
+            table = FileTable(files[0].prefix if files else '')
+            for f in files:
+                table.append(f.path, md5=f.md5, mtime=f.mtime, size=f.size,
+                             stat=f.stat)
+            state["files"] = table
+            state.pop("_frozen_files", None)
+        self.__dict__.update(state)
+
 
 class LocalSnapshot(Snapshot):
 
+    # files being downloaded, which are not scanned
+    partial_suffix = ".foxy_sync_part"
+
     def __init__(self, root_dir):
         if not os.path.isdir(root_dir):
             raise utils.SnapshotError("LocalSnapshot need directory.")
@@ -187,6 +495,12 @@ class LocalSnapshot(Snapshot):
         from . import transaction
         if isinstance(snapshot, AliOssSnapshot):
             return transaction.Local2AliOssTransaction(self, snapshot)
+        elif isinstance(snapshot, LocalSnapshot):
+            if (os.path.commonpath([self.root, snapshot.root]) in
+                    (self.root, snapshot.root)):
+                raise utils.SnapshotError("directories overlap: %s, %s" %
+                                          (self.root, snapshot.root))
+            return transaction.Local2LocalTransaction(self, snapshot)
         else:
             raise utils.SnapshotError("snapshot type not support: %s " %
                                       type(snapshot))
@@ -196,41 +510,195 @@ class LocalSnapshot(Snapshot):
         return os.path.basename(self.root)
 
     def _scan(self):
-        """WARNING: not support cyclic path and link."""
+        with Metrics().phase("scan"):
+            for path, st in self._walk():
+                self.files.append(path, size=st.st_size,
+                                  stat=utils.stat_key(st))
+        Metrics().inc("scanned_files", len(self.files))
+
+    def _walk(self):
+        """Walk the directory tree with os.scandir, yield (relative path,
+        os.stat_result) of files. With one walk_workers, files are yielded
+        sorted by path. More walk_workers read directories by threads, which
+        helps on network file systems, but the order is lost.
+
+        Linked directories are followed, but not the ones linking to their
+        own ancestors.
+        """
+        workers = utils.Config().walk_workers
+        root_st = os.stat(self.root)
+        root = (self.root, "", frozenset([(root_st.st_dev, root_st.st_ino)]))
+
+        if workers <= 1:
+            stack = [("", None, root)]
+            while stack:
+                relative_path, st, sub_dir = stack.pop()
+                if sub_dir is None:
+                    yield relative_path, st
+                else:
+                    stack.extend(reversed(self._scan_dir(*sub_dir)))
+            return
 
-        dir_set = {(self.root, "")}
+        executor = ThreadPoolExecutor(max_workers=workers)
+        pending = {executor.submit(self._scan_dir, *root)}
+        try:
+            while pending:
+                done, pending = wait(pending, return_when=FIRST_COMPLETED)
+                for future in done:
+                    for relative_path, st, sub_dir in future.result():
+                        if sub_dir is None:
+                            yield relative_path, st
+                        else:
+                            pending.add(executor.submit(self._scan_dir,
+                                                        *sub_dir))
+        finally:
+            for future in pending:
+                future.cancel()
+            executor.shutdown(wait=False)
+
+    def _scan_dir(self, path, relative_path, ancestors):
+        """:return: list of (relative path, stat, None) for files, and
+        (relative path, None, arguments of _scan_dir) for sub directories,
+        sorted the way their paths are."""
+        entries = []
+        # the directory is not excluded, only the entries are matched
+        path_filter = PathFilter.get()
+
+        with os.scandir(path) as it:
+            for entry in it:
+                sub_relative_path = os.path.join(relative_path, entry.name)
+
+                try:
+                    # the type is cached by scandir, and each entry is
+                    # stat only once.
+                    is_dir = entry.is_dir()
+                    if path_filter.match(sub_relative_path,
+                                         directory=is_dir) or (
+                            not is_dir and
+                            entry.name.endswith(self.partial_suffix)):
+                        continue
+                    st = entry.stat()
+                except FileNotFoundError:
+                    logger.warning("broken link ignored: %s", entry.path)
+                    continue
+
+                if not is_dir:
+                    entries.append((sub_relative_path, st, None))
+                    continue
+
+                key = (st.st_dev, st.st_ino)
+                if key in ancestors:
+                    logger.warning("cyclic link ignored: %s", entry.path)
+                    continue
+
+                entries.append((sub_relative_path, None,
+                                (entry.path, sub_relative_path,
+                                 ancestors | {key})))
+
+        # "a/b" goes after "a.txt", as the files under directory "a" do.
+        entries.sort(key=lambda e: e[0] if e[2] is None else e[0] + "/")
+        return entries
 
-        while True:
-            if not dir_set:
-                break
+    def _load_detail(self, md5=False, mtime=False):
+        self._load(self.files, md5, mtime, compact=True)
 
-            path, relative_path = dir_set.pop()
+    def load_md5(self, files, cache=None):
+        """get md5 of some files only, such as the files whose size or mtime
+        differ from the remote ones.
 
-            for file in os.listdir(path):
-                sub_path = os.path.join(path, file)
-                sub_relative_path = os.path.join(relative_path, file)
+        :param cache: HashCache kept by the caller, which saves it, instead
+                      of one loaded and saved by every call
+        """
+        self._load(files, True, False, compact=False, cache=cache)
 
-                if not os.path.isdir(sub_path):
-                    self.files.append(FileIdentity(sub_relative_path))
-                elif not self.should_skip(sub_relative_path, directory=True):
-                    dir_set.add((sub_path, sub_relative_path))
+    def iter_load_md5(self):
+        """load_detail(md5=True) by steps, yield files hashed in order of
+        completion, so that they are used before the others are done. Files
+        whose md5 is cached are not yielded."""
+        if self.load_completed:
+            return
+        yield from self._iter_load(self.files, True, False, compact=True)
+        self.load_completed = True
 
-    def _load_detail(self, md5=False, mtime=False):
+    def _load(self, files, md5, mtime, compact, cache=None):
+        for _ in self._iter_load(files, md5, mtime, compact, cache):
+            pass
 
-        for f_id in self.files:
+    def _iter_load(self, files, md5, mtime, compact, cache=None):
+        """:param compact: evict files not in files from the hash cache.
+        :param cache: see load_md5
+        """
+        save = cache is None
+        if save and md5 and utils.Config().hash_cache:
+            cache = utils.HashCache(self.root)
+        completed = False
+        metrics = Metrics()
+
+        try:
+            tasks = self._iter_hash_tasks(files, md5, mtime, cache)
+            with metrics.phase("hash"):
+                for (f_id, key), value in utils.Hasher().imap(tasks):
+                    # assigned in the main thread as soon as each file is
+                    # done, so a transaction dump keeps every finished md5.
+                    f_id.md5 = value.upper()
+                    if cache is not None:
+                        cache.set(f_id.path, key, f_id.md5)
+                    metrics.inc("hashed_files")
+                    metrics.inc("hashed_bytes", key[0])
+                    yield f_id
+            completed = True
+        finally:
+            if save and cache is not None:
+                cache.save(compact=compact and completed)
+
+    def _iter_hash_tasks(self, files, md5, mtime, cache):
+        """load mtime and cached md5, yield files that need to be hashed."""
+
+        for f_id in files:
             path = os.path.join(self.root, f_id.path)
+            need_md5 = md5 and f_id.md5 is None
 
-            if md5 and f_id.md5 is None:
-                f_id.md5 = utils.get_md5(path).upper()
-            if mtime and f_id.mtime is None:
-                f_id.mtime = os.stat(path).st_mtime
+            need_mtime = mtime and f_id.mtime is None
+            key = f_id.stat
+            if key is None and (need_md5 or need_mtime):
+                # file identities from old dumps
+                key = f_id.stat = utils.stat_key(os.stat(path))
 
-            self._frozen_files.add(f_id)
+            if need_mtime:
+                f_id.mtime = key[1] / 1e9
+
+            if need_md5:
+                if cache is not None:
+                    f_id.md5 = cache.get(f_id.path, key)
+                if f_id.md5 is None:
+                    # stat taken before reading, a file modified while
+                    # hashing will not hit the cache next time.
+                    yield (f_id, key), path, key[3]
+                    continue
+            elif cache is not None:
+                cache.touch(f_id.path)
 
 
 class AliOssSnapshot(Snapshot):
+    """Objects under a prefix of a bucket.
+
+    A finished transaction writes a gzipped manifest of the files, one JSON
+    list of [path, md5, size, mtime, etag] per line, into meta_dir under the
+    prefix. The etag is only kept for objects whose etag is not the md5. The
+    manifest is trusted while its generation is the one of the generation
+    object, which is changed before a transaction starts to modify the
+    bucket. Otherwise the bucket is listed.
+    """
 
     meta_md5 = "x-oss-meta-md5"
+    meta_size = "x-oss-meta-size"
+    meta_mtime = "x-oss-meta-mtime"
+    # codec of an object compressed, whose md5 and size in meta are the ones
+    # of the file
+    meta_compress = "x-oss-meta-compress"
+    meta_dir = ".foxy_sync/"
+    # see _list
+    skip_ahead = 1000
 
     def __init__(self, endpoint, bucket, prefix=None):
         self._endpoint = endpoint
@@ -243,34 +711,246 @@ class AliOssSnapshot(Snapshot):
         else:
             root = "%s:%s" % (endpoint, bucket)
 
-        Snapshot.__init__(self, root)
+        # generation of the manifest when scanned, None if there is none
+        self.generation = None
+        self.manifest_fresh = False
+        # etags which are not md5, by path
+        self.etags = {}
+        self._known = None
+        Snapshot.__init__(self, root, prefix=self.prefix)
 
     def push_to(self, snapshot):
-        raise NotImplementedError
+        """
+        :return: transaction
+        """
+        from . import transaction
+        if isinstance(snapshot, LocalSnapshot):
+            return transaction.AliOss2LocalTransaction(self, snapshot)
+        else:
+            raise utils.SnapshotError("snapshot type not support: %s " %
+                                      type(snapshot))
+
+    @property
+    def manifest_key(self):
+        return self.prefix + self.meta_dir + "manifest.gz"
+
+    @property
+    def generation_key(self):
+        return self.prefix + self.meta_dir + "generation"
+
+    def parts_key(self, path):
+        """key of md5 of the parts of an object, see
+        Local2AliOssTransaction._delta_upload"""
+        return self.prefix + self.meta_dir + "parts/" + path + ".json"
 
     def _scan(self):
-        marker = ""
+        """Load files from the manifest if it is fresh, or list keys under
+        prefix. Directories found in the first list_depth levels by delimiter
+        are listed concurrently, and skipped directories are never listed.
 
-        while True:
-            try:
-                objs = [o for o in
-                        oss2.ObjectIterator(self.bucket, marker=marker,
-                                            max_keys=1000, prefix=self.prefix)]
-            except Exception as e:
-                logger.exception(e)
-                raise utils.SnapshotError('scan AliOss bucket failed.')
-
-            if not objs:
-                break
-            else:
-                for o in objs:
-                    path = o.key[len(self.prefix):]
-                    if not self.should_skip(path, key=True):
-                        f = FileIdentity(path, prefix=self.prefix)
-                        if len(o.etag) == 32:
-                            f.md5 = o.etag.upper()
-                        self.files.append(f)
-                marker = objs[-1].key
+        With manifest_reconcile, the bucket is always listed, and objects
+        whose size and etag match the manifest take md5 and mtime from it.
+        """
+        config = utils.Config()
+        if config.manifest and self._read_manifest(config.manifest_reconcile):
+            return
+
+        self._listed = 0
+        self._list_lock = threading.Lock()
+        self._filter = PathFilter.get()
+        start = time.time()
+
+        try:
+            with Metrics().phase("list"):
+                shards = self._iter_shards(self.prefix, config.list_depth)
+                for _ in utils.imap_unordered(self._list, shards,
+                                              config.list_workers):
+                    pass
+        except Exception as e:
+            logger.exception(e)
+            raise utils.SnapshotError('scan AliOss bucket failed.')
+        finally:
+            self._known = None
+            Metrics().inc("listed_keys", self._listed)
+
+        interval = max(time.time() - start, 0.001)
+        logger.info("%s keys listed in %.1fs, %.0f keys/s",
+                    self._listed, interval, self._listed/interval)
+
+    def _read_manifest(self, reconcile):
+        """:return: True if files are loaded from a fresh manifest. With
+        reconcile, entries of the manifest are kept for listing instead."""
+        try:
+            self.generation = self._get_generation()
+            if self.generation is None:
+                return False
+
+            result = utils.retry(self.bucket.get_object, self.manifest_key)
+            f = io.TextIOWrapper(gzip.GzipFile(fileobj=io.BytesIO(
+                result.read())), encoding="utf-8")
+            fresh = json.loads(f.readline())["generation"] == self.generation
+            if not fresh:
+                logger.info("manifest of %s is stale", self.root)
+                if not reconcile:
+                    return False
+
+            entries = (json.loads(line) for line in f)
+            if reconcile:
+                self._known = {e[0]: e[1:] for e in entries}
+                return False
+
+            for path, md5, size, mtime, etag in entries:
+                if not self.should_skip(path, key=True):
+                    self.files.append(path, md5=md5, size=size, mtime=mtime)
+                    if etag is not None:
+                        self.etags[path] = etag
+        except oss2.exceptions.NoSuchKey:
+            return False
+        except Exception as e:
+            logger.warning("manifest of %s ignored: %s", self.root, e)
+            self.files = FileTable(self.prefix)
+            self.etags = {}
+            self._known = None
+            return False
+
+        self.manifest_fresh = True
+        Metrics().inc("manifest_files", len(self.files))
+        logger.info("%s files loaded from manifest of %s", len(self.files),
+                    self.root)
+        return True
+
+    def _get_generation(self):
+        try:
+            result = utils.retry(self.bucket.get_object, self.generation_key)
+        except oss2.exceptions.NoSuchKey:
+            return None
+        return result.read().decode()
+
+    def invalidate_manifest(self):
+        """called before the bucket is modified, so that the manifest is not
+        trusted until it is written again. If another run has changed the
+        generation since the snapshot was scanned, the snapshot is out of
+        date, and the manifest is left stale instead of written by it."""
+        outdated = self._get_generation() != self.generation
+        generation = uuid.uuid4().hex
+        self.manifest_fresh = False
+        utils.retry(self.bucket.put_object, self.generation_key, generation)
+        if outdated:
+            logger.warning("%s modified by another run since scanned, "
+                           "manifest not written", self.root)
+            # never matches, see write_manifest
+            generation = None
+        self.generation = generation
+
+    def write_manifest(self, changes=None):
+        """write files of the snapshot into the manifest, skipped if the
+        generation has been changed by another run since.
+
+        :param changes: {path: (md5, size, mtime, etag), or None if removed}
+        """
+        if self._get_generation() != self.generation:
+            logger.warning("%s modified by another run, manifest not written",
+                           self.root)
+            return
+
+        changes = dict(changes or {})
+        generation = uuid.uuid4().hex
+        number = 0
+        data = io.BytesIO()
+        with gzip.GzipFile(fileobj=data, mode="wb") as f:
+            f.write(json.dumps({"generation": generation}).encode() + b"\n")
+            for f_id in self.files:
+                if f_id.path in changes:
+                    continue
+                f.write(self._manifest_line(
+                    f_id.path, f_id.md5, f_id.size, f_id.mtime,
+                    self.etags.get(f_id.path)))
+                number += 1
+            for path, entry in sorted(changes.items()):
+                if entry is not None:
+                    f.write(self._manifest_line(path, *entry))
+                    number += 1
+
+        # the manifest goes first, it is stale until the generation is set
+        utils.retry(self.bucket.put_object, self.manifest_key,
+                    data.getvalue())
+        utils.retry(self.bucket.put_object, self.generation_key, generation)
+        self.generation = generation
+        self.manifest_fresh = True
+        logger.info("manifest of %s files written to %s", number, self.root)
+
+    @staticmethod
+    def _manifest_line(path, md5, size, mtime, etag):
+        if etag is not None and etag.upper() == md5:
+            etag = None
+        return json.dumps([path, md5, size, mtime, etag]).encode() + b"\n"
+
+    def _iter_shards(self, prefix, depth):
+        """add objects directly under prefix, yield sub-prefixes to be listed
+        as (prefix, (prefix,))"""
+        if depth <= 0:
+            yield prefix, (prefix,)
+            return
+
+        for o in oss2.ObjectIterator(self.bucket, prefix=prefix, delimiter='/',
+                                     max_keys=1000):
+            if not o.is_prefix():
+                self._add_object(o)
+            elif (o.key != self.prefix + self.meta_dir and
+                  not self._filter.match(o.key[len(self.prefix):-1],
+                                         directory=True)):
+                yield from self._iter_shards(o.key, depth-1)
+
+    def _list(self, prefix):
+        """list keys under prefix. Once skip_ahead keys in a row are under
+        a same excluded directory, listing goes on after the directory."""
+        marker = ''
+        while marker is not None:
+            start, marker = marker, None
+            skipped, last = 0, None
+            for o in oss2.ObjectIterator(self.bucket, prefix=prefix,
+                                         marker=start, max_keys=1000):
+                directory = self._filter.excluded_parent(
+                    o.key[len(self.prefix):])
+                if directory is None:
+                    skipped = 0
+                    self._add_object(o)
+                    continue
+
+                skipped = skipped + 1 if directory == last else 1
+                last = directory
+                if skipped >= self.skip_ahead:
+                    # keys are sorted by UTF-8, and none goes after it
+                    marker = self.prefix + directory + "/\U0010ffff"
+                    break
+
+    def _add_object(self, o):
+        path = o.key[len(self.prefix):]
+        # folders made by the console are empty objects of keys ending in /
+        if path.startswith(self.meta_dir) or not path or path.endswith("/"):
+            return
+        md5 = o.etag.upper() if len(o.etag) == 32 else None
+        mtime = None
+        size = o.size
+
+        known = self._known and self._known.get(path)
+        if known:
+            known_md5, known_size, known_mtime, etag = known
+            # the size of a compressed object is not the one of the file
+            if (etag and etag.upper() == o.etag.upper() or
+                    known_size == o.size and
+                    (known_md5 or "").upper() == o.etag.upper()):
+                md5, mtime, size = known_md5, known_mtime, known_size
+
+        with self._list_lock:
+            # listed by several threads, rows of the table must not mix.
+            if not self._filter.excluded(path):
+                self.files.append(path, md5=md5, mtime=mtime, size=size)
+                if md5 is None or md5 != o.etag.upper():
+                    self.etags[path] = o.etag
+            self._listed += 1
+            if self._listed % 100000 == 0:
+                logger.info("%s keys listed", self._listed)
 
     def refresh_session(self):
         """release underlying session in oss2.
@@ -280,17 +960,46 @@ class AliOssSnapshot(Snapshot):
         This method is crude, but simple."""
 
         self.bucket.session.session.close()
-        self.bucket.session = OssSession()
+        self.bucket.session = utils.get_session(self._pool_size())
 
     def _load_detail(self, md5=False, mtime=False):
-        if mtime:
-            raise utils.SnapshotError("AliOssSnapshot not support file mtime.")
-
+        """file mtime is the one of the local file, kept in object meta when
+        uploaded. It needs a HEAD request for every object, unless it is
+        taken from the manifest."""
+
+        tasks = self._iter_head_tasks(md5, mtime)
+        with Metrics().phase("head"):
+            for f_id, (md5_value, mtime_value, size) in \
+                    utils.imap_unordered(self._head, tasks,
+                                         utils.Config().head_workers):
+                # objects without md5 in meta get '', and will not be
+                # fetched again after the snapshot is loaded from a
+                # transaction dump.
+                if md5 and f_id.md5 is None:
+                    f_id.md5 = md5_value
+                if mtime:
+                    f_id.mtime = mtime_value
+                if size is not None:
+                    f_id.size = size
+
+    def _iter_head_tasks(self, md5, mtime):
         for f_id in self.files:
-            if md5 and f_id.md5 is None:
-                meta = self.bucket.head_object(f_id.prefix+f_id.path)
-                f_id.md5 = meta.headers.get(self.meta_md5, "").upper()
-            self._frozen_files.add(f_id)
+            if (md5 and f_id.md5 is None) or (mtime and f_id.mtime is None):
+                yield f_id, (f_id.prefix+f_id.path,)
+
+    def _head(self, key):
+        """:return: (md5, mtime, size) in object meta, size is only of
+                    compressed objects"""
+        meta = utils.retry(self.bucket.head_object, key)
+        Metrics().inc("head_requests")
+        try:
+            mtime = float(meta.headers[self.meta_mtime])
+        except (KeyError, ValueError):
+            mtime = None
+        size = None
+        if meta.headers.get(self.meta_compress):
+            size = int(meta.headers[self.meta_size])
+        return meta.headers.get(self.meta_md5, "").upper(), mtime, size
 
     @property
     def short_name(self):
@@ -304,10 +1013,31 @@ class AliOssSnapshot(Snapshot):
                                       "missing")
 
         auth = oss2.Auth(config.access_key_id, config.access_key_secret)
-        return oss2.Bucket(auth, self._endpoint, self._bucket)
+        return oss2.Bucket(auth, self._endpoint, self._bucket,
+                           session=utils.get_session(self._pool_size()))
+
+    @staticmethod
+    def _pool_size():
+        """enough connections for both HEAD requests and running jobs."""
+        config = utils.Config()
+        return max(config.head_workers, config.job_workers*config.num_threads,
+                   10)
 
     def __getstate__(self):
         state = Snapshot.__getstate__(self)
         state.update({"_endpoint": self._endpoint,
-                      "_bucket": self._bucket})
+                      "_bucket": self._bucket,
+                      "prefix": self.prefix,
+                      "generation": self.generation,
+                      "etags": self.etags})
         return state
+
+    def __setstate__(self, state):
+        # dumps before the manifest
+        self.generation = None
+        self.etags = {}
+        Snapshot.__setstate__(self, state)
+        self.manifest_fresh = False
+        if "prefix" not in state:
+            # dumps before the prefix was kept
+            self.prefix = self.files.prefix
@@ -1,23 +1,67 @@
 
+import io
 import os
 import sys
+import stat
+import errno
+import fcntl
+import shutil
+import math
+import zlib
+import hashlib
 import pickle
 import signal
+import json
+import time
 import base64
+import random
 import logging
+import threading
+import multiprocessing
+from array import array
+from queue import Queue
 from datetime import datetime
+from concurrent.futures import ProcessPoolExecutor
 
 import oss2
 
 from .utils import (Config, SnapshotError, TransactionError, JobError,
-                    FoxyException)
+                    FoxyException, stat_key, retry, RateLimiter, get_md5,
+                    imap_unordered)
 from . import snapshot
+from .metrics import Metrics, Progress
 
 
-__all__ = ["Transaction", "Local2AliOssTransaction"]
+__all__ = ["Transaction", "Local2AliOssTransaction",
+           "AliOss2LocalTransaction", "Local2LocalTransaction"]
 
 logger = logging.getLogger(__name__)
 
+# bandwidth shared by all the uploads
+_limiter = RateLimiter()
+
+# processes compressing files, created on demand
+_compress_pool = None
+_compress_lock = threading.Lock()
+
+
+def _compress_file(src, path, level):
+    """gzip src into path by blocks, run in a process of _compress_pool.
+
+    :return: (md5 of src, size of path)
+    """
+    md5 = hashlib.md5()
+    compressor = zlib.compressobj(level, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+    with open(src, "rb") as f, open(path, "wb") as out:
+        while True:
+            block = f.read(1024*1024)
+            if not block:
+                break
+            md5.update(block)
+            out.write(compressor.compress(block))
+        out.write(compressor.flush())
+        return md5.hexdigest().upper(), out.tell()
+
 
 class _Job:
 
@@ -30,9 +74,13 @@ class _Job:
     # action
     PUSH = "push"
     REMOVE = "remove"
+    # server side copy from src, a key, and then remove it
+    MOVE = "move"
+    # server side copy from src, a key
+    COPY = "copy"
 
     def __init__(self, src, target, action, status=READY,
-                 md5=None, mtime=None, info="", size=0):
+                 md5=None, mtime=None, info="", size=0, etag=None):
         self.src = src
         self.target = target
         self.md5 = md5
@@ -41,13 +89,503 @@ class _Job:
         self.status = status
         self.info = info
         self.size = size
+        # etag of the pushed object
+        self.etag = etag
+
+    @property
+    def transfer_size(self):
+        """bytes sent by the job, nothing for the ones done by the server."""
+        return self.size if self.action == self.PUSH else 0
+
+    def __setstate__(self, state):
+        # dumps before the etag was kept
+        state.setdefault("etag", None)
+        self.__dict__.update(state)
 
     def __eq__(self, other):
         return self.__dict__ == other.__dict__
 
 
+class _Controller:
+    """Adaptive number of job workers, between 1 and the maximum.
+
+    Every interval, the bytes per second sent in the last interval are
+    compared with the ones before. The number goes on growing, or shrinking,
+    by one while throughput grows, and turns back once it drops. It is
+    halved if more than a tenth of the jobs failed, such as being throttled.
+    """
+
+    interval = 10
+
+    def __init__(self, limit, maximum):
+        self.limit = limit
+        self.maximum = maximum
+        self._step = 1
+        self._last = None
+        self._reset(time.time())
+
+    def _reset(self, now):
+        self._time = now
+        self._jobs = 0
+        self._failures = 0
+        self._bytes = 0
+
+    def record(self, job):
+        """called with every job done.
+
+        :return: the number of workers
+        """
+        self._jobs += 1
+        if job.status == _Job.FAILED:
+            self._failures += 1
+        else:
+            self._bytes += job.transfer_size
+
+        now = time.time()
+        if now - self._time >= self.interval:
+            self.adjust(self._bytes / (now - self._time),
+                        self._failures / self._jobs)
+            self._reset(now)
+        return self.limit
+
+    def adjust(self, throughput, failure_rate):
+        if failure_rate > 0.1:
+            self.limit //= 2
+            self._step = 1
+            throughput = None
+        elif self._last is None or throughput > self._last * 1.05:
+            self.limit += self._step
+        elif throughput < self._last * 0.95:
+            self._step = -self._step
+            self.limit += self._step
+        self.limit = min(max(self.limit, 1), self.maximum)
+        self._last = throughput
+
+
+class _Executor:
+    """Run jobs with a pool of worker threads.
+
+    job_workers jobs run at the same time, independent of num_threads which
+    oss2 uses for the parts of one file. With a larger job_workers_max, the
+    number is adjusted to throughput by a _Controller. A job is not started
+    if the size of jobs in flight would exceed max_inflight_bytes, unless
+    nothing else is running. Job status and counters are only changed with
+    the lock held, and not any more after stop() is called.
+
+    With do_batch, remove jobs are done by batches of batch_size in one
+    call, such as a multi-object delete request.
+    """
+
+    log_interval = 60*30
+    batch_size = 1000
+
+    def __init__(self, do, total, workers=None, max_bytes=None,
+                 on_change=None, do_batch=None, max_workers=None):
+        """
+        :param on_change: called with a job when it finished or failed,
+                          with the lock held.
+        :param do_batch: called with a list of jobs, returns a list of info
+                         of the jobs failed, and None for the ones finished.
+        """
+        config = Config()
+        self._do = do
+        self._do_batch = do_batch
+        self._on_change = on_change
+        self.total = total
+        self.workers = workers or config.job_workers
+        self.max_workers = max(max_workers or config.job_workers_max,
+                               self.workers)
+        self.max_bytes = max_bytes or config.max_inflight_bytes
+        self.finished_number = 0
+        self.failed_number = 0
+        self._inflight_bytes = 0
+        self._lock = threading.Lock()
+        self._bytes_released = threading.Condition(self._lock)
+        self._slot_released = threading.Condition(self._lock)
+        self._active = 0
+        self._limit = self.workers
+        if self.max_workers > self.workers:
+            self._controller = _Controller(self.workers, self.max_workers)
+        else:
+            self._controller = None
+        self._stopped = False
+        self._time_stamp = datetime.now()
+        self._size = 0
+
+    @property
+    def inflight_bytes(self):
+        return self._inflight_bytes
+
+    def run(self, jobs):
+        """:param jobs: list of jobs, or an iterable taken as they are
+                        started, such as a generator."""
+        queue = Queue(self.workers)
+        number = self.max_workers
+        if isinstance(jobs, list):
+            number = min(number, len(jobs))
+        threads = [threading.Thread(target=self._work, args=(queue,),
+                                    daemon=True)
+                   for _ in range(number)]
+        for t in threads:
+            t.start()
+
+        for batch in self._batches(jobs):
+            self._reserve(sum(job.transfer_size for job in batch))
+            queue.put(batch)
+
+        for _ in threads:
+            queue.put(None)
+        for t in threads:
+            t.join()
+
+    def _batches(self, jobs):
+        """yield lists of jobs, of a single one unless batched."""
+        batch = []
+        for job in jobs:
+            if self._do_batch is None or job.action != _Job.REMOVE:
+                yield [job]
+                continue
+            batch.append(job)
+            if len(batch) == self.batch_size:
+                yield batch
+                batch = []
+        if batch:
+            yield batch
+
+    def stop(self):
+        """jobs still running are left as they are, and will be canceled."""
+        with self._lock:
+            self._stopped = True
+            self._bytes_released.notify_all()
+            self._slot_released.notify_all()
+
+    def _reserve(self, size):
+        with self._lock:
+            while (not self._stopped and self.max_bytes
+                   and self._inflight_bytes
+                   and self._inflight_bytes + size > self.max_bytes):
+                # wake up regularly, so that KeyboardInterrupt is handled
+                self._bytes_released.wait(1)
+            self._inflight_bytes += size
+            Metrics().set("inflight_bytes", self._inflight_bytes)
+
+    def _work(self, queue):
+        while True:
+            batch = queue.get()
+            if batch is None or self._stopped:
+                return
+
+            with self._lock:
+                while (not self._stopped and
+                       self._active >= self._limit):
+                    self._slot_released.wait(1)
+                self._active += 1
+
+            start = time.time()
+            if self._do_batch is None or batch[0].action != _Job.REMOVE:
+                infos = [self._run(batch[0])]
+                Metrics().observe("job_seconds", time.time() - start)
+            else:
+                try:
+                    infos = self._do_batch(batch)
+                except Exception as e:
+                    logger.exception(e)
+                    infos = [str(e)] * len(batch)
+                failures = sum(info is not None for info in infos)
+                if failures:
+                    Metrics().inc("job_failures", failures,
+                                  error="BatchError")
+                Metrics().observe("batch_seconds", time.time() - start)
+
+            with self._lock:
+                if self._stopped:
+                    return
+                self._active -= 1
+                self._slot_released.notify()
+                for job, info in zip(batch, infos):
+                    if info is None:
+                        self.finished_number += 1
+                        self._size += job.transfer_size
+                        job.status = _Job.FINISHED
+                    else:
+                        self.failed_number += 1
+                        job.status = _Job.FAILED
+                        job.info = info
+                    self._done(job)
+
+    def _run(self, job):
+        """:return: None if done, or info of the failure"""
+        try:
+            self._do(job)
+        except JobError:
+            Metrics().inc("job_failures", error="JobError")
+            return job.info
+        except Exception as e:
+            # unexpected exception
+            logger.exception(e)
+            Metrics().inc("job_failures", error=type(e).__name__)
+            return str(e)
+        return None
+
+    def _done(self, job):
+        metrics = Metrics()
+        metrics.inc("jobs", action=job.action, status=job.status)
+        if job.status == _Job.FINISHED:
+            metrics.inc("uploaded_bytes", job.transfer_size)
+
+        if self._on_change is not None:
+            self._on_change(job)
+
+        if self._controller is not None:
+            limit = self._controller.record(job)
+            if limit != self._limit:
+                logger.info("job workers: %s -> %s", self._limit, limit)
+                self._limit = limit
+                self._slot_released.notify_all()
+
+        self._inflight_bytes -= job.transfer_size
+        metrics.set("inflight_bytes", self._inflight_bytes)
+        self._bytes_released.notify_all()
+
+        tmp_ts = datetime.now()
+        interval = (tmp_ts-self._time_stamp).seconds
+        if interval > self.log_interval:
+            logger.info("average speed: %s KB/s, %s remained",
+                        round(self._size/interval/1024, 2),
+                        self.total - self.finished_number - self.failed_number)
+            self._size = 0
+            self._time_stamp = tmp_ts
+
+
+class _Journal:
+    """Append-only log of job status changes next to the transaction dump, so
+    that a run killed halfway loses nothing. Every line records one change,
+    and the log is compacted into the dump once it grows long, by updating
+    the records of the jobs changed in place.
+    """
+
+    fsync_interval = 1
+
+    def __init__(self, transaction):
+        self.transaction = transaction
+        self.path = self.get_path(transaction.dump_path)
+        self._index = {id(job): i for i, job in enumerate(transaction.jobs)}
+        self._changed = set()
+        self._records = 0
+        self._synced_at = time.time()
+        self._f = open(self.path, "a")
+
+    @staticmethod
+    def get_path(dump_path):
+        return dump_path + ".journal"
+
+    def record(self, job):
+        index = self._index[id(job)]
+        self._f.write(json.dumps([index, job.status, job.info, job.etag]) +
+                      "\n")
+        self._f.flush()
+        self._changed.add(index)
+        self._records += 1
+
+        if time.time() - self._synced_at > self.fsync_interval:
+            os.fsync(self._f.fileno())
+            self._synced_at = time.time()
+
+        if self._records >= Config().journal_compact:
+            self.compact()
+
+    def compact(self):
+        """dump the jobs changed, which removes the log."""
+        self._f.close()
+        self.transaction.dump(sorted(self._changed))
+        self._changed = set()
+        self._records = 0
+        self._f = open(self.path, "a")
+
+    def close(self):
+        self._f.close()
+
+    @classmethod
+    def replay(cls, transaction, path):
+        """apply the log at path to a transaction loaded from its dump."""
+        for index, (status, info, etag) in cls.read(path).items():
+            job = transaction.jobs[index]
+            job.status = status
+            job.info = info
+            job.etag = etag
+
+    @staticmethod
+    def read(path):
+        """:return: {index of job: (status, info, etag)} of the log at path
+        """
+        changes = {}
+        if not os.path.exists(path):
+            return changes
+
+        number = 0
+        with open(path) as f:
+            for line in f:
+                try:
+                    # logs before the etag was kept have none
+                    index, status, info, etag = (json.loads(line) +
+                                                 [None])[:4]
+                except ValueError:
+                    # the last line may be half written
+                    break
+                changes[index] = (status, info, etag)
+                number += 1
+        logger.info("%s job changes replayed from %s", number, path)
+        return changes
+
+
+class _DumpFile:
+    """Transaction dump of records, so that jobs are read one by one, and
+    their status updated in place:
+
+        magic           FOXY_SYNC_TS and the version, a line
+        header          a JSON object padded to header_size, of the name,
+                        the class, the number of jobs, and the offsets of
+                        the sections
+        state           the transaction pickled without jobs, such as the
+                        snapshots, only loaded to run it again
+        records         a line per job: its status, [etag, info] in JSON
+                        padded to slot_size, and the rest of the job in
+                        JSON
+
+    Status and slot have a fixed size, so a job done is written over its
+    record. info too long for the slot is cut, the whole of it is logged
+    when the job failed. Dumps of the pickle of a whole transaction, the
+    format before, start with the pickle protocol instead of the magic.
+    """
+
+    magic = b"FOXY_SYNC_TS 1\n"
+    header_size = 4096
+    status_size = 8
+    slot_size = 128
+
+    @classmethod
+    def is_dump(cls, path):
+        """:return: False for the pickle dumps"""
+        with open(path, "rb") as f:
+            return f.read(len(cls.magic)) == cls.magic
+
+    @classmethod
+    def write(cls, path, transaction):
+        """:return: array of offsets of the records"""
+        state = transaction.__dict__.copy()
+        state["jobs"] = None
+        state.pop("_offsets", None)
+        jobs = transaction.jobs
+        offsets = array("Q")
+
+        with open(path, "wb") as f:
+            f.write(cls.magic)
+            f.write(b" " * cls.header_size)
+            state_offset = f.tell()
+            pickle.dump((type(transaction), state), f,
+                        protocol=pickle.HIGHEST_PROTOCOL)
+            records_offset = offset = f.tell()
+            for job in jobs or ():
+                record = cls._encode(job)
+                f.write(record)
+                offsets.append(offset)
+                offset += len(record)
+
+            header = json.dumps({
+                "name": transaction.name,
+                "class": type(transaction).__name__,
+                "jobs": None if jobs is None else len(jobs),
+                "state": state_offset,
+                "records": records_offset}).encode()
+            if len(header) >= cls.header_size:
+                raise TransactionError("name too long: %s" % transaction.name)
+            f.seek(len(cls.magic))
+            f.write(header.ljust(cls.header_size - 1) + b"\n")
+            f.flush()
+            os.fsync(f.fileno())
+        return offsets
+
+    @classmethod
+    def update(cls, path, jobs, offsets):
+        """write status and slot of jobs over their records.
+
+        :param jobs: iterable of (index, job)
+        """
+        size = cls.status_size + 1 + cls.slot_size
+        with open(path, "r+b") as f:
+            for index, job in jobs:
+                f.seek(offsets[index])
+                f.write(cls._encode(job)[:size])
+            f.flush()
+            os.fsync(f.fileno())
+
+    @classmethod
+    def read_header(cls, path):
+        with open(path, "rb") as f:
+            if f.read(len(cls.magic)) != cls.magic:
+                raise TransactionError("not a transaction dump: %s" % path)
+            return json.loads(f.read(cls.header_size).decode())
+
+    @classmethod
+    def load(cls, path):
+        """:return: the transaction, with offsets of its records"""
+        header = cls.read_header(path)
+        with open(path, "rb") as f:
+            f.seek(header["state"])
+            klass, state = pickle.load(f)
+        transaction = klass.__new__(klass)
+        transaction.__dict__.update(state)
+
+        if header["jobs"] is not None:
+            transaction.jobs = []
+            transaction._offsets = array("Q")
+            for offset, job in cls.iter_records(path, header):
+                transaction.jobs.append(job)
+                transaction._offsets.append(offset)
+        return transaction
+
+    @classmethod
+    def iter_records(cls, path, header=None):
+        """:return: generator of (offset, job) of the records"""
+        header = header or cls.read_header(path)
+        with open(path, "rb") as f:
+            f.seek(header["records"])
+            offset = header["records"]
+            for line in f:
+                yield offset, cls._decode(line)
+                offset += len(line)
+
+    @classmethod
+    def _encode(cls, job):
+        info = job.info or ""
+        slot = json.dumps([job.etag, info])
+        while len(slot) > cls.slot_size and info:
+            cut = max(len(info) - (len(slot) - cls.slot_size) - 3, 0)
+            info = info[:cut] + "..." if cut else ""
+            slot = json.dumps([job.etag, info])
+        return ("%-*s %-*s %s\n" % (
+            cls.status_size, job.status, cls.slot_size, slot,
+            json.dumps([job.action, job.src, job.target, job.md5,
+                        job.mtime, job.size]))).encode()
+
+    @classmethod
+    def _decode(cls, line):
+        line = line.decode()
+        slot_end = cls.status_size + 1 + cls.slot_size
+        etag, info = json.loads(line[cls.status_size+1:slot_end])
+        action, src, target, md5, mtime, size = json.loads(line[slot_end:])
+        status = line[:cls.status_size].rstrip()
+        return _Job(src, target, action, status=status, md5=md5,
+                    mtime=mtime, info=info, size=size, etag=etag)
+
+
 class Transaction:
 
+    # write the JSON summary of metrics after run, with the prom file
+    summary = True
+    # offsets of the records of jobs in the dump, see _DumpFile
+    _offsets = None
+
     def __init__(self, src_snapshot, target_snapshot):
         self.src_snapshot = src_snapshot
         self.target_snapshot = target_snapshot
@@ -57,12 +595,21 @@ class Transaction:
         self.jobs = None
 
     def start(self):
+        try:
+            self.run()
+        except KeyboardInterrupt:
+            pass
+        sys.exit(0)
+
+    def run(self):
+        """run the jobs not finished yet. KeyboardInterrupt is raised again
+        after the transaction is dumped.
+
+        :return: number of (finished, failed, canceled) jobs
+        """
 
         self.get_jobs()
 
-        finished_number = 0
-        failed_number = 0
-        canceled_number = 0
         ready_list = []
 
         for job in self.jobs:
@@ -76,58 +623,98 @@ class Transaction:
 
         if not ready_list:
             logger.info("no job found.")
-            sys.exit(0)
+            self._commit()
+            self.write_metrics()
+            return 0, 0, 0
 
         logging.info("%s jobs, start...", len(ready_list))
-        time_stamp = datetime.now()
-        size = 0
+        self._begin()
+        # the journal needs a dump as its base
+        self.dump()
+        journal = _Journal(self)
+        executor = _Executor(self._do, len(ready_list),
+                             on_change=journal.record,
+                             do_batch=self._do_batch)
+        interrupted = False
+        progress = Progress(executor) if Config().progress else None
 
-        try:
-            for i, job in enumerate(ready_list):
-                try:
-                    self._do(job)
-                except Exception as e:
-                    failed_number += 1
-                    job.status = _Job.FAILED
-                    if not isinstance(e, JobError):
-                        # unexpected exception
-                        job.info = str(e)
-                        logger.exception(e)
-                else:
-                    finished_number += 1
-                    size += job.size
-                    job.status = _Job.FINISHED
-
-                tmp_ts = datetime.now()
-                interval = (tmp_ts-time_stamp).seconds
-                if interval > 60*30:
-                    logger.info("average speed: %s KB/s, %s remained",
-                                round(size/interval/1024, 2),
-                                len(ready_list) - i - 1)
-                    size = 0
-                    time_stamp = tmp_ts
+        # copies wait for the objects they are copied from
+        sources = {job.target: job for job in ready_list
+                   if job.action != _Job.COPY}
+        waves = ([], [])
+        for job in ready_list:
+            waves[job.action == _Job.COPY and job.src in sources].append(job)
 
+        try:
+            with Metrics().phase("execute"):
+                if progress is not None:
+                    progress.start()
+                if waves[0]:
+                    executor.run(waves[0])
+                # the object not pushed may still be of the old content
+                copies = []
+                for job in waves[1]:
+                    if sources[job.src].status == _Job.FINISHED:
+                        copies.append(job)
+                    else:
+                        job.info = "source not pushed"
+                if copies:
+                    executor.run(copies)
         except Exception as e:
             logger.exception(e)
         except KeyboardInterrupt:
-            pass
+            interrupted = True
         finally:
             # suppress KeyboardInterrupt for transaction dump
-            signal.signal(signal.SIGINT, lambda signum, frame: None)
+            handler = signal.signal(signal.SIGINT,
+                                    lambda signum, frame: None)
+            executor.stop()
+            journal.close()
+            if progress is not None:
+                progress.stop()
 
+        canceled_number = 0
         for job in ready_list:
             if job.status not in (_Job.FINISHED, _Job.FAILED):
                 job.status = _Job.CANCELED
                 canceled_number += 1
 
+        if executor.finished_number == len(ready_list):
+            self._commit()
         self.dump()
+        self.write_metrics()
+        signal.signal(signal.SIGINT, handler)
         logging.info("total: %s finished, %s failed, %s canceled",
-                     finished_number, failed_number, canceled_number)
-        sys.exit(0)
+                     executor.finished_number, executor.failed_number,
+                     canceled_number)
+
+        if interrupted:
+            raise KeyboardInterrupt
+        return (executor.finished_number, executor.failed_number,
+                canceled_number)
+
+    def write_metrics(self):
+        """write metrics of the run into cache_dir, see metrics.Metrics."""
+        Metrics().write(self.name if self.summary else None)
+
+    def dump(self, changed=None):
+        """write the dump atomically, the journal is then out of date.
 
-    def dump(self):
-        with open(self.dump_path, "wb") as f:
-            pickle.dump(self, f)
+        :param changed: indexes of the only jobs changed since the last
+                        dump, whose records are updated in place
+        """
+        if changed is not None and self._offsets is not None:
+            _DumpFile.update(self.dump_path,
+                             ((i, self.jobs[i]) for i in changed),
+                             self._offsets)
+        else:
+            tmp_path = self.dump_path + ".tmp"
+            self._offsets = _DumpFile.write(tmp_path, self)
+            os.replace(tmp_path, self.dump_path)
+
+        journal_path = _Journal.get_path(self.dump_path)
+        if os.path.exists(journal_path):
+            os.remove(journal_path)
         logger.info("dump to %s", self.dump_path)
 
     @property
@@ -136,19 +723,54 @@ class Transaction:
 
     @staticmethod
     def load(path):
-        with open(path, "rb") as f:
-            return pickle.load(f)
+        """load a dump, of records or of the pickle before, see _DumpFile."""
+        if _DumpFile.is_dump(path):
+            transaction = _DumpFile.load(path)
+        else:
+            with open(path, "rb") as f:
+                transaction = pickle.load(f)
+        if transaction.jobs is not None:
+            _Journal.replay(transaction, _Journal.get_path(path))
+        return transaction
+
+    @staticmethod
+    def iter_jobs(path):
+        """:return: generator of jobs of a dump with the changes in its
+                    journal, read one by one without loading the snapshots.
+                    Pickle dumps, and dumps before jobs are planned, are
+                    loaded as a whole.
+        """
+        header = None
+        if _DumpFile.is_dump(path):
+            header = _DumpFile.read_header(path)
+        if header is None or header["jobs"] is None:
+            transaction = Transaction.load(path)
+            transaction.get_jobs()
+            yield from transaction.jobs
+            return
+
+        changes = _Journal.read(_Journal.get_path(path))
+        for index, (_, job) in enumerate(_DumpFile.iter_records(path,
+                                                                header)):
+            if index in changes:
+                job.status, job.info, job.etag = changes[index]
+            yield job
 
-    def get_jobs(self):
+    def get_jobs(self, pipeline=False):
         """diff snapshots and generate jobs. This method will let snapshot load
         file details. Do dump if any exception raised. This will let snapshot be
-        able to load file detail from the break point."""
+        able to load file detail from the break point.
+
+        :param pipeline: run jobs while they are planned, if the transaction
+                         supports it, only for one started right after
+        """
 
         if self.jobs is not None:
             return
 
         try:
-            self.jobs = self._get_jobs()
+            with Metrics().phase("plan"):
+                self.jobs = self._get_jobs(pipeline)
         except Exception as e:
             logger.exception(e)
             self.dump()
@@ -157,13 +779,70 @@ class Transaction:
             self.dump()
             raise TransactionError('canceled: %s' % self.dump_path)
 
-    def _get_jobs(self):
+    def _get_jobs(self, pipeline=False):
         """WARNING: job.info should be initialized as str."""
         raise NotImplementedError
 
     def _do(self, job):
         raise NotImplementedError
 
+    # do remove jobs together if defined, see _Executor
+    _do_batch = None
+
+    def _begin(self):
+        """called before jobs start."""
+        pass
+
+    def _commit(self):
+        """called when all jobs are finished."""
+        pass
+
+    def __str__(self):
+        f = io.StringIO()
+        self.write(f)
+        return f.getvalue().rstrip("\n")
+
+    def write(self, f, status=None):
+        """write the plan into file object f, line by line."""
+        self.write_jobs(f, self.jobs, status)
+
+    @staticmethod
+    def write_jobs(f, jobs, status=None):
+        """write jobs, an iterable, into file object f, and a summary of all
+        of them.
+
+        :param status: only jobs of the status are written
+        """
+        info = {_Job.FINISHED: 0,
+                _Job.FAILED: 0,
+                _Job.READY: 0,
+                _Job.CANCELED: 0}
+        saved = 0
+
+        for job in jobs:
+            # not for the objects copied onto themselves, see _meta_jobs
+            if (job.action in (_Job.MOVE, _Job.COPY) and
+                    job.src != job.target):
+                saved += job.size
+            if job.action in (_Job.PUSH, _Job.MOVE, _Job.COPY):
+                operator = '%s -> %s' % (job.src, job.target)
+            elif job.action == _Job.REMOVE:
+                operator = job.target
+            else:
+                raise TransactionError("unknown action")
+
+            info[job.status] += 1
+            if status is None or job.status == status:
+                f.write("%-6s %-8s %s %s\n" % (job.action, job.status,
+                                               operator, job.info))
+
+        summary = "".join("%s: %s  " % (key, info[key])
+                          for key in sorted(info.keys()))
+        if saved:
+            # moved or copied in the bucket instead of uploaded
+            summary += "saved: %s bytes  " % saved
+        f.write(summary + "\n")
+
     def __len__(self):
         return len(self.jobs)
 
@@ -175,72 +854,902 @@ class Transaction:
 
 
 class Local2AliOssTransaction(Transaction):
+    """Push a local directory to AliOss.
 
-    def _get_jobs(self):
-        for s in (self.src_snapshot, self.target_snapshot):
-            s.load_detail(md5=True)
+    With compress, files are compressed by gzip in a process pool before
+    uploaded, see _compress. md5 and size of the file are kept in object
+    meta, with meta_compress of the codec, so the object is compared as
+    the file.
 
-        new_list, removed_list = self.src_snapshot.diff(self.target_snapshot)
-        new_path = {f.path for f in new_list}
-        src_root = self.src_snapshot.root
+    Planned with pipeline, files whose content is in neither the bucket nor
+    the files hashed before are pushed as soon as they are hashed, and
+    others are still being read, instead of after the whole diff.
+    Their pages are still cached when uploaded, so they are read from the
+    disk once. Moves, copies and removes are planned after the diff.
+
+    With delta_upload, large files are uploaded by parts of which md5 are
+    kept, and parts not changed are copied inside the bucket the next
+    time, see _delta_upload.
+    """
+
+    # files smaller are not compressed, and bytes read to sample a file
+    compress_min_size = 4096
+    compress_sample = 64*1024
+    # parts of a multipart upload at most
+    max_parts = 10000
+    # keys of one batch delete request
+    batch_keys = 1000
+
+    def _get_jobs(self, pipeline=False):
+        config = Config()
+        pushed = {}
+        touched = []
+        if config.compare == "fast":
+            diff, touched = self._fast_diff()
+        else:
+            if pipeline:
+                pushed = self._pipeline()
+            for s in (self.src_snapshot, self.target_snapshot):
+                s.load_detail(md5=True)
+            diff = self.src_snapshot.iter_diff(self.target_snapshot,
+                                               same=snapshot.same_md5)
+        with Metrics().phase("diff"):
+            return self._jobs_of(diff, pushed) + self._meta_jobs(touched)
+
+    def _pipeline(self):
+        """hash local files, and push the new contents meanwhile.
+
+        :return: {target: job} of the pushes finished
+        """
+        target = self.target_snapshot
+        target.load_detail(md5=True)
+        contents = {(f_id.md5, f_id.size) for f_id in target.files}
+        executor = _Executor(self._do, len(self.src_snapshot.files))
+        jobs = []
+
+        def iter_jobs():
+            for f_id in self.src_snapshot.iter_load_md5():
+                if (f_id.md5, f_id.size) in contents:
+                    continue
+                contents.add((f_id.md5, f_id.size))
+                if not jobs:
+                    # the bucket is about to be modified
+                    self._begin()
+                job = self._push_job(f_id)
+                jobs.append(job)
+                yield job
+
+        try:
+            with Metrics().phase("pipeline"):
+                executor.run(iter_jobs())
+        finally:
+            executor.stop()
+            logger.info("%s files pushed while hashing, %s failed",
+                        executor.finished_number, executor.failed_number)
+        return {job.target: job for job in jobs
+                if job.status == _Job.FINISHED}
+
+    def _push_job(self, file_id):
+        src = os.path.join(self.src_snapshot.root, file_id.path)
+        stat = file_id.stat
+        if stat is None:
+            stat = stat_key(os.stat(src))
+        return _Job(src=src, target=self.target_snapshot.prefix+file_id.path,
+                    md5=file_id.md5, mtime=stat[1] / 1e9, action=_Job.PUSH,
+                    size=stat[0])
+
+    def _jobs_of(self, diff, pushed=None):
+        """:param diff: iterable of (kind, file_id, removed_id), see
+                        snapshot.merge_diff
+        :param pushed: {target: job} of files pushed already, see _pipeline
+        """
+        pushed = pushed or {}
         target_prefix = self.target_snapshot.prefix
+        added = []
+        removed = {}
+        touched = set()
+        move_jobs = []
         jobs = []
+        remove_jobs = []
 
-        for file_id in new_list:
-            src = os.path.join(src_root, file_id.path)
-            size = os.stat(src).st_size
-            jobs.append(_Job(src=src, target=target_prefix+file_id.path,
-                             md5=file_id.md5, action=_Job.PUSH, size=size))
+        for kind, file_id, removed_id in diff:
+            touched.add((file_id or removed_id).path)
+            if kind != snapshot.REMOVED:
+                added.append((kind, file_id))
+            elif removed_id.md5 and removed_id.size is not None:
+                # objects removed may be moved to the files added
+                removed.setdefault((removed_id.md5, removed_id.size),
+                                   []).append(removed_id.path)
+            else:
+                remove_jobs.append(target_prefix+removed_id.path)
 
-        for file_id in removed_list:
-            if file_id.path not in new_path:
-                jobs.append(_Job(src=None, target=target_prefix+file_id.path,
-                                 md5=None, action=_Job.REMOVE))
+        for kind, file_id in added:
+            job = pushed.get(target_prefix+file_id.path)
+            if job is not None and job.md5 == file_id.md5:
+                jobs.append(job)
+                continue
+            job = self._push_job(file_id)
+
+            # the object of a changed file is replaced, not moved
+            paths = removed.get((job.md5, job.size))
+            if kind == snapshot.ADDED and paths:
+                job.src = target_prefix + paths.pop()
+                job.action = _Job.MOVE
+                move_jobs.append(job)
+            else:
+                jobs.append(job)
+
+        for paths in removed.values():
+            remove_jobs.extend(target_prefix+path for path in paths)
+        remove_jobs = [_Job(src=None, target=target, md5=None,
+                            action=_Job.REMOVE)
+                       for target in sorted(remove_jobs)]
+        if move_jobs:
+            logger.info("%s files moved, %s bytes not uploaded",
+                        len(move_jobs), sum(j.size for j in move_jobs))
+
+        jobs = self._dedup(jobs, move_jobs, touched)
+        return move_jobs + jobs + remove_jobs
+
+    def _dedup(self, jobs, move_jobs, touched):
+        """Files of a same content are uploaded once. The others are copied
+        in the bucket from the object uploaded, or from an object of the
+        content already there and not touched by the transaction.
+
+        :param touched: paths of the target pushed or removed
+        :return: jobs, some of which are turned into copies
+        """
+        groups = {}
+        for job in jobs:
+            if job.size:
+                groups.setdefault((job.md5, job.size), []).append(job)
+        if not groups:
+            return jobs
+
+        prefix = self.target_snapshot.prefix
+        sources = {(job.md5, job.size): job.target for job in move_jobs}
+        for f_id in self.target_snapshot.files:
+            key = (f_id.md5, f_id.size)
+            if (key in groups and key not in sources and
+                    f_id.path not in touched):
+                sources[key] = prefix + f_id.path
+
+        copied = 0
+        for key, group in groups.items():
+            source = sources.get(key)
+            if source is None:
+                # the one pushed already, if any
+                group.sort(key=lambda job: job.status != _Job.FINISHED)
+                source = group[0].target
+                group = group[1:]
+            for job in group:
+                job.src = source
+                job.action = _Job.COPY
+                copied += job.size
+
+        if copied:
+            logger.info("%s bytes not uploaded for copies", copied)
+        return jobs
+
+    def _fast_diff(self):
+        """Compare files by size and mtime kept in object meta. md5 is only
+        calculated for local files that are new or differ by them, and for a
+        sample of fast_compare_audit of the others, to be safe.
+
+        :return: (list of diff, see snapshot.merge_diff, list of files only
+                 touched, whose content is the same)
+        """
+        config = Config()
+        self.src_snapshot.load_detail(mtime=True)
+        self.target_snapshot.load_detail(md5=True, mtime=True)
+
+        diff = []
+        audit = []
+        for kind, mine, theirs in self.src_snapshot.iter_diff(
+                self.target_snapshot, same=snapshot.same_metadata,
+                unchanged=True):
+            if kind != snapshot.UNCHANGED:
+                diff.append((kind, mine, theirs))
+            elif random.random() < config.fast_compare_audit:
+                audit.append((mine, theirs))
+
+        self.src_snapshot.load_md5(
+            [mine for _, mine, _ in diff if mine is not None] +
+            [mine for mine, _ in audit])
+
+        result = []
+        touched = []
+        for kind, mine, theirs in diff:
+            if kind != snapshot.CHANGED or mine.md5 != theirs.md5:
+                result.append((kind, mine, theirs))
+            else:
+                touched.append(mine)
+        for mine, theirs in audit:
+            if mine.md5 != theirs.md5:
+                logger.warning("%s changed, but size and mtime not",
+                               mine.path)
+                result.append((snapshot.CHANGED, mine, theirs))
+
+        logger.info("%s files compared by md5, %s of them audited",
+                    len(diff) + len(audit), len(audit))
+        return result, touched
+
+    def _meta_jobs(self, files):
+        """Objects of files only touched are copied onto themselves with the
+        new mtime in meta, or they would be compared by md5 every time.
 
+        :return: copy jobs
+        """
+        jobs = []
+        for f_id in files:
+            job = self._push_job(f_id)
+            job.src = job.target
+            job.action = _Job.COPY
+            jobs.append(job)
         return jobs
 
     def _do(self, job):
         config = Config()
         if job.action == _Job.PUSH:
-            encode_md5 = base64.b64encode(bytearray.fromhex(job.md5)
-                                          ).decode()
-            headers = {"Content-MD5": encode_md5,
-                       snapshot.AliOssSnapshot.meta_md5: job.md5}
-            try:
-                oss2.resumable_upload(
-                        self.target_snapshot.bucket, job.target, job.src,
-                        headers=headers,
-                        store=oss2.ResumableStore(root=config.cache_dir),
-                        multipart_threshold=config.multipart_threshold,
-                        part_size=config.multipart_threshold,
-                        num_threads=config.num_threads)
-
-            except oss2.exceptions.InvalidDigest:
-                job.info = "md5 mismatch"
-                raise JobError
+            compressed = self._compress(job)
+            if (compressed is None and config.delta_upload and
+                    job.size >= config.multipart_threshold):
+                self._delta_upload(job)
+            else:
+                self._upload(job, compressed)
+
+        elif job.action == _Job.MOVE:
+            self._copy(job)
+            retry(self.target_snapshot.bucket.batch_delete_objects,
+                  self._delete_keys(job.src))
+
+        elif job.action == _Job.COPY:
+            self._copy(job)
 
         elif job.action == _Job.REMOVE:
-            self.target_snapshot.bucket.delete_object(job.target)
+            retry(self.target_snapshot.bucket.batch_delete_objects,
+                  self._delete_keys(job.target))
 
-    def __str__(self):
-        data = ''
-        info = {_Job.FINISHED: 0,
-                _Job.FAILED: 0,
-                _Job.READY: 0,
-                _Job.CANCELED: 0}
+    def _upload(self, job, compressed=None):
+        """:param compressed: path of the file compressed, which is removed
+                              after uploaded"""
+        config = Config()
+        headers = self._meta_headers(job)
+        if compressed is None:
+            src = job.src
+            threshold = config.multipart_threshold
+            headers["Content-MD5"] = base64.b64encode(
+                bytearray.fromhex(job.md5)).decode()
+        else:
+            # by parts, so the etag is never taken as md5 of the file
+            src = compressed
+            threshold = 0
+            headers[snapshot.AliOssSnapshot.meta_compress] = "gzip"
+
+        try:
+            result = oss2.resumable_upload(
+                    self.target_snapshot.bucket, job.target, src,
+                    headers=headers,
+                    store=oss2.ResumableStore(root=config.cache_dir),
+                    multipart_threshold=threshold,
+                    part_size=config.multipart_threshold,
+                    num_threads=config.num_threads,
+                    progress_callback=self._throttle())
+
+        except oss2.exceptions.InvalidDigest:
+            job.info = "md5 mismatch"
+            raise JobError
+        finally:
+            if compressed is not None:
+                os.remove(compressed)
+        job.etag = result.etag
+
+    def _delta_upload(self, job):
+        """Upload a large file by parts, and only the parts changed since
+        the object was pushed so. md5 of the parts are kept in a sidecar
+        object in meta_dir, see AliOssSnapshot.parts_key, and taken while
+        the etag of the object is the one in it. Parts of a same md5 are
+        copied from the object in the bucket."""
+        config = Config()
+        bucket = self.target_snapshot.bucket
+        old = self._read_parts(job.target)
+        if (old is not None and
+                math.ceil(job.size / old["part_size"]) <= self.max_parts):
+            part_size = old["part_size"]
+            old_md5s = old["md5s"]
+        else:
+            part_size = oss2.determine_part_size(
+                job.size, preferred_size=config.multipart_threshold)
+            old_md5s = []
+        md5s = self._part_md5s(job, part_size)
+
+        upload_id = bucket.init_multipart_upload(
+            job.target, headers=self._meta_headers(job)).upload_id
+        try:
+            tasks = ((number, (job, upload_id, number, part_size, md5,
+                               md5 in old_md5s[number-1:number]))
+                     for number, md5 in enumerate(md5s, 1))
+            parts = [oss2.models.PartInfo(number, etag) for number, etag in
+                     sorted(imap_unordered(self._upload_part, tasks,
+                                           config.num_threads))]
+            result = bucket.complete_multipart_upload(job.target, upload_id,
+                                                      parts)
+        except Exception:
+            bucket.abort_multipart_upload(job.target, upload_id)
+            raise
+        job.etag = result.etag
+
+        retry(bucket.put_object, self._parts_key(job.target), json.dumps(
+            {"etag": result.etag, "part_size": part_size, "md5s": md5s}))
+
+    def _upload_part(self, job, upload_id, number, part_size, md5, reuse):
+        """upload a part of the file, or copy it from the object if reuse.
+
+        :return: etag of the part
+        """
+        bucket = self.target_snapshot.bucket
+        offset = (number-1) * part_size
+        length = min(part_size, job.size - offset)
+        if reuse:
+            result = retry(bucket.upload_part_copy, bucket.bucket_name,
+                           job.target, (offset, offset+length-1), job.target,
+                           upload_id, number)
+            Metrics().inc("delta_bytes_saved", length)
+        else:
+            with open(job.src, "rb") as f:
+                f.seek(offset)
+                data = f.read(length)
+            _limiter.consume(len(data))
+            result = retry(bucket.upload_part, job.target, upload_id, number,
+                           data)
+
+        # the etag of a part is its md5
+        if result.etag.strip('"').upper() != md5:
+            job.info = "md5 mismatch"
+            raise JobError
+        return result.etag
+
+    @staticmethod
+    def _part_md5s(job, part_size):
+        """:return: md5 of every part of the file, which is checked to be
+                    the one of the job as a whole"""
+        md5 = hashlib.md5()
+        md5s = []
+        with open(job.src, "rb") as f:
+            while True:
+                part = hashlib.md5()
+                remain = part_size
+                while remain:
+                    block = f.read(min(remain, 1024*1024))
+                    if not block:
+                        break
+                    part.update(block)
+                    md5.update(block)
+                    remain -= len(block)
+                if remain == part_size:
+                    break
+                md5s.append(part.hexdigest().upper())
+
+        if md5.hexdigest().upper() != job.md5:
+            job.info = "md5 mismatch"
+            raise JobError
+        return md5s
+
+    def _parts_key(self, target):
+        return self.target_snapshot.parts_key(
+            target[len(self.target_snapshot.prefix):])
+
+    def _read_parts(self, target):
+        """:return: the sidecar of parts of an object, or None if there is
+                    none or it is not of the object any more"""
+        bucket = self.target_snapshot.bucket
+        try:
+            parts = json.loads(retry(bucket.get_object,
+                                     self._parts_key(target)).read().decode())
+            etag = retry(bucket.head_object, target).etag
+        except (oss2.exceptions.NotFound, ValueError):
+            return None
+        if parts.get("etag", "").strip('"').upper() != etag.strip('"').upper():
+            return None
+        return parts
+
+    def _delete_keys(self, key):
+        """:return: keys to delete with an object, its sidecar of parts is
+                    only there with delta_upload"""
+        if Config().delta_upload:
+            return [key, self._parts_key(key)]
+        return [key]
+
+    def _do_batch(self, jobs):
+        """delete objects of remove jobs, with their sidecars of parts, by
+        requests of at most batch_keys keys."""
+        bucket = self.target_snapshot.bucket
+        keys = []
+        for job in jobs:
+            keys.extend(self._delete_keys(job.target))
+        deleted = set()
+        for i in range(0, len(keys), self.batch_keys):
+            result = retry(bucket.batch_delete_objects,
+                           keys[i:i + self.batch_keys])
+            deleted.update(result.deleted_keys)
+        return [None if job.target in deleted else "not deleted"
+                for job in jobs]
+
+    def _compress(self, job):
+        """gzip the file of a push job into cache_dir, if it has one of
+        compress_extensions, or a sample of it is compressed to
+        compress_ratio.
+
+        :return: path of the compressed file, or None if not compressed
+        """
+        config = Config()
+        if not config.compress or job.size < self.compress_min_size:
+            return None
+        extension = os.path.splitext(job.src)[1].lower()
+        if extension not in config.compress_extensions:
+            if not config.compress_ratio:
+                return None
+            with open(job.src, "rb") as f:
+                sample = f.read(self.compress_sample)
+            if (len(zlib.compress(sample, 1)) >
+                    len(sample) * config.compress_ratio):
+                return None
+
+        path = os.path.join(config.cache_dir, "compress_%s.gz" %
+                            hashlib.md5(job.target.encode()).hexdigest())
+        md5, size = self._compress_pool().submit(
+            _compress_file, job.src, path, config.compress_level).result()
+        if md5 != job.md5:
+            os.remove(path)
+            job.info = "md5 mismatch"
+            raise JobError
+        if size >= job.size * 0.9:
+            os.remove(path)
+            return None
+
+        Metrics().inc("compressed_bytes_saved", job.size - size)
+        return path
+
+    @staticmethod
+    def _compress_pool():
+        """processes are started by a fork server, not forked from this
+        process, whose threads may hold locks such as the one of logging"""
+        global _compress_pool
+        with _compress_lock:
+            if _compress_pool is None:
+                _compress_pool = ProcessPoolExecutor(
+                    max_workers=Config().compress_workers,
+                    mp_context=multiprocessing.get_context("forkserver"))
+            return _compress_pool
+
+    @staticmethod
+    def _throttle():
+        """:return: progress callback of an upload, which takes the bytes
+        sent from the bandwidth limit. oss2 calls it as the data of a small
+        file is read, and after each part of a large one."""
+        sent = [None]
+
+        def progress_callback(consumed_bytes, total_bytes):
+            if sent[0] is not None:
+                _limiter.consume(consumed_bytes - sent[0])
+            # parts uploaded by a former run are not counted
+            sent[0] = consumed_bytes
+
+        return progress_callback
+
+    @staticmethod
+    def _meta_headers(job):
+        headers = {snapshot.AliOssSnapshot.meta_md5: job.md5,
+                   snapshot.AliOssSnapshot.meta_size: str(job.size)}
+        if job.mtime is not None:
+            # repr of float keeps all digits
+            headers[snapshot.AliOssSnapshot.meta_mtime] = repr(job.mtime)
+        return headers
+
+    def _copy(self, job):
+        """copy object job.src to job.target in the bucket, by parts if it is
+        not smaller than multipart_threshold, or compressed. The object
+        copied is checked to be of the md5 of the job first."""
+        config = Config()
+        bucket = self.target_snapshot.bucket
+        headers = self._meta_headers(job)
+        # the object may be compressed, and of a size not the file's
+        meta = retry(bucket.head_object, job.src)
+        md5 = meta.headers.get(snapshot.AliOssSnapshot.meta_md5)
+        if md5 is None and len(meta.etag.strip('"')) == 32:
+            md5 = meta.etag.strip('"')
+        if (md5 or "").upper() != job.md5:
+            # changed since planned, it would be copied as of the file
+            job.info = "source changed"
+            raise JobError
+        size = meta.content_length
+        codec = meta.headers.get(snapshot.AliOssSnapshot.meta_compress)
+        if codec:
+            headers[snapshot.AliOssSnapshot.meta_compress] = codec
+
+        if size < config.multipart_threshold and not codec:
+            headers["x-oss-metadata-directive"] = "REPLACE"
+            result = retry(bucket.copy_object, bucket.bucket_name, job.src,
+                           job.target, headers=headers)
+            job.etag = result.etag
+            return
+
+        part_size = oss2.determine_part_size(
+            size, preferred_size=config.multipart_threshold)
+        upload_id = bucket.init_multipart_upload(job.target,
+                                                 headers=headers).upload_id
+        parts = []
+        try:
+            for number, offset in enumerate(range(0, size, part_size), 1):
+                result = retry(
+                    bucket.upload_part_copy, bucket.bucket_name, job.src,
+                    (offset, min(offset+part_size, size) - 1),
+                    job.target, upload_id, number)
+                parts.append(oss2.models.PartInfo(number, result.etag))
+            result = bucket.complete_multipart_upload(job.target, upload_id,
+                                                      parts)
+        except Exception:
+            bucket.abort_multipart_upload(job.target, upload_id)
+            raise
+        job.etag = result.etag
+
+    def _begin(self):
+        if Config().manifest:
+            self.target_snapshot.invalidate_manifest()
+
+    def _commit(self):
+        """write the manifest of the bucket after the jobs."""
+        target = self.target_snapshot
+        if not Config().manifest or target.manifest_fresh:
+            return
+
+        try:
+            target.write_manifest(self.changes())
+        except Exception as e:
+            logger.warning("write manifest failed: %s", e)
 
+    def changes(self):
+        """:return: {path: (md5, size, mtime, etag), or None if removed} of
+                    finished jobs, paths are relative to the target prefix.
+        """
+        prefix_length = len(self.target_snapshot.prefix)
+        changes = {}
         for job in self.jobs:
-            if job.action == _Job.PUSH:
-                operator = '%s -> %s' % (job.src, job.target)
-            elif job.action == _Job.REMOVE:
-                operator = job.target
+            if job.status != _Job.FINISHED:
+                continue
+            path = job.target[prefix_length:]
+            if job.action == _Job.MOVE:
+                changes[job.src[prefix_length:]] = None
+            if job.action in (_Job.PUSH, _Job.MOVE, _Job.COPY):
+                changes[path] = (job.md5, job.size, job.mtime, job.etag)
             else:
-                raise TransactionError("unknown action")
+                changes[path] = None
+        return changes
 
-            info[job.status] += 1
-            data += "%-6s %-8s %s %s\n" % (job.action, job.status, operator,
-                                           job.info)
 
-        for key in sorted(info.keys()):
-            data += "%s: %s  " % (key, info[key])
-        return data
+class AliOss2LocalTransaction(Transaction):
+    """Download objects into a local directory, and remove local files not
+    in the bucket.
+
+    An object is written into a file of partial_suffix next to the target,
+    which replaces the target once md5 is verified, and its mtime is set
+    from object meta. Compressed objects are decompressed as they are read.
+    Others not smaller than multipart_threshold are got by ranged GETs of
+    num_threads at a time into a preallocated file. Parts
+    done are kept in a checkpoint in cache_dir, so that a download broken
+    goes on from them if the object is not changed.
+    """
+
+    block_size = 1024*1024
+
+    def _get_jobs(self, pipeline=False):
+        for s in (self.src_snapshot, self.target_snapshot):
+            s.load_detail(md5=True)
+
+        src_prefix = self.src_snapshot.prefix
+        target_root = self.target_snapshot.root
+        jobs = []
+        remove_jobs = []
+        with Metrics().phase("diff"):
+            for kind, mine, theirs in self.src_snapshot.iter_diff(
+                    self.target_snapshot, same=snapshot.same_md5):
+                if kind == snapshot.REMOVED:
+                    remove_jobs.append(_Job(
+                        src=None, target=os.path.join(target_root,
+                                                      theirs.path),
+                        action=_Job.REMOVE))
+                else:
+                    jobs.append(_Job(
+                        src=src_prefix+mine.path,
+                        target=os.path.join(target_root, mine.path),
+                        md5=mine.md5, action=_Job.PUSH, size=mine.size))
+        return jobs + remove_jobs
+
+    def _do(self, job):
+        if job.action == _Job.PUSH:
+            self._download(job)
+        elif job.action == _Job.REMOVE:
+            try:
+                os.remove(job.target)
+            except FileNotFoundError:
+                pass
+
+    def _download(self, job):
+        bucket = self.src_snapshot.bucket
+        part_path = job.target + snapshot.LocalSnapshot.partial_suffix
+        os.makedirs(os.path.dirname(job.target), exist_ok=True)
+
+        result = None
+        if job.size >= Config().multipart_threshold:
+            result = retry(bucket.head_object, job.src)
+        if (result is None or
+                result.headers.get(snapshot.AliOssSnapshot.meta_compress)):
+            # compressed objects are got by one request, and decompressed
+            # as they are read
+            result = retry(bucket.get_object, job.src)
+            md5 = self._write(result, part_path)
+        else:
+            self._download_parts(job, part_path, result)
+            md5 = get_md5(part_path)
+
+        expected = self._expected_md5(result)
+        if expected and md5.upper() != expected:
+            os.remove(part_path)
+            job.info = "md5 mismatch"
+            raise JobError
+
+        try:
+            mtime = float(result.headers[
+                snapshot.AliOssSnapshot.meta_mtime])
+        except (KeyError, ValueError):
+            pass
+        else:
+            os.utime(part_path, (mtime, mtime))
+        os.replace(part_path, job.target)
+
+    def _write(self, result, path):
+        """write a GET result into path, decompressed.
+
+        :return: md5 of the data written
+        """
+        codec = result.headers.get(snapshot.AliOssSnapshot.meta_compress)
+        if codec == "gzip":
+            decompressor = zlib.decompressobj(16 + zlib.MAX_WBITS)
+        elif codec:
+            raise TransactionError("unknown codec: %s" % codec)
+        else:
+            decompressor = None
+
+        md5 = hashlib.md5()
+        with open(path, "wb") as f:
+            for block in self._iter_blocks(result):
+                if decompressor is not None:
+                    block = decompressor.decompress(block)
+                md5.update(block)
+                f.write(block)
+            if decompressor is not None:
+                block = decompressor.flush()
+                md5.update(block)
+                f.write(block)
+        return md5.hexdigest()
+
+    def _download_parts(self, job, part_path, meta):
+        """:param meta: result of HEAD of the object"""
+        config = Config()
+        size = meta.content_length
+        checkpoint_path = self._checkpoint_path(job)
+        checkpoint = {"etag": meta.etag, "size": size,
+                      "part_size": config.multipart_threshold, "done": []}
+
+        saved = None
+        if os.path.exists(part_path):
+            try:
+                with open(checkpoint_path) as f:
+                    saved = json.load(f)
+            except (OSError, ValueError):
+                pass
+        if saved is not None and all(saved.get(k) == checkpoint[k] for k in
+                                     ("etag", "size", "part_size")):
+            checkpoint = saved
+            logger.info("%s parts of %s downloaded before",
+                        len(saved["done"]), job.src)
+        else:
+            with open(part_path, "wb") as f:
+                self._preallocate(f.fileno(), size)
+
+        part_size = checkpoint["part_size"]
+        done = set(checkpoint["done"])
+        fd = os.open(part_path, os.O_WRONLY)
+        try:
+            tasks = ((offset, (fd, job.src, meta.etag, offset,
+                               min(offset+part_size, size)))
+                     for offset in range(0, size, part_size)
+                     if offset not in done)
+            for offset, _ in imap_unordered(
+                    self._download_part, tasks, config.num_threads):
+                # the part is on disk before it is recorded
+                os.fsync(fd)
+                checkpoint["done"].append(offset)
+                self._write_checkpoint(checkpoint_path, checkpoint)
+        finally:
+            os.close(fd)
+
+        os.remove(checkpoint_path)
+
+    def _download_part(self, fd, key, etag, start, end):
+        """write bytes [start, end) of an object at the same offset of fd.
+        The etag makes sure all the parts are of a same object."""
+        result = retry(self.src_snapshot.bucket.get_object, key,
+                       byte_range=(start, end-1), headers={"If-Match": etag})
+        offset = start
+        for block in self._iter_blocks(result):
+            os.pwrite(fd, block, offset)
+            offset += len(block)
+        if offset != end:
+            raise TransactionError("incomplete part of %s: %s-%s"
+                                   % (key, start, offset))
+
+    def _iter_blocks(self, result):
+        """read a GET result by blocks, taken from the bandwidth limit."""
+        while True:
+            block = result.read(self.block_size)
+            if not block:
+                return
+            _limiter.consume(len(block))
+            yield block
+
+    def _checkpoint_path(self, job):
+        name = "%s:%s" % (self.src_snapshot.root, job.src)
+        return os.path.join(Config().cache_dir, "download_%s.json" %
+                            hashlib.md5(name.encode()).hexdigest())
+
+    @staticmethod
+    def _write_checkpoint(path, checkpoint):
+        tmp_path = path + ".tmp"
+        with open(tmp_path, "w") as f:
+            json.dump(checkpoint, f)
+        os.replace(tmp_path, path)
+
+    @staticmethod
+    def _preallocate(fd, size):
+        """reserve the blocks of the file, or only set its size if the file
+        system does not support it."""
+        try:
+            os.posix_fallocate(fd, 0, size)
+        except (AttributeError, OSError):
+            os.ftruncate(fd, size)
+
+    @staticmethod
+    def _expected_md5(result):
+        """:return: md5 in object meta, or the etag if it is a md5, or None
+        """
+        md5 = result.headers.get(snapshot.AliOssSnapshot.meta_md5)
+        if md5:
+            return md5.upper()
+        etag = result.etag.strip('"')
+        if len(etag) == 32:
+            return etag.upper()
+        return None
+
+
+class Local2LocalTransaction(Transaction):
+    """Mirror a local directory into another one, such as a volume of NFS.
+
+    Files are copied by os.copy_file_range, or os.sendfile, so data is not
+    read into the process, and even not sent over the network by NFS 4.2.
+    With local_link of "reflink", files are reflinked instead on btrfs or
+    xfs, which falls back to copying across file systems. Blocks are shared
+    until either file is written, so the mirror stays a copy. "hardlink" is
+    rejected by Config, for a mirror sharing inodes with the source would
+    change with files edited in place, and never be found different by fast
+    compare.
+
+    Files are written into a file of partial_suffix first, which replaces
+    the target with the mode and mtime of the source. With fast compare,
+    files are compared by size and mtime, without md5.
+    """
+
+    # FICLONE of linux/fs.h
+    FICLONE = 0x40049409
+    chunk_size = 1024*1024*1024
+
+    def _get_jobs(self, pipeline=False):
+        if Config().compare == "fast":
+            kwargs = {"same": snapshot.same_metadata}
+            for s in (self.src_snapshot, self.target_snapshot):
+                s.load_detail(mtime=True)
+        else:
+            kwargs = {"same": snapshot.same_md5}
+            for s in (self.src_snapshot, self.target_snapshot):
+                s.load_detail(md5=True)
+
+        src_root = self.src_snapshot.root
+        target_root = self.target_snapshot.root
+        jobs = []
+        remove_jobs = []
+        with Metrics().phase("diff"):
+            for kind, mine, theirs in self.src_snapshot.iter_diff(
+                    self.target_snapshot, **kwargs):
+                if kind == snapshot.REMOVED:
+                    remove_jobs.append(_Job(
+                        src=None, target=os.path.join(target_root,
+                                                      theirs.path),
+                        action=_Job.REMOVE))
+                else:
+                    jobs.append(_Job(
+                        src=os.path.join(src_root, mine.path),
+                        target=os.path.join(target_root, mine.path),
+                        md5=mine.md5, action=_Job.PUSH, size=mine.size))
+        return jobs + remove_jobs
+
+    def _do(self, job):
+        if job.action == _Job.PUSH:
+            part_path = job.target + snapshot.LocalSnapshot.partial_suffix
+            os.makedirs(os.path.dirname(job.target), exist_ok=True)
+            if os.path.lexists(part_path):
+                os.remove(part_path)
+
+            self._copy(job, part_path,
+                       reflink=Config().local_link == "reflink")
+            os.replace(part_path, job.target)
+
+        elif job.action == _Job.REMOVE:
+            try:
+                os.remove(job.target)
+            except FileNotFoundError:
+                pass
+
+    def _copy(self, job, path, reflink=False):
+        with open(job.src, "rb") as src, open(path, "wb") as target:
+            st = os.fstat(src.fileno())
+            if not (reflink and self._reflink(src, target)):
+                self._copy_data(src, target, st.st_size)
+
+            if stat_key(os.fstat(src.fileno()))[:2] != stat_key(st)[:2]:
+                target.close()
+                os.remove(path)
+                job.info = "changed while copying"
+                raise JobError
+            os.chmod(target.fileno(), stat.S_IMODE(st.st_mode))
+            os.utime(target.fileno(), ns=(st.st_atime_ns, st.st_mtime_ns))
+
+    def _reflink(self, src, target):
+        """share the blocks of src, on btrfs or xfs.
+
+        :return: False if not supported
+        """
+        try:
+            fcntl.ioctl(target.fileno(), self.FICLONE, src.fileno())
+        except OSError as e:
+            if e.errno in (errno.EXDEV, errno.EOPNOTSUPP, errno.ENOTTY,
+                           errno.EINVAL, errno.EBADF):
+                return False
+            raise
+        return True
+
+    def _copy_data(self, src, target, size):
+        """copy in the kernel, by copy_file_range, or sendfile, or by
+        reading in the end."""
+        src_fd, target_fd = src.fileno(), target.fileno()
+        offset = 0
+        for copy in (getattr(os, "copy_file_range", None),
+                     getattr(os, "sendfile", None)):
+            if copy is None:
+                continue
+            try:
+                while offset < size:
+                    count = min(self.chunk_size, size - offset)
+                    if copy is os.sendfile:
+                        sent = copy(target_fd, src_fd, offset, count)
+                    else:
+                        sent = copy(src_fd, target_fd, count)
+                    if not sent:
+                        break
+                    offset += sent
+                return
+            except OSError as e:
+                if e.errno not in (errno.EXDEV, errno.ENOSYS, errno.EINVAL,
+                                   errno.EOPNOTSUPP, errno.ENOTSUP) or offset:
+                    raise
+
+        shutil.copyfileobj(src, target)
@@ -1,9 +1,17 @@
 
+import os
+import time
+import pickle
+import random
 import hashlib
 import logging
 import functools
+import threading
+from datetime import datetime
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
 
 import oss2
+import requests
 
 logger = logging.getLogger(__name__)
 
@@ -38,20 +46,209 @@ class Bucket(oss2.Bucket):
         return resp
 
 
-def get_md5(path=None, block_size=64*1024):
+# read buffers of get_md5, one for every thread
+_buffers = threading.local()
+
+
+def get_md5(path=None, block_size=1024*1024, stop=None):
+    """Files are read into a buffer kept by the thread, without buffering of
+    python, and the kernel is told that they are read sequentially, which
+    doubles its read-ahead on linux.
+
+    :param stop: optional threading.Event, reading is aborted once set.
+    """
     md5 = hashlib.md5()
     if path:
-        with open(path, "rb") as f:
+        buffer = getattr(_buffers, "md5", None)
+        if buffer is None or len(buffer) != block_size:
+            buffer = _buffers.md5 = bytearray(block_size)
+        view = memoryview(buffer)
+
+        with open(path, "rb", buffering=0) as f:
+            if hasattr(os, "posix_fadvise"):
+                os.posix_fadvise(f.fileno(), 0, 0,
+                                 os.POSIX_FADV_SEQUENTIAL)
             while True:
-                block = f.read(block_size)
-                if not block:
+                if stop is not None and stop.is_set():
+                    raise FoxyException("calculate md5 canceled: %s" % path)
+                length = f.readinto(buffer)
+                if not length:
                     break
-                md5.update(block)
+                md5.update(view[:length])
         return md5.hexdigest()
     else:
         raise FoxyException("calculate md5 failed: path missing.")
 
 
+def imap_unordered(func, tasks, workers, queue_size=None):
+    """Call func with a thread pool, at most queue_size calls are submitted
+    at once.
+
+    :param tasks: iterable of (key, args)
+    :return: generator of (key, func(*args)), in order of completion.
+             Results that completed are always yielded before an error
+             raised.
+    """
+    tasks = iter(tasks)
+    queue_size = queue_size or workers * 4
+    executor = ThreadPoolExecutor(max_workers=workers)
+    pending = set()
+    exhausted = False
+
+    try:
+        while True:
+            while not exhausted and len(pending) < queue_size:
+                try:
+                    key, args = next(tasks)
+                except StopIteration:
+                    exhausted = True
+                    break
+                future = executor.submit(func, *args)
+                future.key = key
+                pending.add(future)
+
+            if not pending:
+                break
+
+            done, pending = wait(pending, return_when=FIRST_COMPLETED)
+            error = None
+            for future in done:
+                if future.exception() is None:
+                    yield future.key, future.result()
+                elif error is None:
+                    error = future.exception()
+            if error is not None:
+                raise error
+    finally:
+        for future in pending:
+            future.cancel()
+        executor.shutdown(wait=False)
+
+
+def retry(func, *args, **kwargs):
+    """Call an oss2 api, retry with exponential backoff when throttled or
+    the connection broken."""
+    retries = Config().oss_retries
+    for i in range(retries + 1):
+        try:
+            return func(*args, **kwargs)
+        except oss2.exceptions.OssError as e:
+            if i == retries or e.status not in RETRY_STATUS:
+                raise
+            from .metrics import Metrics
+            Metrics().inc("oss_retries", status=e.status)
+            delay = min(2 ** i, 60) * (0.5 + random.random())
+            logger.debug("retry in %.1fs: %s", delay, e)
+            time.sleep(delay)
+
+
+# -2 is oss2.exceptions.OSS_REQUEST_ERROR_STATUS, raised by network problem.
+RETRY_STATUS = (-2, 429, 500, 502, 503, 504)
+
+
+def get_session(pool_size):
+    """:return: oss2 session whose connection pool holds pool_size
+    connections, instead of oss2.defaults.connection_pool_size."""
+    session = oss2.http.Session()
+    for scheme in ("http://", "https://"):
+        session.session.mount(scheme, requests.adapters.HTTPAdapter(
+            pool_connections=pool_size, pool_maxsize=pool_size))
+    return session
+
+
+class RateLimiter:
+    """Token bucket shared by all the threads uploading. The rate is
+    bandwidth_limit bytes per second, or the one of a bandwidth_schedule
+    window the time of day falls in. A rate of 0 means no limit.
+
+    Bytes are taken after they are sent, and the thread sleeps until the
+    bucket is no longer in debt. At most one second of bytes is saved up.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._tokens = 0
+        self._time = time.monotonic()
+
+    @staticmethod
+    def rate(now=None):
+        """:param now: datetime.time, the current one by default."""
+        config = Config()
+        now = (now or datetime.now().time()).strftime("%H:%M")
+        for start, end, rate in config.bandwidth_schedule:
+            if start <= end:
+                if start <= now < end:
+                    return rate
+            elif now >= start or now < end:
+                # over midnight
+                return rate
+        return config.bandwidth_limit
+
+    def consume(self, size):
+        rate = self.rate()
+        if not rate:
+            return
+
+        with self._lock:
+            now = time.monotonic()
+            self._tokens = min(self._tokens + (now - self._time) * rate,
+                               rate)
+            self._time = now
+            self._tokens -= size
+            delay = -self._tokens / rate
+        if delay > 0:
+            time.sleep(delay)
+
+
+class Hasher:
+    """Calculate md5 of many files with a thread pool. hashlib releases the
+    GIL while digesting, so threads are enough to keep cores and disks busy.
+
+    At most queue_size files are submitted at once, and at most per_device
+    files of the same device are read at the same time, so that spinning
+    disks are not thrashed.
+    """
+
+    def __init__(self, workers=None, per_device=None, queue_size=None):
+        config = Config()
+        self.workers = workers or config.hash_workers
+        self.per_device = per_device or config.hash_per_device
+        self.queue_size = queue_size or self.workers * 4
+        self._devices = {}
+        self._lock = threading.Lock()
+
+    def imap(self, tasks):
+        """
+        :param tasks: iterable of (key, path, device)
+        :return: generator of (key, md5), in order of completion. Results
+                 that completed are always yielded before an error raised.
+        """
+        if self.workers <= 1:
+            for key, path, _ in tasks:
+                yield key, get_md5(path)
+            return
+
+        stop = threading.Event()
+        try:
+            yield from imap_unordered(
+                functools.partial(self._hash, stop=stop),
+                ((key, (path, device)) for key, path, device in tasks),
+                self.workers, queue_size=self.queue_size)
+        finally:
+            stop.set()
+
+    def _hash(self, path, device, stop):
+        with self._semaphore(device):
+            return get_md5(path, stop=stop)
+
+    def _semaphore(self, device):
+        with self._lock:
+            if device not in self._devices:
+                self._devices[device] = threading.BoundedSemaphore(
+                    self.per_device)
+            return self._devices[device]
+
+
 class SingletonMeta(type):
 
     def __call__(cls, *args, **kwargs):
@@ -109,27 +306,183 @@ class Config(metaclass=SingletonMeta):
     end_point = None
     bucket = None
     multipart_threshold = 30*1024*1024
+    head_workers = 16
+    list_workers = 8
+    list_depth = 1
+    oss_retries = 5
 
     # for transaction
     num_threads = 2
+    job_workers = 4
+    max_inflight_bytes = 0
+    # more job workers are tried, up to job_workers_max, if throughput grows
+    job_workers_max = 0
+    # bytes per second of uploads, 0 means no limit, and the limits in
+    # [(start, end, bytes per second)] windows of a day, such as "08:00"
+    bandwidth_limit = 0
+    bandwidth_schedule = []
+    journal_compact = 100000
     cache_dir = "/tmp"
 
+    # md5, or fast which compares size and mtime first
+    compare = "md5"
+    fast_compare_audit = 0
+
+    # remote manifest of files, see AliOssSnapshot
+    manifest = True
+    manifest_reconcile = False
+
+    # print a line of job progress to the console
+    progress = False
+    # push files as soon as they are hashed when run by -i, see
+    # Local2AliOssTransaction
+    pipeline = False
+    # None or "reflink", see Local2LocalTransaction
+    local_link = None
+    # gzip files of compress_extensions, or others compressed to
+    # compress_ratio, see Local2AliOssTransaction
+    compress = False
+    compress_extensions = [".log", ".csv", ".tsv", ".txt", ".json", ".xml",
+                           ".sql"]
+    compress_ratio = 0.5
+    compress_level = 6
+    compress_workers = 2
+    # upload only the parts changed of files not smaller than
+    # multipart_threshold, see Local2AliOssTransaction._delta_upload
+    delta_upload = False
+
+    # for local snapshot
+    hash_cache = True
+    hash_workers = 4
+    hash_per_device = 2
+    walk_workers = 1
+
+    # for watch mode, seconds to wait for more changes, and between scans
+    # without inotify
+    watch_delay = 2
+    watch_interval = 60*10
+
     # log configuration
     log_config = None
     log_file = None
 
     # skip directory
     skip_dir = []
+    # gitignore style rules, see filters.PathFilter
+    filters = []
 
     def __init__(self):
         import foxy_sync_settings
         for key in ("access_key_id", "access_key_secret", "end_point", "bucket",
-                    "multipart_threshold", "num_threads", "cache_dir",
-                    "log_config", "log_file", "skip_dir"):
+                    "multipart_threshold", "head_workers", "list_workers",
+                    "list_depth", "oss_retries", "num_threads", "job_workers",
+                    "max_inflight_bytes", "job_workers_max",
+                    "bandwidth_limit", "bandwidth_schedule", "journal_compact",
+                    "compare", "fast_compare_audit", "manifest",
+                    "manifest_reconcile", "cache_dir", "hash_cache",
+                    "hash_workers", "hash_per_device", "walk_workers",
+                    "watch_delay", "watch_interval", "progress", "pipeline",
+                    "local_link", "compress", "compress_extensions",
+                    "compress_ratio", "compress_level", "compress_workers",
+                    "delta_upload", "log_config", "log_file", "skip_dir",
+                    "filters"):
             value = getattr(foxy_sync_settings, key, None)
             if value is not None:
                 setattr(self, key, value)
 
+        if self.local_link not in (None, "reflink"):
+            # hardlinks would make the mirror change with the source
+            raise ConfigError("local_link not supported: %s" %
+                              self.local_link)
+
+
+def stat_key(st):
+    """:return: (size, mtime_ns, inode, device) of an os.stat_result"""
+    return st.st_size, st.st_mtime_ns, st.st_ino, st.st_dev
+
+
+class HashCache:
+    """Persistent md5 cache of a local directory, stored in cache_dir. A file
+    is identified by (relative path, size, mtime_ns, inode, device), and the
+    cached md5 is used only if none of them changed.
+
+    The cache file is rewritten atomically, so an interrupted run leaves
+    either the old or the new version on disk.
+    """
+
+    save_interval = 300
+
+    def __init__(self, root):
+        self.root = root
+        self.path = os.path.join(
+            Config().cache_dir,
+            "%s.hash" % hashlib.md5(root.encode()).hexdigest())
+        self._entries = {}
+        self._seen = set()
+        self._dirty = False
+        self._saved_at = time.time()
+        self._load()
+
+    def get(self, path, key):
+        """
+        :param key: stat key of the file, see stat_key()
+        :return: cached md5 of path, or None if missing or outdated.
+        """
+        self._seen.add(path)
+        entry = self._entries.get(path)
+        if entry is not None and entry[:4] == key:
+            return entry[4]
+        return None
+
+    def set(self, path, key, md5):
+        self._seen.add(path)
+        self._entries[path] = tuple(key) + (md5,)
+        self._dirty = True
+        if time.time() - self._saved_at > self.save_interval:
+            self.save()
+
+    def touch(self, path):
+        """mark path as alive, so that it survives compaction."""
+        self._seen.add(path)
+
+    def save(self, compact=False):
+        """:param compact: evict entries of paths not seen in this run."""
+        if compact and len(self._seen) != len(self._entries):
+            self._entries = {k: v for k, v in self._entries.items()
+                             if k in self._seen}
+            self._dirty = True
+
+        if not self._dirty:
+            return
+
+        tmp_path = self.path + ".tmp"
+        with open(tmp_path, "wb") as f:
+            pickle.dump((self.root, self._entries), f,
+                        protocol=pickle.HIGHEST_PROTOCOL)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, self.path)
+
+        self._dirty = False
+        self._saved_at = time.time()
+        logger.debug("%s hashes saved to %s", len(self._entries), self.path)
+
+    def _load(self):
+        try:
+            with open(self.path, "rb") as f:
+                root, entries = pickle.load(f)
+        except FileNotFoundError:
+            return
+        except Exception as e:
+            logger.warning("hash cache %s ignored: %s", self.path, e)
+            return
+
+        if root == self.root:
+            self._entries = entries
+
+    def __len__(self):
+        return len(self._entries)
+
 
 class lazy_property(object):
     """Use descriptor.
@@ -157,5 +510,9 @@ class TransactionError(FoxyException):
     pass
 
 
+class ConfigError(FoxyException):
+    pass
+
+
 class JobError(TransactionError):
     pass
@@ -0,0 +1,409 @@
+import os
+import copy
+import stat
+import time
+import errno
+import select
+import struct
+import ctypes
+import ctypes.util
+import logging
+
+from . import utils
+from .snapshot import (FileTable, FileIdentity, LocalSnapshot, merge_diff,
+                       same_md5, REMOVED, ADDED, CHANGED)
+from .transaction import Local2AliOssTransaction
+
+
+__all__ = ["Watcher"]
+
+logger = logging.getLogger(__name__)
+
+
+class _Inotify:
+    """inotify(7) by ctypes, only on linux."""
+
+    IN_CLOSE_WRITE = 0x00000008
+    IN_MOVED_FROM = 0x00000040
+    IN_MOVED_TO = 0x00000080
+    IN_CREATE = 0x00000100
+    IN_DELETE = 0x00000200
+    IN_Q_OVERFLOW = 0x00004000
+    IN_IGNORED = 0x00008000
+    IN_ISDIR = 0x40000000
+
+    mask = IN_CLOSE_WRITE | IN_MOVED_FROM | IN_MOVED_TO | IN_CREATE | IN_DELETE
+    header = struct.Struct("iIII")
+
+    def __init__(self):
+        libc = ctypes.CDLL(ctypes.util.find_library("c"), use_errno=True)
+        try:
+            self._add_watch = libc.inotify_add_watch
+            self._rm_watch = libc.inotify_rm_watch
+            init = libc.inotify_init1
+        except AttributeError:
+            raise OSError(errno.ENOSYS, "inotify not supported")
+
+        self.fd = init(os.O_CLOEXEC)
+        if self.fd < 0:
+            self._raise()
+
+    def add_watch(self, path):
+        """:return: watch descriptor, the same one for a same directory"""
+        wd = self._add_watch(self.fd, os.fsencode(path), self.mask)
+        if wd < 0:
+            self._raise(path)
+        return wd
+
+    def rm_watch(self, wd):
+        self._rm_watch(self.fd, wd)
+
+    def read(self, timeout):
+        """:return: list of (wd, mask, name) read in timeout seconds"""
+        if not select.select([self.fd], [], [], timeout)[0]:
+            return []
+
+        data = os.read(self.fd, 64*1024)
+        events = []
+        offset = 0
+        while offset < len(data):
+            wd, mask, _, length = self.header.unpack_from(data, offset)
+            offset += self.header.size
+            name = data[offset:offset+length].rstrip(b"\0")
+            offset += length
+            events.append((wd, mask, os.fsdecode(name)))
+        return events
+
+    def close(self):
+        os.close(self.fd)
+
+    @staticmethod
+    def _raise(path=None):
+        number = ctypes.get_errno()
+        raise OSError(number, os.strerror(number), path)
+
+
+class _DeltaTransaction(Local2AliOssTransaction):
+    """jobs of a few paths, on snapshots holding no files. The manifest is
+    written by the watcher."""
+
+    summary = False
+
+    def __init__(self, src_snapshot, target_snapshot, number, diff):
+        Local2AliOssTransaction.__init__(self, src_snapshot, target_snapshot)
+        self.name += "_%s" % number
+        self.jobs = self._jobs_of(diff)
+
+    def _begin(self):
+        if utils.Config().manifest and self.target_snapshot.manifest_fresh:
+            self.target_snapshot.invalidate_manifest()
+
+    def _commit(self):
+        pass
+
+
+class Watcher:
+    """Keep pushing changes of a local directory to AliOss.
+
+    After a full transaction, the objects are kept in memory as
+    {path: (md5, size, mtime, etag)}. Paths changed are taken from inotify,
+    and pushed together once no more change comes in watch_delay seconds,
+    or max_delay after the first one. Only these paths are hashed, mostly
+    by the hash cache, and compared with the objects. The hash cache is
+    kept in memory, and saved every HashCache.save_interval and at exit.
+
+    Without inotify, or when changes are lost, the directory is scanned
+    again, every watch_interval seconds for the former. Directories reached
+    by links are not watched, and only scanned. Files removed while hashed
+    are removed, and paths failed to be pushed are pending again, so the
+    watcher keeps running through errors of the disk or AliOss.
+    """
+
+    max_delay = 60
+    manifest_interval = 60*10
+
+    def __init__(self, local_dir, alioss_snapshot):
+        if not os.path.isdir(local_dir):
+            raise utils.SnapshotError("invalid local directory %s" % local_dir)
+        self.root = os.path.abspath(os.path.realpath(local_dir))
+        self.alioss_snapshot = alioss_snapshot
+        self.state = {}
+        self._local = None
+        self._target = None
+        self._cache = None
+        self._inotify = None
+        self._wds = {}
+        self._pending = set()
+        self._first_event = self._last_event = 0
+        self._scanned_at = time.time()
+        self._scan_failed = False
+        self._number = 0
+        self._changed = False
+        self._manifest_at = time.time()
+
+    def run(self):
+        try:
+            self.setup()
+            while True:
+                self.step()
+        except KeyboardInterrupt:
+            pass
+        finally:
+            self._write_manifest()
+            if self._cache is not None:
+                self._cache.save()
+            if self._inotify is not None:
+                self._inotify.close()
+
+    def setup(self):
+        """watch the directory, then push all of it."""
+        try:
+            self._inotify = _Inotify()
+            self._watch_tree("")
+        except OSError as e:
+            logger.warning("scan every %ss, inotify failed: %s",
+                           utils.Config().watch_interval, e)
+            if self._inotify is not None:
+                self._inotify.close()
+            self._inotify = None
+            self._wds = {}
+
+        local_snapshot = LocalSnapshot(self.root)
+        target = self.alioss_snapshot
+        transaction = local_snapshot.push_to(target)
+        transaction.get_jobs()
+
+        for f_id in target.files:
+            self.state[f_id.path] = (f_id.md5, f_id.size, f_id.mtime,
+                                     target.etags.get(f_id.path))
+        self._run(transaction)
+        # the manifest is written by the transaction if all finished
+        self._changed = not target.manifest_fresh
+
+        # both snapshots are not needed any more, only their settings
+        self._local = copy.copy(local_snapshot)
+        self._local.files = FileTable()
+        self._target = copy.copy(target)
+        self._target.files = FileTable(target.prefix)
+        self._target.etags = {}
+        self.alioss_snapshot = None
+        if utils.Config().hash_cache:
+            # saved by the transaction
+            self._cache = utils.HashCache(self.root)
+        logger.info("watching %s, %s files", self.root, len(self.state))
+
+    def step(self, timeout=None):
+        """wait for changes, and push them if it is time to."""
+        config = utils.Config()
+        deadlines = []
+        if self._pending:
+            deadlines.append(min(self._last_event + config.watch_delay,
+                                 self._first_event + self.max_delay))
+        if self._inotify is None or self._scan_failed:
+            deadlines.append(self._scanned_at + config.watch_interval)
+        if self._changed and not self._pending:
+            deadlines.append(self._manifest_at + self.manifest_interval)
+        if deadlines:
+            wait = max(min(deadlines) - time.time(), 0)
+            timeout = wait if timeout is None else min(timeout, wait)
+
+        if self._inotify is None:
+            time.sleep(timeout)
+        else:
+            self.read(timeout)
+
+        now = time.time()
+        if self._pending and (
+                now >= self._last_event + config.watch_delay or
+                now >= self._first_event + self.max_delay):
+            self.flush()
+        if ((self._inotify is None or self._scan_failed) and
+                now >= self._scanned_at + config.watch_interval):
+            self.rescan()
+        if (self._changed and not self._pending and
+                now >= self._manifest_at + self.manifest_interval):
+            self._write_manifest()
+
+    def read(self, timeout):
+        """take events from inotify, changed paths are pending."""
+        for wd, mask, name in self._inotify.read(timeout):
+            if mask & _Inotify.IN_Q_OVERFLOW:
+                logger.warning("inotify queue overflow, scan again")
+                self.rescan()
+                continue
+            if mask & _Inotify.IN_IGNORED:
+                self._wds.pop(wd, None)
+                continue
+
+            directory = self._wds.get(wd)
+            if directory is None:
+                continue
+            path = os.path.join(directory, name)
+
+            if not mask & _Inotify.IN_ISDIR:
+                self._add_pending([path])
+            elif mask & (_Inotify.IN_CREATE | _Inotify.IN_MOVED_TO):
+                self._watch_tree(path)
+            else:
+                self._unwatch_tree(path)
+
+    def flush(self):
+        """push pending paths. They are pending again if it failed, such as
+        by an error of AliOss."""
+        paths, self._pending = self._pending, set()
+        try:
+            self._flush(paths)
+        except Exception as e:
+            logger.exception(e)
+            logger.warning("push %s paths again later", len(paths))
+            self._add_pending(paths)
+
+    def _flush(self, paths):
+        files = FileTable()
+        diff = []
+        for path in sorted(paths):
+            if LocalSnapshot.should_skip(path, key=True):
+                continue
+            try:
+                st = os.stat(os.path.join(self.root, path))
+            except (FileNotFoundError, NotADirectoryError):
+                st = None
+
+            if st is not None and stat.S_ISREG(st.st_mode):
+                files.append(path, size=st.st_size, stat=utils.stat_key(st))
+            elif path in self.state:
+                md5, size = self.state[path][:2]
+                diff.append((REMOVED, None,
+                             FileIdentity(path, md5=md5, size=size)))
+
+        hashed = self._load_md5(files)
+        if len(hashed) < len(files):
+            # removed while hashed
+            kept = {f_id.path for f_id in hashed}
+            for f_id in files:
+                if f_id.path not in kept and f_id.path in self.state:
+                    md5, size = self.state[f_id.path][:2]
+                    diff.append((REMOVED, None,
+                                 FileIdentity(f_id.path, md5=md5, size=size)))
+
+        for f_id in hashed:
+            entry = self.state.get(f_id.path)
+            if entry is None:
+                diff.append((ADDED, f_id, None))
+            elif entry[0] != f_id.md5:
+                diff.append((CHANGED, f_id, FileIdentity(f_id.path)))
+
+        logger.info("%s paths changed", len(paths))
+        self._push(diff)
+
+    def rescan(self):
+        """compare the whole directory with the objects. If it failed, it is
+        done again in watch_interval, with inotify too."""
+        self._scanned_at = time.time()
+        try:
+            files = self._load_md5(LocalSnapshot(self.root).files)
+            objects = FileTable()
+            for path in sorted(self.state):
+                md5, size = self.state[path][:2]
+                objects.append(path, md5=md5, size=size)
+            self._push(merge_diff(files.iter_sorted(), objects.iter_sorted(),
+                                  same=same_md5))
+        except Exception as e:
+            logger.exception(e)
+            logger.warning("scan again in %ss",
+                           utils.Config().watch_interval)
+            self._scan_failed = True
+        else:
+            self._scan_failed = False
+
+    def _load_md5(self, files):
+        """hash files with the cache, leaving out the ones removed meanwhile.
+
+        :return: FileTable of the files hashed
+        """
+        while True:
+            try:
+                self._local.load_md5(files, self._cache)
+                return files
+            except (FileNotFoundError, NotADirectoryError):
+                kept = FileTable()
+                for f_id in files:
+                    if os.path.isfile(os.path.join(self.root, f_id.path)):
+                        kept.append(f_id.path, md5=f_id.md5, size=f_id.size,
+                                    stat=f_id.stat)
+                if len(kept) == len(files):
+                    raise
+                files = kept
+
+    def _push(self, diff):
+        self._number += 1
+        transaction = _DeltaTransaction(self._local, self._target,
+                                        self._number, diff)
+        if transaction.jobs:
+            self._run(transaction)
+
+    def _run(self, transaction):
+        _, failed, canceled = transaction.run()
+        self._apply(transaction.changes())
+        if not failed and not canceled and os.path.exists(
+                transaction.dump_path):
+            # nothing to resume
+            os.remove(transaction.dump_path)
+
+    def _apply(self, changes):
+        for path, entry in changes.items():
+            if entry is None:
+                self.state.pop(path, None)
+            else:
+                self.state[path] = entry
+        self._changed = self._changed or bool(changes)
+
+    def _add_pending(self, paths):
+        now = time.time()
+        if not self._pending:
+            self._first_event = now
+        self._last_event = now
+        self._pending.update(paths)
+
+    def _watch_tree(self, relative_path):
+        """watch a directory and the ones under it, files found there are
+        pending, for they may be created before watched."""
+        found = []
+        for path, dirs, files in os.walk(os.path.join(self.root,
+                                                      relative_path)):
+            directory = os.path.relpath(path, self.root)
+            directory = "" if directory == "." else directory
+            if directory and LocalSnapshot.should_skip(directory,
+                                                       directory=True):
+                dirs[:] = []
+                continue
+
+            try:
+                self._wds[self._inotify.add_watch(path)] = directory
+            except OSError as e:
+                if e.errno != errno.ENOENT:
+                    raise
+            found.extend(os.path.join(directory, f) for f in files)
+
+        if relative_path:
+            self._add_pending(found)
+
+    def _unwatch_tree(self, relative_path):
+        """a directory removed or moved away, objects under it are pending."""
+        head = relative_path + "/"
+        for wd, directory in list(self._wds.items()):
+            if directory == relative_path or directory.startswith(head):
+                self._inotify.rm_watch(wd)
+                del self._wds[wd]
+        self._add_pending([p for p in self.state if p.startswith(head)])
+
+    def _write_manifest(self):
+        if not self._changed or self._target is None:
+            return
+        if utils.Config().manifest:
+            try:
+                self._target.write_manifest(self.state)
+            except Exception as e:
+                logger.warning("write manifest failed: %s", e)
+        self._changed = False
+        self._manifest_at = time.time()
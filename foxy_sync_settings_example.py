@@ -9,8 +9,103 @@ bucket = "terrence-test"
 # optional
 skip_dir = ["*/movie",]
 
+# rules of gitignore, for both local files and objects, the last rule matched
+# wins, optional
+filters = ["*.tmp",
+           "node_modules/",
+           "/build",
+           "!keep.tmp"]
+
 cache_dir = "/var/log/foxy_sync"
+
+# compare files by md5, or by size and mtime first with fast, and then md5
+# is only calculated for files differ, optional
+compare = "md5"
+# with fast, ratio of the other files whose md5 is also checked, optional
+fast_compare_audit = 0.01
+
+# keep a manifest of pushed files under the target prefix, so that the bucket
+# is not listed while the manifest is up to date, optional
+manifest = True
+# list the bucket anyway, and only HEAD objects not matching the manifest,
+# in case other tools write into the bucket too, optional
+manifest_reconcile = False
+
+# keep md5 of local files in cache_dir, optional
+hash_cache = True
+
+# with md5 compare, push new contents while other files are still hashed,
+# so that a file is uploaded before its pages are evicted. Only when the
+# transaction is started at once by -i, optional
+pipeline = False
+
+# to another local directory, "reflink" files of btrfs and xfs instead of
+# copying them if they are on a same file system. Blocks are shared until
+# either file is written. Others, such as "hardlink", are rejected, as the
+# mirror would change with the source, optional
+local_link = None
+
+# upload files compressed by gzip in compress_workers processes, the ones of
+# compress_extensions, and others whose first 64KB is compressed to
+# compress_ratio, 0 means never. Objects are still compared with the files
+# as they are, and decompressed when downloaded, optional
+compress = False
+compress_extensions = [".log", ".csv", ".tsv", ".txt", ".json", ".xml", ".sql"]
+compress_ratio = 0.5
+compress_level = 6
+compress_workers = 2
+
+# upload files not smaller than multipart_threshold by parts, keeping md5 of
+# the parts in the bucket, so that parts not changed are copied in the bucket
+# next time, such as the ones of an appended log or a disk image, optional
+delta_upload = False
+
+# threads for calculating md5, and the max threads reading a same device
+hash_workers = 4
+hash_per_device = 2
+
+# threads for reading directories, helps on network file systems, optional
+walk_workers = 1
+
+# with --watch, seconds to wait for more changes before pushing them, and
+# seconds between scans of the directory if inotify is not available, optional
+watch_delay = 2
+watch_interval = 600
+
 log_file = "/var/log/foxy_sync/log.txt"
 
+# print jobs done and upload speed every second, as --progress, optional.
+# metrics of every run are written into cache_dir, foxy_sync.prom for the
+# textfile collector of Prometheus, and <transaction>.metrics.json
+progress = False
+
 # threshold for multipart, byte, optional
-multipart_threshold = 100*1024*1024
\ No newline at end of file
+multipart_threshold = 100*1024*1024
+
+# concurrent HEAD requests when loading md5 of AliOss objects, and retries
+# of a throttled request, optional
+head_workers = 16
+oss_retries = 5
+
+# directories in the first list_depth levels are listed concurrently by
+# list_workers threads, optional
+list_workers = 8
+list_depth = 1
+
+# jobs running at the same time, and the max bytes of the running jobs,
+# 0 means no limit, optional
+job_workers = 4
+max_inflight_bytes = 2*1024*1024*1024
+
+# try more job workers while throughput grows, up to job_workers_max, and
+# fewer when jobs fail or are throttled, 0 means fixed job_workers, optional
+job_workers_max = 16
+
+# bytes per second of all the uploads, 0 means no limit, and the limits in
+# windows of the day, such as less in office hours, optional
+bandwidth_limit = 0
+bandwidth_schedule = [("09:00", "18:00", 1024*1024),
+                      ("23:00", "07:00", 0)]
+
+# job changes logged before the transaction dump is rewritten, optional
+journal_compact = 100000
@@ -1,13 +1,25 @@
 
+import io
 import os
+import sys
+import gzip
+import json
 import time
+import pickle
 import shutil
 import unittest
 import tempfile
+from unittest import mock
+from datetime import time as day_time
 
 from foxy_sync.snapshot import *
-from foxy_sync.transaction import Transaction, Local2AliOssTransaction
-from foxy_sync import utils
+from foxy_sync.transaction import (Transaction, Local2AliOssTransaction,
+                                   _Job, _Executor, _Journal, _Controller)
+from foxy_sync.watch import Watcher
+from foxy_sync.metrics import Metrics
+from foxy_sync.filters import PathFilter
+from foxy_sync import utils, Run
+from . import fake_oss
 
 
 class CaseAlioss(unittest.TestCase):
@@ -59,6 +71,7 @@ class CaseLocal(unittest.TestCase):
 
         # _scan
         assert len(snapshot.files) == len(self.file_set)
+        assert snapshot.files.is_sorted
 
         # load_detail
         snapshot.load_detail(md5=True, mtime=True)
@@ -73,6 +86,62 @@ class CaseLocal(unittest.TestCase):
         print()
         print(snapshot)
 
+    def test_hash_cache(self):
+        config = utils.Config()
+        cache_dir, config.cache_dir = config.cache_dir, tempfile.mkdtemp()
+        get_md5 = utils.get_md5
+        try:
+            snapshot = LocalSnapshot(self.root)
+            snapshot.load_detail(md5=True)
+            cache = utils.HashCache(snapshot.root)
+            assert len(cache) == len(self.file_set)
+
+            # unchanged files are not read again
+            def _get_md5(path=None, **kwargs):
+                raise AssertionError("%s hashed again" % path)
+            utils.get_md5 = _get_md5
+            snapshot = LocalSnapshot(self.root)
+            snapshot.load_detail(md5=True)
+            for f_id in snapshot.frozen_files:
+                assert f_id.md5.lower() == self.md5
+        finally:
+            utils.get_md5 = get_md5
+            shutil.rmtree(config.cache_dir)
+            config.cache_dir = cache_dir
+
+    def test_hasher(self):
+        paths = [os.path.join(self.root, p) for p in self.file_set]
+        for workers in (1, 3):
+            hasher = utils.Hasher(workers=workers, per_device=1, queue_size=2)
+            result = dict(hasher.imap((p, p, 0) for p in paths))
+            self.assertEqual(set(result.keys()), set(paths))
+            self.assertEqual(set(result.values()), {self.md5})
+
+        with self.assertRaises(FileNotFoundError):
+            dict(utils.Hasher(workers=2).imap([("x", "/not/exist", 0)]))
+
+    def test_walk(self):
+        root = tempfile.mkdtemp()
+        try:
+            os.makedirs(os.path.join(root, "a/b"))
+            with open(os.path.join(root, "a/b/file"), "wb") as f:
+                f.write(self.content)
+            os.symlink(root, os.path.join(root, "a/b/loop"))
+            os.symlink(os.path.join(root, "a/b"), os.path.join(root, "link"))
+            os.symlink("/not/exist", os.path.join(root, "broken"))
+
+            config = utils.Config()
+            for workers in (1, 4):
+                config.walk_workers = workers
+                snapshot = LocalSnapshot(root)
+                self.assertEqual(sorted(f.path for f in snapshot.files),
+                                 ["a/b/file", "link/file"])
+                self.assertEqual({f.size for f in snapshot.files},
+                                 {len(self.content)})
+        finally:
+            config.walk_workers = 1
+            shutil.rmtree(root)
+
     def test_skip(self):
         config = utils.Config()
         config.skip_dir = ["*/movie",
@@ -87,6 +156,1016 @@ class CaseLocal(unittest.TestCase):
         assert should_skip("dir1/movie/dir3/a", key=True)
         assert should_skip("dir1/dir2/a", key=True)
 
+    def test_filter(self):
+        path_filter = PathFilter(["# comment", "*.tmp", "node_modules/",
+                                  "/build", "docs/**/draft", "!keep.tmp"],
+                                 skip_dir=["*/movie"])
+        excluded = path_filter.excluded
+        self.assertTrue(excluded("a.tmp"))
+        self.assertTrue(excluded("x/y/a.tmp"))
+        self.assertFalse(excluded("x/keep.tmp"))
+        self.assertTrue(excluded("x/node_modules", directory=True))
+        self.assertTrue(excluded("x/node_modules/y/z.js"))
+        # directories only
+        self.assertFalse(excluded("x/node_modules"))
+        self.assertTrue(excluded("build/a"))
+        self.assertFalse(excluded("x/build/a"))
+        self.assertTrue(excluded("docs/draft"))
+        self.assertTrue(excluded("docs/a/b/draft/c"))
+        self.assertTrue(excluded("my/movie/a"))
+        # included, but under an excluded directory
+        self.assertTrue(excluded("x/node_modules/keep.tmp"))
+        self.assertEqual(path_filter.excluded_parent("docs/a/draft/b/c"),
+                         "docs/a/draft")
+
+        config = utils.Config()
+        root = tempfile.mkdtemp()
+        try:
+            for path in ("a.txt", "a.tmp", "build/b.txt", "sub/build/b.txt",
+                         "sub/node_modules/c.js"):
+                os.makedirs(os.path.join(root, os.path.dirname(path)),
+                            exist_ok=True)
+                open(os.path.join(root, path), "w").close()
+            config.filters = ["*.tmp", "node_modules/", "/build"]
+            snapshot = LocalSnapshot(root)
+            self.assertEqual(sorted(f.path for f in snapshot.files),
+                             ["a.txt", "sub/build/b.txt"])
+        finally:
+            config.filters = []
+            shutil.rmtree(root)
+
+    def test_local_to_local(self):
+        config = utils.Config()
+        saved = config.cache_dir
+        config.cache_dir = tempfile.mkdtemp()
+        target = tempfile.mkdtemp()
+        with open(os.path.join(target, "extra"), "w") as f:
+            f.write("not in the source")
+
+        def mirror():
+            transaction = LocalSnapshot(self.root).push_to(
+                LocalSnapshot(target))
+            return transaction.run()
+
+        try:
+            self.assertEqual(mirror(), (len(self.file_set) + 1, 0, 0))
+            for path in self.file_set:
+                src = os.stat(os.path.join(self.root, path))
+                st = os.stat(os.path.join(target, path))
+                self.assertEqual((st.st_size, st.st_mtime_ns, st.st_mode),
+                                 (src.st_size, src.st_mtime_ns, src.st_mode))
+                self.assertNotEqual(st.st_ino, src.st_ino)
+            self.assertFalse(os.path.exists(os.path.join(target, "extra")))
+            self.assertEqual(mirror(), (0, 0, 0))
+
+            # compared by size and mtime, never sharing the inode
+            config.compare = "fast"
+            config.local_link = "reflink"
+            path = os.path.join(self.root, sorted(self.file_set)[0])
+            st = os.stat(path)
+            os.utime(path, (0, 0))
+            try:
+                self.assertEqual(mirror(), (1, 0, 0))
+            finally:
+                os.utime(path, ns=(st.st_atime_ns, st.st_mtime_ns))
+            copied = os.path.join(target, sorted(self.file_set)[0])
+            self.assertNotEqual(os.stat(copied).st_ino, st.st_ino)
+            with open(copied, "rb") as f:
+                self.assertEqual(f.read(), self.content)
+
+            # hardlinks are rejected when the settings are loaded
+            with mock.patch("foxy_sync_settings.local_link", "hardlink",
+                            create=True):
+                with self.assertRaises(utils.ConfigError):
+                    utils.Config.__init__(object.__new__(utils.Config))
+
+            with self.assertRaises(utils.SnapshotError):
+                LocalSnapshot(self.root).push_to(LocalSnapshot(self.root))
+        finally:
+            config.compare = "md5"
+            config.local_link = None
+            shutil.rmtree(target)
+            shutil.rmtree(config.cache_dir)
+            config.cache_dir = saved
+
+
+class CaseFileTable(unittest.TestCase):
+
+    def test_base(self):
+        table = FileTable(prefix="p/")
+        table.append("a/b", md5="5EB63BBBE01EEED093CB22BB8F5ACDC3", size=11)
+        table.append("a/c", md5="", mtime=1500000000.5)
+        table.append("d", md5="not-hex", stat=(3, 4, 5, 6))
+        table.append("e")
+
+        table = pickle.loads(pickle.dumps(table))
+        self.assertEqual([f.path for f in table], ["a/b", "a/c", "d", "e"])
+        self.assertEqual([f.md5 for f in table],
+                         ["5EB63BBBE01EEED093CB22BB8F5ACDC3", "", "not-hex",
+                          None])
+        self.assertEqual([f.mtime for f in table],
+                         [None, 1500000000.5, None, None])
+        self.assertEqual([f.size for f in table], [11, None, 3, None])
+        self.assertEqual(table[2].stat, (3, 4, 5, 6))
+        self.assertEqual(table[0].prefix, "p/")
+
+        table[3].md5 = "5EB63BBBE01EEED093CB22BB8F5ACDC3"
+        self.assertEqual(table[3], FileIdentity(
+            "e", md5="5EB63BBBE01EEED093CB22BB8F5ACDC3"))
+        self.assertTrue(table.is_sorted)
+        table.append("a.txt")
+        self.assertFalse(table.is_sorted)
+        self.assertEqual([f.path for f in table.iter_sorted()],
+                         ["a.txt", "a/b", "a/c", "d", "e"])
+
+    def test_merge_diff(self):
+        mine = [FileIdentity("a", md5="1"), FileIdentity("b", md5="2"),
+                FileIdentity("d", md5="4")]
+        theirs = [FileIdentity("b", md5="3"), FileIdentity("c", md5="3"),
+                  FileIdentity("d", md5="4"), FileIdentity("e", md5="5")]
+        result = [(kind, a and a.path, b and b.path)
+                  for kind, a, b in merge_diff(mine, theirs)]
+        self.assertEqual(result, [(ADDED, "a", None),
+                                  (CHANGED, "b", "b"),
+                                  (REMOVED, None, "c"),
+                                  (REMOVED, None, "e")])
+
+
+class CaseExecutor(unittest.TestCase):
+
+    def test_run(self):
+        jobs = [_Job(src=None, target=str(i), action=_Job.PUSH, size=10)
+                for i in range(20)]
+        inflight = []
+        running = set()
+
+        def _do(job):
+            running.add(job.target)
+            inflight.append(len(running))
+            time.sleep(0.01)
+            running.discard(job.target)
+            if job.target == "3":
+                raise ValueError("broken")
+
+        executor = _Executor(_do, len(jobs), workers=4, max_bytes=20)
+        executor.run(jobs)
+
+        self.assertEqual(executor.finished_number, 19)
+        self.assertEqual(executor.failed_number, 1)
+        self.assertEqual(jobs[3].status, _Job.FAILED)
+        self.assertEqual(jobs[3].info, "broken")
+        self.assertTrue(max(inflight) <= 2)
+
+    def test_controller(self):
+        controller = _Controller(4, 8)
+        for throughput, failure_rate, limit in ((100, 0, 5), (120, 0, 6),
+                                                (121, 0, 6), (100, 0, 5),
+                                                (120, 0, 4), (120, 0.5, 2),
+                                                (120, 0, 3), (10, 0, 2)):
+            controller.adjust(throughput, failure_rate)
+            self.assertEqual(controller.limit, limit)
+
+    def test_rate_limiter(self):
+        config = utils.Config()
+        saved = (config.bandwidth_limit, config.bandwidth_schedule)
+        config.bandwidth_limit = 100000
+        config.bandwidth_schedule = [("08:00", "18:00", 10),
+                                     ("22:00", "06:00", 20)]
+        try:
+            limiter = utils.RateLimiter()
+            self.assertEqual(limiter.rate(day_time(9)), 10)
+            self.assertEqual(limiter.rate(day_time(23)), 20)
+            self.assertEqual(limiter.rate(day_time(1)), 20)
+            self.assertEqual(limiter.rate(day_time(7)), 100000)
+
+            with mock.patch.object(utils.RateLimiter, "rate",
+                                   return_value=100000):
+                start = time.time()
+                for _ in range(3):
+                    limiter.consume(20000)
+                self.assertTrue(time.time() - start >= 0.5)
+        finally:
+            config.bandwidth_limit, config.bandwidth_schedule = saved
+
+    def test_batch(self):
+        jobs = [_Job(src=None, target=str(i), action=_Job.REMOVE)
+                for i in range(2500)]
+        jobs.append(_Job(src=None, target="push", action=_Job.PUSH))
+        batches = []
+
+        def _do_batch(batch):
+            batches.append(len(batch))
+            return [None if job.target != "7" else "denied" for job in batch]
+
+        executor = _Executor(lambda job: None, len(jobs), workers=2,
+                             do_batch=_do_batch)
+        executor.run(jobs)
+
+        self.assertEqual(sorted(batches), [500, 1000, 1000])
+        self.assertEqual(executor.finished_number, 2500)
+        self.assertEqual((jobs[7].status, jobs[7].info),
+                         (_Job.FAILED, "denied"))
+        self.assertEqual(jobs[-1].status, _Job.FINISHED)
+
+
+class CaseFakeOss(unittest.TestCase):
+
+    def setUp(self):
+        self.config = utils.Config()
+        self.saved = (self.config.cache_dir, self.config.multipart_threshold)
+        self.config.cache_dir = tempfile.mkdtemp()
+        self.config.multipart_threshold = 100*1024
+        self.root = tempfile.mkdtemp()
+        for i in range(20):
+            os.makedirs(os.path.join(self.root, "d%s" % (i % 3)),
+                        exist_ok=True)
+            with open(os.path.join(self.root, "d%s/f%s" % (i % 3, i)),
+                      "wb") as f:
+                f.write(os.urandom(1024 * i * i))
+
+    def tearDown(self):
+        shutil.rmtree(self.root)
+        shutil.rmtree(self.config.cache_dir)
+        self.config.cache_dir, self.config.multipart_threshold = self.saved
+
+    def _push(self, prefix=None):
+        local_snapshot = LocalSnapshot(self.root)
+        alioss_snapshot = AliOssSnapshot("fake-endpoint", "fake-bucket",
+                                         prefix=prefix)
+        transaction = local_snapshot.push_to(alioss_snapshot)
+        transaction.get_jobs()
+        if transaction.jobs:
+            with self.assertRaises(SystemExit):
+                transaction.start()
+        return transaction
+
+    @staticmethod
+    def _cli(*args):
+        """run the command line, leaving logging as it is"""
+        with mock.patch.object(sys, "argv", ["foxy-sync"] + list(args)), \
+                mock.patch("logging.config.dictConfig"):
+            Run().start()
+
+    @staticmethod
+    def _objects(bucket):
+        """objects pushed, without the manifest"""
+        return {k: v for k, v in bucket.objects.items()
+                if AliOssSnapshot.meta_dir not in k}
+
+    def test_push(self):
+        with fake_oss.install() as bucket:
+            transaction = self._push(prefix="backup")
+            self.assertEqual(len(transaction), 20)
+            self.assertEqual(len(self._objects(bucket)), 20)
+            self.assertTrue(bucket.requests["complete_multipart_upload"] > 0)
+
+            # pushed again, nothing changed
+            self.assertEqual(len(self._push(prefix="backup")), 0)
+
+            os.remove(os.path.join(self.root, "d0/f0"))
+            with open(os.path.join(self.root, "d1/f1"), "wb") as f:
+                f.write(b"changed")
+            with mock.patch.object(
+                    bucket, "batch_delete_objects",
+                    wraps=bucket.batch_delete_objects) as batch_delete:
+                transaction = self._push(prefix="backup")
+            self.assertEqual(sorted((j.action, j.target, j.status)
+                                    for j in transaction.jobs),
+                             [("push", "backup/d1/f1", "finished"),
+                              ("remove", "backup/d0/f0", "finished")])
+            # no sidecar of parts without delta_upload
+            batch_delete.assert_called_once_with(["backup/d0/f0"])
+            self.assertEqual(bucket.requests["batch_delete_objects"], 1)
+            self.assertNotIn("delete_object", bucket.requests)
+            self.assertEqual(len(self._objects(bucket)), 19)
+
+    def test_metrics(self):
+        Metrics().reset()
+        with fake_oss.install():
+            transaction = self._push()
+
+        with open(os.path.join(self.config.cache_dir,
+                               transaction.name + ".metrics.json")) as f:
+            summary = json.load(f)
+        self.assertTrue({"scan", "hash", "list", "plan", "execute"} <=
+                        set(summary["phases"]))
+        self.assertEqual(summary["counters"]["scanned_files"], 20)
+        self.assertEqual(summary["counters"]['jobs{action="push",'
+                                             'status="finished"}'], 20)
+        self.assertEqual(summary["job_seconds"]["count"], 20)
+        self.assertIsNotNone(summary["job_seconds"]["p50"])
+
+        with open(os.path.join(self.config.cache_dir,
+                               "foxy_sync.prom")) as f:
+            text = f.read()
+        self.assertIn('foxy_sync_job_seconds_bucket{le="+Inf"} 20', text)
+        self.assertIn("# TYPE foxy_sync_uploaded_bytes counter", text)
+
+    def test_move(self):
+        with fake_oss.install() as bucket:
+            self._push()
+            data = {k: v.data for k, v in self._objects(bucket).items()}
+
+            os.rename(os.path.join(self.root, "d2"),
+                      os.path.join(self.root, "renamed"))
+            bucket.requests.clear()
+            with mock.patch("oss2.resumable_upload") as upload:
+                transaction = self._push()
+                self.assertFalse(upload.called)
+            self.assertEqual({j.action for j in transaction.jobs}, {"move"})
+            self.assertEqual(len(transaction), 6)
+            self.assertIn("move   finished d2/f2 -> renamed/f2",
+                          str(transaction))
+            self.assertTrue(bucket.requests["upload_part_copy"] > 0)
+
+            objects = self._objects(bucket)
+            self.assertEqual(len(objects), 20)
+            for key, value in data.items():
+                key = key.replace("d2/", "renamed/")
+                self.assertEqual(objects[key].data, value)
+                self.assertIn("x-oss-meta-md5", objects[key].headers)
+
+    def test_move_source_changed(self):
+        with fake_oss.install() as bucket:
+            self._push()
+            os.rename(os.path.join(self.root, "d0/f3"),
+                      os.path.join(self.root, "d0/moved"))
+            transaction = LocalSnapshot(self.root).push_to(
+                AliOssSnapshot("fake-endpoint", "fake-bucket"))
+            transaction.get_jobs()
+            self.assertEqual([(j.action, j.src) for j in transaction.jobs],
+                             [("move", "d0/f3")])
+
+            # replaced after planned
+            bucket.put_object("d0/f3", b"changed")
+            with self.assertRaises(SystemExit):
+                transaction.start()
+            job = transaction.jobs[0]
+            self.assertEqual((job.status, job.info),
+                             ("failed", "source changed"))
+            self.assertEqual(bucket.objects["d0/f3"].data, b"changed")
+            self.assertNotIn("d0/moved", bucket.objects)
+
+    def test_dedup(self):
+        for i in range(3):
+            shutil.copy(os.path.join(self.root, "d1/f10"),
+                        os.path.join(self.root, "d0/copy%s" % i))
+
+        with fake_oss.install() as bucket:
+            transaction = self._push()
+            jobs = {j.target: j for j in transaction.jobs}
+            self.assertEqual(
+                [(jobs[k].action, jobs[k].src) for k in
+                 ("d0/copy0", "d0/copy1", "d0/copy2", "d1/f10")],
+                [("push", os.path.join(self.root, "d0/copy0"))] +
+                [("copy", "d0/copy0")] * 3)
+            self.assertIn("saved: %s bytes" % (3*1024*100), str(transaction))
+            objects = self._objects(bucket)
+            self.assertEqual(objects["d0/copy0"].data,
+                             objects["d1/f10"].data)
+
+            # copied from the object already there
+            shutil.copy(os.path.join(self.root, "d1/f10"),
+                        os.path.join(self.root, "d2/copy"))
+            transaction = self._push()
+            self.assertEqual([(j.action, j.src) for j in transaction.jobs],
+                             [("copy", "d0/copy0")])
+
+    def test_copy_source_failed(self):
+        path = os.path.join(self.root, "d1/f10")
+        with fake_oss.install() as bucket:
+            self._push()
+            old = bucket.objects["d1/f10"].data
+            with open(path, "wb") as f:
+                f.write(os.urandom(1024*100))
+            shutil.copy(path, os.path.join(self.root, "d2/copy"))
+
+            with mock.patch.object(Local2AliOssTransaction, "_upload",
+                                   side_effect=utils.JobError):
+                transaction = self._push()
+            jobs = {j.target: j for j in transaction.jobs}
+            self.assertEqual(jobs["d1/f10"].status, "failed")
+            self.assertEqual((jobs["d2/copy"].action, jobs["d2/copy"].src,
+                              jobs["d2/copy"].status, jobs["d2/copy"].info),
+                             ("copy", "d1/f10", "canceled",
+                              "source not pushed"))
+            self.assertNotIn("d2/copy", bucket.objects)
+            self.assertEqual(bucket.objects["d1/f10"].data, old)
+
+            # the old object is not copied as of the file
+            with self.assertRaises(utils.JobError):
+                transaction._do(jobs["d2/copy"])
+            self.assertEqual(jobs["d2/copy"].info, "source changed")
+            self.assertNotIn("d2/copy", bucket.objects)
+
+            self._push()
+            with open(path, "rb") as f:
+                self.assertEqual(bucket.objects["d2/copy"].data, f.read())
+
+    def test_pipeline(self):
+        for i in range(3):
+            shutil.copy(os.path.join(self.root, "d1/f10"),
+                        os.path.join(self.root, "d0/copy%s" % i))
+
+        self.config.pipeline = True
+        # files hashed by the plan would be cached, and pushed after the diff
+        self.config.hash_cache = False
+        try:
+            with fake_oss.install() as bucket:
+                # a plan only dumped pushes nothing
+                Metrics().reset()
+                self._cli(self.root, "alioss://fake-endpoint/fake-bucket")
+                self.assertFalse(self._objects(bucket))
+                self.assertNotIn("pipeline", Metrics().phases)
+
+                # nor does printing a dump saved before its jobs are planned
+                transaction = LocalSnapshot(self.root).push_to(
+                    AliOssSnapshot("fake-endpoint", "fake-bucket"))
+                transaction.dump()
+                with mock.patch.object(sys, "stdout", io.StringIO()) as out:
+                    self._cli(transaction.dump_path)
+                self.assertIn("ready: 23", out.getvalue())
+                self.assertFalse(self._objects(bucket))
+
+                # contents pushed while hashing, only copies left to run
+                started = []
+
+                def start(transaction):
+                    started.append((transaction, transaction.run()))
+
+                with mock.patch.object(Transaction, "start", start):
+                    self._cli("-i", self.root,
+                              "alioss://fake-endpoint/fake-bucket")
+                transaction, result = started[0]
+                self.assertEqual(result, (3, 0, 0))
+                self.assertIn("pipeline", Metrics().phases)
+
+                actions = sorted(j.action for j in transaction.jobs)
+                self.assertEqual(actions, ["copy"] * 3 + ["push"] * 20)
+                objects = self._objects(bucket)
+                self.assertEqual(len(objects), 23)
+                for job in transaction.jobs:
+                    self.assertEqual(job.status, "finished")
+                    with open(os.path.join(self.root, job.target),
+                              "rb") as f:
+                        self.assertEqual(objects[job.target].data, f.read())
+                self.assertEqual(len(self._push()), 0)
+        finally:
+            self.config.pipeline = False
+            self.config.hash_cache = True
+
+    def test_filter(self):
+        with fake_oss.install() as bucket:
+            self._push()
+            for i in range(10):
+                bucket._store("d1/tmp/%s" % i, None, 0, "0" * 32, {})
+            bucket.requests.clear()
+            self.config.filters = ["d1/tmp/", "*9"]
+            self.config.manifest = False
+            try:
+                with mock.patch.object(AliOssSnapshot, "skip_ahead", 3):
+                    alioss_snapshot = AliOssSnapshot(
+                        "fake-endpoint", "fake-bucket")
+                self.assertEqual(len(alioss_snapshot.files), 18)
+                self.assertFalse([f for f in alioss_snapshot.files
+                                  if f.path.startswith("d1/tmp/")])
+                # the rest of d1/tmp is not listed
+                self.assertEqual(bucket.requests["list_objects"], 5)
+            finally:
+                self.config.filters = []
+                self.config.manifest = True
+
+    def test_download(self):
+        with fake_oss.install() as bucket:
+            self._push()
+            restored = tempfile.mkdtemp()
+            try:
+                with open(os.path.join(restored, "extra"), "w") as f:
+                    f.write("not in the bucket")
+                # the part of d0/f12, 147456 bytes, is broken once
+                get_object = bucket.get_object
+
+                def fail_once(key, byte_range=None, headers=None):
+                    result = get_object(key, byte_range, headers)
+                    if byte_range == (102400, 147455) and not failed:
+                        failed.append(key)
+                        result.read = mock.Mock(
+                            side_effect=ConnectionResetError())
+                    return result
+
+                failed = []
+                # parts in order, the first one is done before the failure
+                with mock.patch.object(bucket, "get_object", fail_once), \
+                        mock.patch.object(self.config, "num_threads", 1):
+                    transaction = self._download(restored)
+                self.assertEqual(failed, ["d0/f12"])
+                self.assertEqual([j.target for j in transaction.jobs
+                                  if j.status == "failed"],
+                                 [os.path.join(restored, "d0/f12")])
+
+                # only the part failed is got again, with the generation
+                # and the manifest
+                bucket.requests.clear()
+                transaction = self._download(restored)
+                self.assertEqual(bucket.requests, {"head_object": 1,
+                                                   "get_object": 3})
+                for path in ("d0/f12", "d1/f1", "d2/f2"):
+                    with open(os.path.join(self.root, path), "rb") as f, \
+                            open(os.path.join(restored, path), "rb") as g:
+                        self.assertEqual(f.read(), g.read())
+                    self.assertAlmostEqual(
+                        os.stat(os.path.join(self.root, path)).st_mtime,
+                        os.stat(os.path.join(restored, path)).st_mtime,
+                        places=5)
+                self.assertFalse(os.path.exists(os.path.join(restored,
+                                                             "extra")))
+                self.assertEqual(len(self._download(restored)), 0)
+
+                # md5 of meta not matched
+                bucket.objects["d1/f4"].data = b"broken"
+                os.remove(os.path.join(restored, "d1/f4"))
+                transaction = self._download(restored)
+                self.assertEqual([j.info for j in transaction.jobs],
+                                 ["md5 mismatch"])
+                self.assertEqual(os.listdir(os.path.join(restored, "d1")),
+                                 [f for f in os.listdir(
+                                     os.path.join(self.root, "d1"))
+                                  if f != "f4"])
+            finally:
+                shutil.rmtree(restored)
+
+    def test_folder_marker(self):
+        self.config.manifest = False
+        restored = tempfile.mkdtemp()
+        try:
+            with fake_oss.install() as bucket:
+                self._push()
+                # made by the console
+                for key in ("d1/", "photos/"):
+                    bucket.put_object(key, b"")
+
+                transaction = self._download(restored)
+                self.assertEqual(len(transaction), 20)
+                self.assertEqual({j.status for j in transaction.jobs},
+                                 {"finished"})
+                self.assertEqual(sorted(os.listdir(restored)),
+                                 ["d0", "d1", "d2"])
+                # neither removed by a push
+                self.assertEqual(len(self._push()), 0)
+        finally:
+            self.config.manifest = True
+            shutil.rmtree(restored)
+
+    def test_compress(self):
+        text = b"".join(b"2017-08-19 21:50:%02d INFO line %d\n" % (i % 60, i)
+                        for i in range(5000))
+        for name in ("a.log", "b.dat", "c.log"):
+            with open(os.path.join(self.root, name), "wb") as f:
+                f.write(text if name != "c.log" else text + b"c")
+        shutil.copy(os.path.join(self.root, "a.log"),
+                    os.path.join(self.root, "d0/copy.log"))
+
+        self.config.compress = True
+        self.config.manifest = False
+        restored = tempfile.mkdtemp()
+        try:
+            with fake_oss.install() as bucket:
+                self._push()
+                objects = self._objects(bucket)
+                for key in ("a.log", "b.dat", "d0/copy.log"):
+                    obj = objects[key]
+                    self.assertEqual(obj.headers["x-oss-meta-compress"],
+                                     "gzip")
+                    self.assertEqual(obj.headers["x-oss-meta-size"],
+                                     str(len(text)))
+                    self.assertLess(obj.size, len(text) / 10)
+                    self.assertEqual(gzip.decompress(obj.data), text)
+                # random data, not compressed
+                self.assertNotIn("x-oss-meta-compress",
+                                 objects["d1/f10"].headers)
+
+                # compared as the files
+                self.assertEqual(len(self._push()), 0)
+                self.config.compare = "fast"
+                self.assertEqual(len(self._push()), 0)
+
+                self._download(restored)
+                for name in ("a.log", "b.dat", "c.log", "d0/copy.log",
+                             "d1/f10"):
+                    with open(os.path.join(self.root, name), "rb") as f, \
+                            open(os.path.join(restored, name), "rb") as g:
+                        self.assertEqual(f.read(), g.read())
+        finally:
+            self.config.compress = False
+            self.config.manifest = True
+            self.config.compare = "md5"
+            shutil.rmtree(restored)
+
+    def test_delta_upload(self):
+        path = os.path.join(self.root, "d1/f19")
+        self.config.delta_upload = True
+        try:
+            with fake_oss.install() as bucket:
+                self._push()
+                self.assertNotIn("upload_part_copy", bucket.requests)
+
+                with open(path, "ab") as f:
+                    f.write(os.urandom(1000))
+                bucket.requests.clear()
+                self.assertEqual(len(self._push()), 1)
+                self.assertEqual(bucket.requests["upload_part_copy"], 3)
+                self.assertEqual(bucket.requests["upload_part"], 1)
+                with open(path, "rb") as f:
+                    self.assertEqual(bucket.objects["d1/f19"].data, f.read())
+                self.assertEqual(Metrics().get("delta_bytes_saved"),
+                                 3 * self.config.multipart_threshold)
+
+                # the sidecar of another etag is not taken
+                with open(path, "r+b") as f:
+                    f.write(os.urandom(10))
+                bucket.put_object(
+                    "d1/f19", bucket.objects["d1/f19"].data + b"x")
+                bucket.requests.clear()
+                self._push()
+                self.assertNotIn("upload_part_copy", bucket.requests)
+                self.assertEqual(bucket.requests["upload_part"], 4)
+
+                # the sidecar goes with its object
+                sidecar = ".foxy_sync/parts/d1/%s.json"
+                self.assertIn(sidecar % "f19", bucket.objects)
+                moved = os.path.join(self.root, "d1/f19m")
+                os.rename(path, moved)
+                self.assertEqual(len(self._push()), 1)
+                self.assertNotIn(sidecar % "f19", bucket.objects)
+
+                with open(moved, "ab") as f:
+                    f.write(os.urandom(1000))
+                self._push()
+                self.assertIn(sidecar % "f19m", bucket.objects)
+                os.remove(moved)
+                self.assertEqual(len(self._push()), 1)
+                self.assertNotIn(sidecar % "f19m", bucket.objects)
+        finally:
+            self.config.delta_upload = False
+
+    def _download(self, local_dir):
+        alioss_snapshot = AliOssSnapshot("fake-endpoint", "fake-bucket")
+        transaction = alioss_snapshot.push_to(LocalSnapshot(local_dir))
+        transaction.get_jobs()
+        if transaction.jobs:
+            with self.assertRaises(SystemExit):
+                transaction.start()
+        return transaction
+
+    def test_fast_compare(self):
+        with fake_oss.install() as bucket:
+            self._push()
+            for obj in self._objects(bucket).values():
+                self.assertIn("x-oss-meta-mtime", obj.headers)
+
+            self.config.compare = "fast"
+            try:
+                # unchanged files are not hashed
+                with mock.patch.object(utils, "get_md5") as get_md5:
+                    self.assertEqual(len(self._push()), 0)
+                    self.assertFalse(get_md5.called)
+
+                # touched only, hashed but not pushed, and its mtime kept
+                for path in ("d1/f1", "d1/f16"):
+                    os.utime(os.path.join(self.root, path), (0, 0))
+                bucket.requests.clear()
+                with mock.patch("oss2.resumable_upload") as upload:
+                    transaction = self._push()
+                    self.assertFalse(upload.called)
+                self.assertEqual(
+                    sorted((j.action, j.src, j.target, j.status)
+                           for j in transaction.jobs),
+                    [("copy", p, p, "finished") for p in ("d1/f1", "d1/f16")])
+                self.assertNotIn("saved:", str(transaction))
+                self.assertNotIn("upload_part", bucket.requests)
+                for path in ("d1/f1", "d1/f16"):
+                    with open(os.path.join(self.root, path), "rb") as f:
+                        self.assertEqual(bucket.objects[path].data, f.read())
+                    self.assertEqual(
+                        bucket.objects[path].headers["x-oss-meta-mtime"],
+                        "0.0")
+                with mock.patch.object(utils, "get_md5") as get_md5:
+                    self.assertEqual(len(self._push()), 0)
+                    self.assertFalse(get_md5.called)
+
+                with open(os.path.join(self.root, "d2/f2"), "wb") as f:
+                    f.write(b"changed")
+                transaction = self._push()
+                self.assertEqual([j.target for j in transaction.jobs],
+                                 ["d2/f2"])
+            finally:
+                self.config.compare = "md5"
+
+    def test_manifest(self):
+        with fake_oss.install() as bucket:
+            self._push(prefix="backup")
+            self.assertIn("backup/.foxy_sync/manifest.gz", bucket.objects)
+            local_snapshot = LocalSnapshot(self.root)
+            local_snapshot.load_detail(md5=True, mtime=True)
+
+            # loaded from the manifest, without listing or HEAD
+            bucket.requests.clear()
+            alioss_snapshot = AliOssSnapshot("fake-endpoint", "fake-bucket",
+                                             prefix="backup")
+            alioss_snapshot.load_detail(md5=True, mtime=True)
+            self.assertTrue(alioss_snapshot.manifest_fresh)
+            self.assertEqual(bucket.requests, {"get_object": 2})
+            self.assertEqual(list(local_snapshot.iter_diff(alioss_snapshot)),
+                             [])
+
+            # stale after the bucket is modified
+            alioss_snapshot.invalidate_manifest()
+            bucket.requests.clear()
+            alioss_snapshot = AliOssSnapshot("fake-endpoint", "fake-bucket",
+                                             prefix="backup")
+            self.assertFalse(alioss_snapshot.manifest_fresh)
+            self.assertEqual(len(alioss_snapshot), 20)
+            self.assertTrue(bucket.requests["list_objects"] > 0)
+
+            # reconciled, only objects differing from the manifest are HEAD
+            bucket.put_object("backup/d0/f0", b"changed")
+            self.config.manifest_reconcile = True
+            try:
+                bucket.requests.clear()
+                alioss_snapshot = AliOssSnapshot(
+                    "fake-endpoint", "fake-bucket", prefix="backup")
+                alioss_snapshot.load_detail(md5=True, mtime=True)
+            finally:
+                self.config.manifest_reconcile = False
+            self.assertEqual(bucket.requests["head_object"], 1)
+            self.assertEqual(
+                [(kind, mine.path) for kind, mine, _ in
+                 local_snapshot.iter_diff(alioss_snapshot)],
+                [(CHANGED, "d0/f0")])
+
+    def test_manifest_mtime(self):
+        with fake_oss.install() as bucket:
+            self._push()
+            with open(os.path.join(self.root, "d2/f2"), "wb") as f:
+                f.write(b"changed")
+            self.assertEqual(len(self._push()), 1)
+
+            # files not pushed keep the mtime of the manifest
+            lines = gzip.decompress(
+                bucket.objects[".foxy_sync/manifest.gz"].data).splitlines()
+            entries = [json.loads(line) for line in lines[1:]]
+            self.assertEqual(len(entries), 20)
+            self.assertNotIn(None, [e[3] for e in entries])
+
+            self.config.compare = "fast"
+            try:
+                bucket.requests.clear()
+                self.assertEqual(len(self._push()), 0)
+                self.assertNotIn("head_object", bucket.requests)
+            finally:
+                self.config.compare = "md5"
+
+    def test_manifest_outdated(self):
+        with fake_oss.install():
+            self._push()
+            with open(os.path.join(self.root, "d2/f2"), "wb") as f:
+                f.write(b"changed")
+            # planned, and another run finishes before it is run
+            transaction = LocalSnapshot(self.root).push_to(
+                AliOssSnapshot("fake-endpoint", "fake-bucket"))
+            transaction.get_jobs()
+            with open(os.path.join(self.root, "d1/f1"), "wb") as f:
+                f.write(b"newer")
+            self.assertEqual(len(self._push()), 2)
+            self.assertTrue(AliOssSnapshot("fake-endpoint",
+                                           "fake-bucket").manifest_fresh)
+
+            with self.assertRaises(SystemExit):
+                transaction.start()
+            self.assertFalse(AliOssSnapshot("fake-endpoint",
+                                            "fake-bucket").manifest_fresh)
+            self.assertEqual(len(self._push()), 0)
+
+    def test_watch(self):
+        with fake_oss.install() as bucket:
+            watcher = Watcher(self.root, AliOssSnapshot(
+                "fake-endpoint", "fake-bucket", prefix="backup"))
+            watcher.setup()
+            self.assertEqual(len(self._objects(bucket)), 20)
+
+            try:
+                os.remove(os.path.join(self.root, "d0/f0"))
+                with open(os.path.join(self.root, "d1/f1"), "wb") as f:
+                    f.write(b"changed")
+                os.makedirs(os.path.join(self.root, "d3/sub"))
+                with open(os.path.join(self.root, "d3/sub/new"), "wb") as f:
+                    f.write(b"new")
+                os.rename(os.path.join(self.root, "d2"),
+                          os.path.join(self.root, "moved"))
+
+                bucket.requests.clear()
+                # hashed with the cache kept by the watcher
+                with mock.patch.object(utils, "HashCache") as hash_cache:
+                    watcher.read(1)
+                    watcher.flush()
+                self.assertFalse(hash_cache.called)
+                self.assertNotIn("list_objects", bucket.requests)
+                objects = self._objects(bucket)
+                self.assertNotIn("backup/d0/f0", objects)
+                self.assertEqual(objects["backup/d1/f1"].data, b"changed")
+                self.assertIn("backup/d3/sub/new", objects)
+                self.assertFalse([k for k in objects if "/d2/" in k])
+                self.assertEqual(len([k for k in objects if "/moved/" in k]),
+                                 6)
+
+                # the manifest is written on time, with no more event
+                self.assertTrue(watcher._changed)
+                start = time.time()
+                with mock.patch.object(Watcher, "manifest_interval", 0.1):
+                    watcher.step(timeout=5)
+                self.assertLess(time.time() - start, 1)
+                self.assertTrue(AliOssSnapshot(
+                    "fake-endpoint", "fake-bucket",
+                    prefix="backup").manifest_fresh)
+
+                # changes lost are found by scanning again
+                with open(os.path.join(self.root, "d1/f4"), "wb") as f:
+                    f.write(b"lost")
+                watcher.rescan()
+                self.assertEqual(bucket.objects["backup/d1/f4"].data, b"lost")
+                self.assertEqual(len(watcher.state), 20)
+                self.assertFalse([f for f in os.listdir(self.config.cache_dir)
+                                  if f.endswith(".ts")])
+
+                # files removed while hashed are removed
+                changed = os.path.join(self.root, "d1/f7")
+                with open(changed, "wb") as f:
+                    f.write(b"changed")
+                with open(os.path.join(self.root, "d1/gone"), "wb") as f:
+                    f.write(b"gone")
+                watcher.read(1)
+                load_md5 = LocalSnapshot.load_md5
+
+                def remove_first(snapshot, files, cache=None):
+                    for path in ("d1/f7", "d1/gone"):
+                        path = os.path.join(self.root, path)
+                        if os.path.exists(path):
+                            os.remove(path)
+                    load_md5(snapshot, files, cache)
+
+                with mock.patch.object(LocalSnapshot, "load_md5",
+                                       remove_first):
+                    watcher.flush()
+                self.assertNotIn("backup/d1/f7", bucket.objects)
+                self.assertNotIn("backup/d1/gone", bucket.objects)
+                self.assertNotIn("d1/f7", watcher.state)
+                watcher.read(1)
+                watcher._pending.clear()
+
+                # pushed again after an error
+                with open(changed, "wb") as f:
+                    f.write(b"again")
+                watcher.read(1)
+                with mock.patch("foxy_sync.watch._DeltaTransaction._begin",
+                                side_effect=OSError("connection reset")):
+                    watcher.flush()
+                self.assertEqual(watcher._pending, {"d1/f7"})
+                self.assertNotIn("backup/d1/f7", bucket.objects)
+                watcher.flush()
+                self.assertEqual(bucket.objects["backup/d1/f7"].data,
+                                 b"again")
+
+                with mock.patch.object(LocalSnapshot, "load_md5",
+                                       side_effect=OSError("disk error")):
+                    watcher.rescan()
+                self.assertTrue(watcher._scan_failed)
+                watcher.rescan()
+                self.assertFalse(watcher._scan_failed)
+            finally:
+                watcher._inotify.close()
+
+    def test_journal(self):
+        with fake_oss.install():
+            local_snapshot = LocalSnapshot(self.root)
+            alioss_snapshot = AliOssSnapshot("fake-endpoint", "fake-bucket")
+            transaction = local_snapshot.push_to(alioss_snapshot)
+            transaction.get_jobs()
+            transaction.dump()
+
+            # killed after two jobs, without dump
+            journal = _Journal(transaction)
+            for job in transaction.jobs[:2]:
+                job.status = _Job.FINISHED
+                job.etag = "ETAG-" + job.target
+                journal.record(job)
+            journal.close()
+            with open(journal.path, "a") as f:
+                # a line of the logs before the etag was kept
+                f.write('[2, "failed", "error"]\n[3, "fini')
+
+            ts = Transaction.load(transaction.dump_path)
+            self.assertEqual([j.status for j in ts.jobs[:4]],
+                             [_Job.FINISHED, _Job.FINISHED, _Job.FAILED,
+                              _Job.READY])
+            self.assertEqual([j.etag for j in ts.jobs[:3]],
+                             ["ETAG-" + j.target for j in ts.jobs[:2]] +
+                             [None])
+            jobs = list(Transaction.iter_jobs(transaction.dump_path))
+            self.assertEqual([j.etag for j in jobs[:2]],
+                             ["ETAG-" + j.target for j in ts.jobs[:2]])
+            self.assertEqual(ts.changes()[ts.jobs[0].target][3],
+                             "ETAG-" + ts.jobs[0].target)
+
+            # resumed run skips finished jobs
+            pushed = []
+            with mock.patch.object(Local2AliOssTransaction, "_do",
+                                   lambda self, job: pushed.append(job.target)):
+                with self.assertRaises(SystemExit):
+                    ts.start()
+            self.assertEqual(sorted(pushed),
+                             sorted(j.target for j in ts.jobs[2:]))
+            self.assertFalse(os.path.exists(journal.path))
+
+    def test_pre_series_dump(self):
+        # pickled by the code before the record dumps and the etag of jobs
+        path = os.path.join(os.path.dirname(__file__), "pre_series.ts")
+        with fake_oss.install() as bucket:
+            bucket.put_object("old/x", b"")
+            ts = Transaction.load(path)
+            self.assertEqual([j.etag for j in ts.jobs], [None] * 3)
+
+            ts.src_snapshot.root = self.root
+            for job in ts.jobs:
+                if job.src is not None:
+                    job.src = os.path.join(self.root, "d1/f1")
+                    job.md5 = utils.get_md5(job.src)
+                    job.size = os.path.getsize(job.src)
+            self.assertEqual(ts.run(), (3, 0, 0))
+            self.assertNotIn("old/x", bucket.objects)
+            self.assertIn("old/d/b", bucket.objects)
+
+            self.assertEqual(Transaction.load(ts.dump_path), ts)
+            self.assertEqual([j.status for j in Transaction.iter_jobs(
+                ts.dump_path)], [_Job.FINISHED] * 3)
+
+    def test_dump(self):
+        with fake_oss.install():
+            local_snapshot = LocalSnapshot(self.root)
+            alioss_snapshot = AliOssSnapshot("fake-endpoint", "fake-bucket")
+            transaction = local_snapshot.push_to(alioss_snapshot)
+            transaction.get_jobs()
+            transaction.dump()
+            with open(transaction.dump_path, "rb") as f:
+                dump = f.read()
+            ts = Transaction.load(transaction.dump_path)
+            self.assertEqual(ts, transaction)
+            self.assertEqual(len(ts.target_snapshot.files),
+                             len(alioss_snapshot.files))
+
+            # compacted in place
+            journal = _Journal(transaction)
+            jobs = transaction.jobs
+            jobs[0].status = _Job.FINISHED
+            jobs[0].etag = '"%s"' % jobs[0].md5
+            jobs[1].status = _Job.FAILED
+            jobs[1].info = "x" * 1000
+            for job in jobs[:2]:
+                journal.record(job)
+            journal.compact()
+            journal.close()
+            with open(transaction.dump_path, "rb") as f:
+                self.assertEqual(len(f.read()), len(dump))
+            self.assertFalse(os.path.getsize(journal.path))
+
+            ts = Transaction.load(transaction.dump_path)
+            self.assertEqual(ts.jobs[0], jobs[0])
+            self.assertTrue(ts.jobs[1].info.endswith("..."))
+            self.assertEqual(ts.jobs[2:], jobs[2:])
+
+            # read lazily, with the journal
+            jobs[2].status = _Job.FINISHED
+            journal = _Journal(transaction)
+            journal.record(jobs[2])
+            journal.close()
+            self.assertEqual([j.status for j in Transaction.iter_jobs(
+                transaction.dump_path)], [j.status for j in jobs])
+
+            f = io.StringIO()
+            Transaction.write_jobs(f, Transaction.iter_jobs(
+                transaction.dump_path), status=_Job.FINISHED)
+            lines = f.getvalue().splitlines()
+            self.assertEqual(len(lines), 3)
+            self.assertIn("failed: 1  finished: 2  ready: %s" %
+                          (len(jobs) - 3), lines[-1])
+
+            # dumps of the pickle before
+            with open(transaction.dump_path, "wb") as f:
+                pickle.dump(transaction, f)
+            self.assertEqual(Transaction.load(transaction.dump_path),
+                             transaction)
+            self.assertEqual(list(Transaction.iter_jobs(
+                transaction.dump_path)), jobs)
+
 
 class CaseTrans(unittest.TestCase):
 
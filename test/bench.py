@@ -0,0 +1,274 @@
+"""Benchmarks, run with:
+
+    python -m test.bench memory [-n 1000000]
+    python -m test.bench filter [-n 1000000]
+    python -m test.bench e2e [--sizes 1000,10000,100000,1000000]
+"""
+
+import os
+import json
+import time
+import pickle
+import shutil
+import hashlib
+import logging
+import fnmatch
+import argparse
+import tempfile
+import subprocess
+import tracemalloc
+import contextlib
+
+from foxy_sync import utils
+from foxy_sync.filters import PathFilter
+from foxy_sync.snapshot import FileTable, LocalSnapshot, AliOssSnapshot
+from foxy_sync.transaction import Transaction
+from . import fake_oss
+
+
+class _DictIdentity:
+    """file identity before FileTable, one object with __dict__ per file."""
+
+    def __init__(self, path, md5=None, mtime=None, prefix=''):
+        self.path = path
+        self.md5 = md5
+        self.mtime = mtime
+        self.prefix = prefix
+
+    def __hash__(self):
+        return hash((self.path, self.md5, self.mtime))
+
+
+def _synthetic_files(n, files_per_dir=100):
+    for i in range(n):
+        path = "dir%04d/sub%03d/file%07d.dat" % (
+            i // (files_per_dir*100), i // files_per_dir % 100, i)
+        md5 = hashlib.md5(path.encode()).hexdigest().upper()
+        yield path, md5, 1500000000.0 + i
+
+
+def _measure(build):
+    tracemalloc.start()
+    data = build()
+    memory = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+    return memory, len(pickle.dumps(data, protocol=pickle.HIGHEST_PROTOCOL))
+
+
+def bench_memory(n):
+    def build_dict():
+        files = [_DictIdentity(path, md5, mtime)
+                 for path, md5, mtime in _synthetic_files(n)]
+        # held twice, as files and _frozen_files
+        return files, set(files)
+
+    def build_table():
+        table = FileTable()
+        for path, md5, mtime in _synthetic_files(n):
+            table.append(path, md5=md5, mtime=mtime)
+        return table
+
+    print("%s files" % n)
+    for name, build in (("dict identities", build_dict),
+                        ("file table", build_table)):
+        memory, pickled = _measure(build)
+        print("%-16s memory: %8.1f MB  pickled: %8.1f MB"
+              % (name, memory/1024/1024, pickled/1024/1024))
+
+
+def bench_filter(n, rules=20):
+    """match keys with the compiled filter, and with the loop of fnmatch
+    over skip_dir it replaced, which only saw the directory of a key."""
+    skip_dir = ["*/skip%02d" % i for i in range(rules)]
+    paths = [path for path, _, _ in _synthetic_files(n)]
+
+    def fnmatch_loop():
+        for path in paths:
+            directory = os.path.dirname(path)
+            for p in skip_dir:
+                if fnmatch.fnmatch(directory, p):
+                    break
+
+    def compiled():
+        path_filter = PathFilter(skip_dir=skip_dir)
+        for path in paths:
+            path_filter.excluded(path)
+
+    print("%s keys, %s patterns" % (n, rules))
+    for name, match in (("fnmatch loop", fnmatch_loop),
+                        ("path filter", compiled)):
+        start = time.perf_counter()
+        match()
+        print("%-16s %8.3fs" % (name, time.perf_counter() - start))
+
+
+PHASES = ("scan", "hash", "list", "diff", "plan", "dump", "load", "print",
+          "execute")
+
+
+def _make_tree(root, n, file_size, files_per_dir=100):
+    for i in range(n):
+        directory = os.path.join(root, "d%03d" % (i // (files_per_dir*100)),
+                                 "s%03d" % (i // files_per_dir % 100))
+        if i % files_per_dir == 0:
+            os.makedirs(directory, exist_ok=True)
+        with open(os.path.join(directory, "f%07d" % i), "wb") as f:
+            f.write(i.to_bytes(8, "big") * (file_size // 8))
+
+
+def _fill_bucket(bucket, local_snapshot):
+    """half of the files already pushed, a tenth changed, and some extra
+    keys to be removed."""
+    for i, f_id in enumerate(local_snapshot.files):
+        if i % 2 == 0:
+            md5 = f_id.md5 if i % 10 else "0" * 32
+            bucket._store(f_id.path, None, f_id.size, md5, {})
+        if i % 20 == 0:
+            bucket._store(f_id.path + ".old", None, 0, "0" * 32, {})
+
+
+class _Timer:
+
+    def __init__(self):
+        self.result = {}
+
+    @contextlib.contextmanager
+    def __call__(self, phase):
+        start = time.perf_counter()
+        yield
+        self.result[phase] = round(time.perf_counter() - start, 4)
+
+
+def bench_e2e(n, file_size, latency, bandwidth):
+    """time every phase of a sync from a synthetic tree to a fake bucket."""
+    config = utils.Config()
+    saved = config.cache_dir
+    config.cache_dir = tempfile.mkdtemp()
+    root = tempfile.mkdtemp()
+    timer = _Timer()
+
+    try:
+        _make_tree(root, n, file_size)
+        bucket = fake_oss.FakeBucket(keep_data=False)
+
+        with fake_oss.install(bucket):
+            with timer("scan"):
+                local_snapshot = LocalSnapshot(root)
+            with timer("hash"):
+                local_snapshot.load_detail(md5=True)
+
+            _fill_bucket(bucket, local_snapshot)
+            bucket.latency, bucket.bandwidth = latency, bandwidth
+
+            with timer("list"):
+                alioss_snapshot = AliOssSnapshot("fake-endpoint",
+                                                 "fake-bucket")
+                alioss_snapshot.load_detail(md5=True)
+            with timer("diff"):
+                for _ in local_snapshot.iter_diff(alioss_snapshot):
+                    pass
+            transaction = local_snapshot.push_to(alioss_snapshot)
+            with timer("plan"):
+                transaction.get_jobs()
+            with timer("dump"):
+                transaction.dump()
+            with timer("load"):
+                Transaction.load(transaction.dump_path)
+            with timer("print"), open(os.devnull, "w") as f:
+                Transaction.write_jobs(f, Transaction.iter_jobs(
+                    transaction.dump_path))
+            with timer("execute"):
+                try:
+                    transaction.start()
+                except SystemExit:
+                    pass
+    finally:
+        shutil.rmtree(root)
+        shutil.rmtree(config.cache_dir)
+        config.cache_dir = saved
+
+    return timer.result
+
+
+def _revision():
+    try:
+        return subprocess.check_output(
+            ["git", "rev-parse", "--short", "HEAD"],
+            stderr=subprocess.DEVNULL).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def _load_results(path):
+    if not os.path.exists(path):
+        return []
+    with open(path) as f:
+        return [json.loads(line) for line in f if line.strip()]
+
+
+def run_e2e(args):
+    history = _load_results(args.output)
+    logging.disable(logging.INFO)
+
+    for n in [int(size) for size in args.sizes.split(",")]:
+        result = bench_e2e(n, args.file_size, args.latency, args.bandwidth)
+        record = {"time": time.strftime("%Y-%m-%d %H:%M:%S"),
+                  "revision": _revision(), "files": n,
+                  "file_size": args.file_size, "latency": args.latency,
+                  "bandwidth": args.bandwidth, "phases": result}
+
+        previous = [r for r in history
+                    if all(r.get(k) == record[k] for k in
+                           ("files", "file_size", "latency", "bandwidth"))]
+        previous = previous[-1]["phases"] if previous else {}
+
+        print("%s files" % n)
+        for phase in PHASES:
+            line = "    %-8s %9.3fs" % (phase, result[phase])
+            if previous.get(phase):
+                ratio = result[phase] / previous[phase]
+                line += "  %5.2fx" % ratio
+                if ratio > 1 + args.threshold:
+                    line += "  REGRESSION"
+            print(line)
+
+        with open(args.output, "a") as f:
+            f.write(json.dumps(record) + "\n")
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    sub = parser.add_subparsers(dest="bench")
+    memory = sub.add_parser("memory", help="memory of snapshot files")
+    memory.add_argument("-n", type=int, default=1000000)
+
+    path_filter = sub.add_parser("filter", help="matching of skip rules")
+    path_filter.add_argument("-n", type=int, default=1000000)
+
+    e2e = sub.add_parser("e2e", help="phases of a sync to a fake bucket")
+    e2e.add_argument("--sizes", default="1000,10000",
+                     help="numbers of files, separated by comma")
+    e2e.add_argument("--file-size", type=int, default=1024)
+    e2e.add_argument("--latency", type=float, default=0,
+                     help="seconds of each request")
+    e2e.add_argument("--bandwidth", type=int, default=0,
+                     help="bytes per second, 0 means no limit")
+    e2e.add_argument("--output", default="bench_results.jsonl",
+                     help="results are appended and compared to the last "
+                          "run of the same arguments")
+    e2e.add_argument("--threshold", type=float, default=0.2,
+                     help="slower than this ratio is reported as regression")
+    args = parser.parse_args()
+
+    if args.bench == "memory":
+        bench_memory(args.n)
+    elif args.bench == "filter":
+        bench_filter(args.n)
+    elif args.bench == "e2e":
+        run_e2e(args)
+    else:
+        parser.print_help()
+
+
+if __name__ == "__main__":
+    main()
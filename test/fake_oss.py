@@ -0,0 +1,282 @@
+"""An in-process stand-in of the oss2.Bucket interfaces used by foxy_sync, for
+tests and benchmarks without AliOss.
+
+    with fake_oss.install() as bucket:
+        alioss_snapshot = AliOssSnapshot("fake-endpoint", "fake-bucket")
+"""
+
+import io
+import time
+import base64
+import hashlib
+import threading
+import contextlib
+from types import SimpleNamespace
+
+import oss2
+from oss2.models import SimplifiedObjectInfo, PartInfo
+from oss2.http import CaseInsensitiveDict
+
+from foxy_sync import utils
+
+
+class _Object:
+
+    def __init__(self, data, size, etag, headers):
+        self.data = data
+        self.size = size
+        self.etag = etag
+        self.headers = headers
+        self.last_modified = int(time.time())
+
+
+class FakeBucket:
+    """Objects are kept in memory. If keep_data is False, data is dropped
+    except for small objects, such as the manifest generation.
+
+    :param latency: seconds slept by each request.
+    :param bandwidth: bytes per second of a data transfer, 0 means no limit.
+    """
+
+    small_size = 1024
+
+    def __init__(self, bucket_name="fake-bucket", latency=0, bandwidth=0,
+                 keep_data=True):
+        self.bucket_name = bucket_name
+        self.latency = latency
+        self.bandwidth = bandwidth
+        self.keep_data = keep_data
+        self.objects = {}
+        self.requests = {}
+        self.session = oss2.http.Session()
+        self._uploads = {}
+        self._upload_id = 0
+        self._lock = threading.Lock()
+
+    def put_object(self, key, data, headers=None, progress_callback=None):
+        self._request("put_object")
+        content = self._read(data)
+        if progress_callback is not None:
+            progress_callback(0, len(content))
+            progress_callback(len(content), len(content))
+        headers = CaseInsensitiveDict(headers)
+        md5 = hashlib.md5(content)
+
+        if "Content-MD5" in headers:
+            encode_md5 = base64.b64encode(md5.digest()).decode()
+            if encode_md5 != headers.pop("Content-MD5"):
+                raise oss2.exceptions.InvalidDigest(400, {}, b"", {})
+
+        etag = md5.hexdigest().upper()
+        self._store(key, content, len(content), etag, headers)
+        return SimpleNamespace(etag=etag, status=200)
+
+    def head_object(self, key, headers=None):
+        self._request("head_object")
+        obj = self._get(key)
+        headers = CaseInsensitiveDict(obj.headers)
+        headers.update({"ETag": '"%s"' % obj.etag,
+                        "Content-Length": str(obj.size)})
+        return SimpleNamespace(headers=headers, etag=obj.etag,
+                               content_length=obj.size,
+                               last_modified=obj.last_modified, status=200)
+
+    def get_object(self, key, byte_range=None, headers=None):
+        self._request("get_object")
+        obj = self._get(key)
+        if_match = (headers or {}).get("If-Match")
+        if if_match is not None and if_match != obj.etag:
+            raise oss2.exceptions.PreconditionFailed(412, {}, b"", {})
+
+        data = obj.data or b""
+        if byte_range is not None:
+            data = data[byte_range[0]:byte_range[1]+1]
+        result = io.BytesIO(self._read(data))
+        result.headers = CaseInsensitiveDict(obj.headers)
+        result.etag = obj.etag
+        result.content_length = len(data) if obj.data else obj.size
+        result.status = 200
+        return result
+
+    def delete_object(self, key):
+        self._request("delete_object")
+        with self._lock:
+            self.objects.pop(key, None)
+        return SimpleNamespace(status=204)
+
+    def batch_delete_objects(self, key_list):
+        self._request("batch_delete_objects")
+        with self._lock:
+            for key in key_list:
+                self.objects.pop(key, None)
+        # keys not found are reported deleted too
+        return SimpleNamespace(deleted_keys=list(key_list), status=200)
+
+    def list_objects(self, prefix='', delimiter='', marker='', max_keys=100):
+        self._request("list_objects")
+        with self._lock:
+            keys = sorted(k for k in self.objects
+                          if k.startswith(prefix) and k > marker)
+
+        object_list = []
+        prefix_list = []
+        next_marker = ''
+        is_truncated = False
+        for key in keys:
+            rest = key[len(prefix):]
+            common = None
+            if delimiter and delimiter in rest:
+                common = prefix + rest[:rest.index(delimiter)+1]
+                if prefix_list and prefix_list[-1] == common:
+                    next_marker = key
+                    continue
+
+            if len(object_list) + len(prefix_list) >= max_keys:
+                is_truncated = True
+                break
+
+            if common is not None:
+                prefix_list.append(common)
+            else:
+                obj = self.objects[key]
+                object_list.append(SimplifiedObjectInfo(
+                    key, obj.last_modified, obj.etag, "Normal", obj.size,
+                    "Standard"))
+            next_marker = key
+
+        return SimpleNamespace(object_list=object_list,
+                               prefix_list=prefix_list,
+                               is_truncated=is_truncated,
+                               next_marker=next_marker if is_truncated else '')
+
+    def copy_object(self, source_bucket_name, source_key, target_key,
+                    headers=None):
+        self._request("copy_object")
+        obj = self._get(source_key)
+        headers = CaseInsensitiveDict(headers)
+        if headers.pop("x-oss-metadata-directive", "COPY") == "COPY":
+            headers = obj.headers
+        self._store(target_key, obj.data, obj.size, obj.etag, headers)
+        return SimpleNamespace(etag=obj.etag, status=200)
+
+    def init_multipart_upload(self, key, headers=None):
+        self._request("init_multipart_upload")
+        headers = CaseInsensitiveDict(headers)
+        headers.pop("Content-MD5", None)
+        with self._lock:
+            self._upload_id += 1
+            upload_id = str(self._upload_id)
+            self._uploads[upload_id] = (key, headers, {})
+        return SimpleNamespace(upload_id=upload_id)
+
+    def upload_part(self, key, upload_id, part_number, data, headers=None):
+        self._request("upload_part")
+        content = self._read(data)
+        etag = hashlib.md5(content).hexdigest().upper()
+        parts = self._get_upload(upload_id)[2]
+        with self._lock:
+            parts[part_number] = (content, len(content), etag)
+        return SimpleNamespace(etag=etag, status=200)
+
+    def upload_part_copy(self, source_bucket_name, source_key, byte_range,
+                         target_key, target_upload_id, target_part_number,
+                         headers=None):
+        self._request("upload_part_copy")
+        obj = self._get(source_key)
+        start, end = byte_range
+        if obj.data is None:
+            content = None
+        else:
+            content = obj.data[start:end+1]
+        size = end + 1 - start
+        etag = hashlib.md5(content or b"").hexdigest().upper()
+        parts = self._get_upload(target_upload_id)[2]
+        with self._lock:
+            parts[target_part_number] = (content, size, etag)
+        return SimpleNamespace(etag=etag, status=200)
+
+    def abort_multipart_upload(self, key, upload_id):
+        self._request("abort_multipart_upload")
+        with self._lock:
+            self._uploads.pop(upload_id, None)
+        return SimpleNamespace(status=204)
+
+    def list_parts(self, key, upload_id, marker='', max_parts=1000):
+        self._request("list_parts")
+        parts = self._get_upload(upload_id)[2]
+        return SimpleNamespace(
+            parts=[PartInfo(n, parts[n][2], size=parts[n][1])
+                   for n in sorted(parts) if n > int(marker or 0)],
+            is_truncated=False, next_marker='')
+
+    def complete_multipart_upload(self, key, upload_id, parts, headers=None):
+        self._request("complete_multipart_upload")
+        _, upload_headers, uploaded = self._get_upload(upload_id)
+        numbers = sorted(p.part_number for p in parts)
+        if any(uploaded[n][0] is None for n in numbers):
+            content = None
+        else:
+            content = b"".join(uploaded[n][0] for n in numbers)
+        size = sum(uploaded[n][1] for n in numbers)
+        digest = hashlib.md5(b"".join(bytes.fromhex(uploaded[n][2])
+                                      for n in numbers))
+        etag = "%s-%s" % (digest.hexdigest().upper(), len(numbers))
+
+        self._store(key, content, size, etag, upload_headers)
+        with self._lock:
+            del self._uploads[upload_id]
+        return SimpleNamespace(etag=etag, status=200)
+
+    def _store(self, key, content, size, etag, headers):
+        with self._lock:
+            if not self.keep_data and size > self.small_size:
+                content = None
+            self.objects[key] = _Object(content, size, etag, headers)
+
+    def _get(self, key):
+        with self._lock:
+            obj = self.objects.get(key)
+        if obj is None:
+            raise oss2.exceptions.NoSuchKey(404, {}, b"", {})
+        return obj
+
+    def _get_upload(self, upload_id):
+        with self._lock:
+            upload = self._uploads.get(upload_id)
+        if upload is None:
+            raise oss2.exceptions.NoSuchUpload(404, {}, b"", {})
+        return upload
+
+    def _read(self, data):
+        if hasattr(data, "read"):
+            data = data.read()
+        if isinstance(data, str):
+            data = data.encode()
+        if self.bandwidth:
+            time.sleep(len(data) / self.bandwidth)
+        return data
+
+    def _request(self, name):
+        with self._lock:
+            self.requests[name] = self.requests.get(name, 0) + 1
+        if self.latency:
+            time.sleep(self.latency)
+
+
+@contextlib.contextmanager
+def install(bucket=None):
+    """let every AliOssSnapshot created in the context use a fake bucket.
+
+    :return: the fake bucket
+    """
+    bucket = bucket or FakeBucket()
+    config = utils.Config()
+    saved = (oss2.Bucket, config.access_key_id, config.access_key_secret)
+
+    oss2.Bucket = lambda *args, **kwargs: bucket
+    config.access_key_id = config.access_key_id or "fake-id"
+    config.access_key_secret = config.access_key_secret or "fake-secret"
+    try:
+        yield bucket
+    finally:
+        oss2.Bucket, config.access_key_id, config.access_key_secret = saved